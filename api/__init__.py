@@ -1,3 +1,13 @@
 """This module implements the API to use along with FreeRADIUS to give an IP to every machine."""
 
-from .api import app
+
+def __getattr__(name):
+    """
+    Lazily import the application, so that the tools of the package can be used without starting it
+    :param name: The attribute name
+    :returns: The attribute
+    """
+    if name == 'app':
+        from .api import app #pylint: disable=C0415
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
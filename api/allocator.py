@@ -0,0 +1,177 @@
+"""This module provides the in-memory allocation of the IP addresses of the pools"""
+
+import logging
+from threading import Lock
+from time import monotonic
+from .constants import ALLOCATOR_TTL, ALLOCATOR_MAX_CONFLICTS
+from .exceptions import NoFreeIPException
+from .ip import IP
+
+
+class PoolAllocator:
+    """
+    This class keeps track of the used IP addresses of a pool in a bitmap.
+    :param lease_prefix: The lease prefix of the pool
+    :param first: The first addressable IP
+    :param last: The last addressable IP
+    """
+    def __init__(self, lease_prefix, first, last):
+        self.lease_prefix = lease_prefix
+        self.first = int(first)
+        self.size = int(last) - self.first + 1
+        self.bits = 0
+        self.loaded_at = None
+        self.lock = Lock()
+
+    @property
+    def expired(self):
+        """
+        Check if the bitmap should be reloaded from the LDAP.
+        :returns: Whether the bitmap is expired
+        """
+        return self.loaded_at is None or monotonic() - self.loaded_at > ALLOCATOR_TTL
+
+    def load(self, ldap):
+        """
+        Load the used IP addresses from the LDAP.
+        :param ldap: The ldap to connect to
+        """
+        bits = 0
+        for ip in ldap.get_used_ips(self.lease_prefix):
+            offset = int(IP(ip)) - self.first
+            if 0 <= offset < self.size:
+                bits |= 1 << offset
+        with self.lock:
+            self.bits = bits
+            self.loaded_at = monotonic()
+        logging.info('[ALLOCATOR][load] Loaded %s used IPs for pool %s', bin(bits).count('1'),
+                     self.lease_prefix)
+
+    def take(self, ip=None):
+        """
+        Mark an IP address as used.
+        :param ip: The IP address, or None to take the first free one
+        :returns: The IP address, or None if the pool is full
+        """
+        with self.lock:
+            if ip is None:
+                # The lowest bit set in ~bits & (bits+1) is the lowest free address
+                offset = (~self.bits & (self.bits + 1)).bit_length() - 1
+            else:
+                offset = int(ip) - self.first
+            if not 0 <= offset < self.size:
+                return None
+            self.bits |= 1 << offset
+            return IP(self.first + offset)
+
+    def release(self, ip):
+        """
+        Mark an IP address as free.
+        :param ip: The IP address
+        """
+        offset = int(IP(ip)) - self.first
+        if 0 <= offset < self.size:
+            with self.lock:
+                self.bits &= ~(1 << offset)
+
+    def allocate(self, ldap):
+        """
+        Allocate the first free IP address of the pool. The address is checked against the LDAP
+        and the pool is fully reloaded only if it looks full or after too many conflicts.
+        :param ldap: The ldap to connect to
+        :returns: The IP address
+        """
+        if self.expired:
+            self.load(ldap)
+        for _ in range(ALLOCATOR_MAX_CONFLICTS):
+            ip = self.take()
+            if ip is None:
+                break
+            if not ldap.is_ip_used(self.lease_prefix, str(ip)):
+                return ip
+            logging.warning('[ALLOCATOR][allocate] %s is already used in pool %s', ip,
+                            self.lease_prefix)
+        self.load(ldap)
+        ip = self.take()
+        if ip is None:
+            raise NoFreeIPException
+        return ip
+
+    def allocate_many(self, ldap, count):
+        """
+        Allocate several free IP addresses of the pool in one pass. The addresses are checked
+        against the LDAP together, and the pool is fully reloaded only if it looks full or after
+        too many conflicts.
+        :param ldap: The ldap to connect to
+        :param count: The number of IP addresses
+        :returns: The IP addresses, fewer than requested if the pool is full
+        """
+        if self.expired:
+            self.load(ldap)
+        ips, candidates = [], []
+        try:
+            for _ in range(ALLOCATOR_MAX_CONFLICTS):
+                while len(ips) + len(candidates) < count:
+                    ip = self.take()
+                    if ip is None:
+                        break
+                    candidates.append(ip)
+                used = (ldap.get_used_ips_among(self.lease_prefix,
+                                                [str(ip) for ip in candidates])
+                        if candidates else set())
+                ips += [ip for ip in candidates if str(ip) not in used]
+                candidates = []
+                if len(ips) == count:
+                    return ips
+                if not used: # The pool looks full
+                    break
+                logging.warning('[ALLOCATOR][allocate_many] %s are already used in pool %s',
+                                ', '.join(sorted(used)), self.lease_prefix)
+            self.load(ldap)
+        except:
+            for ip in ips + candidates: # None of them has been given out
+                self.release(ip)
+            raise
+        for ip in ips: # Still being allocated, so not in the LDAP yet
+            self.take(ip)
+        while len(ips) < count:
+            ip = self.take()
+            if ip is None:
+                break
+            ips.append(ip)
+        return ips
+
+
+class Allocators:
+    """This class holds the allocators of all the pools"""
+    def __init__(self):
+        self.pools = {}
+        self.lock = Lock()
+
+    def get(self, lease_prefix, first, last):
+        """
+        Get the allocator of a pool, creating it if needed.
+        :param lease_prefix: The lease prefix of the pool
+        :param first: The first addressable IP
+        :param last: The last addressable IP
+        :returns: The allocator
+        """
+        key = (lease_prefix, int(first), int(last))
+        try:
+            return self.pools[key]
+        except KeyError:
+            with self.lock:
+                return self.pools.setdefault(key, PoolAllocator(lease_prefix, first, last))
+
+    def release(self, lease_id, ip):
+        """
+        Free the IP address of a removed lease in the matching pools.
+        :param lease_id: The lease ID
+        :param ip: The IP address
+        """
+        for allocator in list(self.pools.values()):
+            if lease_id.startswith(allocator.lease_prefix):
+                allocator.release(ip)
+
+
+ALLOCATORS = Allocators()
@@ -1,56 +1,237 @@
 """This module implements the HTTP API endpoint"""
 
 import logging
-from flask import Flask, request, jsonify
-from . import discovery, requesting
+from hmac import compare_digest
+from time import perf_counter
+from flask import Flask, Response, request, jsonify, g, abort
+from . import discovery, requesting, logs, profiling
+from .exceptions import InvalidBatchException
 from .ip import IP
 from .ldap import Ldap
-from .constants import LDAP_USER, LDAP_PASSWORD, RW_SERVERS, RO_SERVERS
+from .metrics import METRICS, inc, observe
+from .mirror import LeaseMirror
+from .snapshot import Snapshotter, restore
+from .tracing import traced, TraceFilter
+from .constants import (LDAP_USER, LDAP_PASSWORD, RW_SERVERS, RO_SERVERS, LDAP_POOL_SIZE,
+                        LDAP_POOL_MIN, LDAP_HEALTH_INTERVAL, LDAP_IDLE_REFRESH, ADMIN_TOKEN,
+                        PROFILE_MAX_SECONDS, BATCH_MAX_SIZE, LEASE_MIRROR, MIRROR_POLL_INTERVAL,
+                        MIRROR_RESYNC_INTERVAL, MIRROR_POLL_OVERLAP, MIRROR_PAGE_SIZE,
+                        SNAPSHOT_FILE, SNAPSHOT_INTERVAL, SNAPSHOT_MAX_AGE)
 
 
 app = Flask(__name__)
-logging.basicConfig(filename='/var/log/dhcapi.log', filemode='a', level=logging.DEBUG,
-                    format='%(asctime)s -- %(name)s -- %(levelname)s -- %(message)s')
-ldap = Ldap(LDAP_USER, LDAP_PASSWORD, RW_SERVERS, RO_SERVERS)
+logs.setup('/var/log/dhcapi.log', logging.DEBUG,
+           '%(asctime)s -- %(name)s -- %(levelname)s -- %(trace_id)s -- %(message)s',
+           [TraceFilter()])
+ldap = Ldap(LDAP_USER, LDAP_PASSWORD, RW_SERVERS, RO_SERVERS, LDAP_POOL_SIZE)
+if LEASE_MIRROR:
+    ldap.mirror = LeaseMirror(ldap, MIRROR_POLL_INTERVAL, MIRROR_RESYNC_INTERVAL,
+                              MIRROR_POLL_OVERLAP, MIRROR_PAGE_SIZE)
+if SNAPSHOT_FILE: # Before connecting, so that the fastest servers are used first
+    restore(SNAPSHOT_FILE, ldap, SNAPSHOT_MAX_AGE)
+    Snapshotter(SNAPSHOT_FILE, ldap, SNAPSHOT_INTERVAL).start()
+if LDAP_HEALTH_INTERVAL:
+    ldap.start(LDAP_POOL_MIN, LDAP_HEALTH_INTERVAL, LDAP_IDLE_REFRESH)
+if LEASE_MIRROR:
+    ldap.mirror.start()
 
 
-@app.route('/discover', methods=['POST'])
-def discover():
-    """This route is the endpoint to answer DHCPDISCOVERs"""
-    relay_ip = IP(request.form.get('relay_ip'))
-    mac = ''.join(request.form.get('mac').split(':')).lower()
+def answer_discover(form):
+    """
+    Answer a DHCPDISCOVER.
+    :param form: The request form
+    :returns: The answer
+    """
+    relay_ip = IP(form.get('relay_ip'))
+    mac = ''.join(form.get('mac').split(':')).lower()
 
-    if relay_ip == '0.0.0.0':
-        return discovery.Result.do_not_respond(), 200
+    if not relay_ip:
+        return discovery.Result.do_not_respond()
 
-    result = discovery.process(ldap, relay_ip, mac)
+    with traced('discover'), profiling.request():
+        result = discovery.process(ldap, relay_ip, mac)
 
-    discovery.log(mac, result)
+        discovery.log(mac, result)
+    inc('dhcapi_results_total', type='discover', message=result.message.name)
 
-    return jsonify(result.get_dict()), 200
+    return result.get_dict()
 
-@app.route('/request', methods=['POST'])
-def req():
-    """This route is the endpoint to answer DHCPREQUESTs"""
-    relay_ip = IP(request.form.get('relay_ip'))
+def answer_request(form):
+    """
+    Answer a DHCPREQUEST.
+    :param form: The request form
+    :returns: The answer
+    """
+    relay_ip = IP(form.get('relay_ip'))
     try:
-        requested_ip = IP(request.form.get('requested_ip'))
+        requested_ip = IP(form.get('requested_ip'))
     except ValueError:
         return requesting.Result.nak()
-    mac = ''.join(request.form.get('mac').split(':')).lower()
-    hostname = request.form.get('hostname').strip()
+    mac = ''.join(form.get('mac').split(':')).lower()
+    hostname = form.get('hostname').strip()
+
+    if not relay_ip:
+        return requesting.Result.do_not_respond()
+
+    with traced('request'), profiling.request():
+        result = requesting.process(ldap, relay_ip, requested_ip, mac, hostname)
+
+        requesting.log(mac, result)
+    inc('dhcapi_results_total', type='request', message=result.message.name)
+
+    return result.get_dict()
+
+
+def batch(forms):
+    """
+    Check the body of a batch request.
+    :param forms: The decoded JSON body
+    :returns: The request forms of the clients
+    """
+    if not isinstance(forms, list) or not all(isinstance(form, dict) for form in forms):
+        raise InvalidBatchException('The body must be a JSON list of forms')
+    if len(forms) > BATCH_MAX_SIZE:
+        raise InvalidBatchException(f'A batch holds at most {BATCH_MAX_SIZE} clients')
+    return forms
+
+def answer_discover_batch(forms):
+    """
+    Answer the DHCPDISCOVERs of several clients at once.
+    :param forms: The request forms of the clients
+    :returns: The answers, in the order of the forms
+    """
+    forms = batch(forms)
+    answers, clients, indexes = [None] * len(forms), [], []
+    for i, form in enumerate(forms):
+        try:
+            relay_ip = IP(form.get('relay_ip'))
+            mac = ''.join(form.get('mac').split(':')).lower()
+        except (TypeError, ValueError, AttributeError) as e:
+            raise InvalidBatchException(f'Invalid form {i}') from e
+        if not relay_ip:
+            answers[i] = discovery.Result.do_not_respond()
+        else:
+            clients.append((relay_ip, mac))
+            indexes.append(i)
+
+    with traced('discover_batch'), profiling.request():
+        results = discovery.process_batch(ldap, clients) if clients else []
+        for i, (_, mac), result in zip(indexes, clients, results):
+            discovery.log(mac, result)
+            inc('dhcapi_results_total', type='discover', message=result.message.name)
+            answers[i] = result.get_dict()
+
+    return answers
+
+def answer_request_batch(forms):
+    """
+    Answer the DHCPREQUESTs of several clients at once.
+    :param forms: The request forms of the clients
+    :returns: The answers, in the order of the forms
+    """
+    forms = batch(forms)
+    answers, clients, indexes = [None] * len(forms), [], []
+    for i, form in enumerate(forms):
+        try:
+            relay_ip = IP(form.get('relay_ip'))
+            mac = ''.join(form.get('mac').split(':')).lower()
+            hostname = form.get('hostname').strip()
+        except (TypeError, ValueError, AttributeError) as e:
+            raise InvalidBatchException(f'Invalid form {i}') from e
+        try:
+            requested_ip = IP(form.get('requested_ip'))
+        except (TypeError, ValueError):
+            answers[i] = requesting.Result.nak()
+            continue
+        if not relay_ip:
+            answers[i] = requesting.Result.do_not_respond()
+        else:
+            clients.append((relay_ip, requested_ip, mac, hostname))
+            indexes.append(i)
 
-    if relay_ip == '0.0.0.0':
-        return requesting.Result.do_not_respond(), 200
+    with traced('request_batch'), profiling.request():
+        results = requesting.process_batch(ldap, clients) if clients else []
+        for i, (_, _, mac, _), result in zip(indexes, clients, results):
+            requesting.log(mac, result)
+            inc('dhcapi_results_total', type='request', message=result.message.name)
+            answers[i] = result.get_dict()
 
-    result = requesting.process(ldap, relay_ip, requested_ip, mac, hostname)
+    return answers
 
-    requesting.log(mac, result)
 
-    return jsonify(result.get_dict()), 200
+@app.before_request
+def start_timer():
+    """Measure the duration of every request"""
+    g.start = perf_counter()
+
+@app.after_request
+def count_request(response):
+    """Count the requests by route and status, and record their duration"""
+    route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    inc('dhcapi_requests_total', route=route, status=response.status_code)
+    observe('dhcapi_request_seconds', perf_counter() - g.start, route=route)
+    return response
+
+
+@app.route('/discover', methods=['POST'])
+def discover():
+    """This route is the endpoint to answer DHCPDISCOVERs"""
+    return jsonify(answer_discover(request.form)), 200
+
+@app.route('/request', methods=['POST'])
+def req():
+    """This route is the endpoint to answer DHCPREQUESTs"""
+    return jsonify(answer_request(request.form)), 200
+
+@app.route('/discover/batch', methods=['POST'])
+def discover_batch():
+    """
+    This route is the endpoint to answer the DHCPDISCOVERs of several clients, given as a JSON list
+    of forms
+    """
+    try:
+        return jsonify(answer_discover_batch(request.get_json(force=True, silent=True))), 200
+    except InvalidBatchException as e:
+        return jsonify({'error': e.args[0]}), 400
+
+@app.route('/request/batch', methods=['POST'])
+def request_batch():
+    """
+    This route is the endpoint to answer the DHCPREQUESTs of several clients, given as a JSON list
+    of forms
+    """
+    try:
+        return jsonify(answer_request_batch(request.get_json(force=True, silent=True))), 200
+    except InvalidBatchException as e:
+        return jsonify({'error': e.args[0]}), 400
 
 @app.route('/cleanup')
 def cleanup():
     """This route is the endpoint to remove old leases"""
-    ldap.remove_expired_leases()
-    return jsonify(None), 204
+    return jsonify(ldap.remove_expired_leases()), 200
+
+@app.route('/metrics')
+def metrics():
+    """This route is the endpoint exposing the metrics of all the workers"""
+    return Response(METRICS.render(), 200, mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profile')
+def profile():
+    """
+    This route is the endpoint profiling the worker which receives it for some seconds, given as
+    the seconds parameter, with cProfile or by sampling its stacks, according to the mode parameter
+    """
+    if not ADMIN_TOKEN or not compare_digest(request.headers.get('Authorization', ''),
+                                             f'Bearer {ADMIN_TOKEN}'):
+        abort(404)
+    mode = request.args.get('mode', 'sample')
+    if mode not in ['cprofile', 'sample']:
+        abort(400)
+    seconds = min(float(request.args.get('seconds', 10)), PROFILE_MAX_SECONDS)
+    result = profiling.run(mode, seconds)
+    if result is None:
+        abort(409)
+    if mode == 'cprofile':
+        return Response(result, 200, mimetype='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=dhcapi.prof'})
+    return Response(result, 200, mimetype='text/plain')
@@ -0,0 +1,135 @@
+"""
+This module implements the HTTP API endpoint as an ASGI application. The LDAP operations block, so
+they run in a thread pool while the event loop keeps accepting requests: a single process can then
+hold many DHCP transactions in flight, bounded by the thread pool and the LDAP connection pools.
+"""
+
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from urllib.parse import parse_qsl
+from .api import (ldap, answer_discover, answer_request, answer_discover_batch,
+                  answer_request_batch)
+from .exceptions import InvalidBatchException
+from .metrics import METRICS, inc, observe
+from .constants import ASGI_THREADS
+
+
+executor = ThreadPoolExecutor(ASGI_THREADS, thread_name_prefix='asgi')
+
+
+def cleanup(_):
+    """This route is the endpoint to remove old leases"""
+    return ldap.remove_expired_leases()
+
+
+def metrics(_):
+    """This route is the endpoint exposing the metrics of all the workers"""
+    return METRICS.render()
+
+
+async def read_body(receive):
+    """
+    Read the request body.
+    :param receive: The ASGI receive channel
+    :returns: The body
+    """
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def parse_form(body):
+    """
+    Parse an URL-encoded form.
+    :param body: The request body
+    :returns: The form as a dictionary
+    """
+    return dict(parse_qsl(body.decode(), keep_blank_values=True))
+
+
+def parse_json(body):
+    """
+    Parse a JSON body.
+    :param body: The request body
+    :returns: The decoded body, or None if it is not JSON
+    """
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+ROUTES = {('POST', '/discover'): (answer_discover, parse_form),
+          ('POST', '/request'): (answer_request, parse_form),
+          ('POST', '/discover/batch'): (answer_discover_batch, parse_json),
+          ('POST', '/request/batch'): (answer_request_batch, parse_json),
+          ('GET', '/cleanup'): (cleanup, parse_form),
+          ('GET', '/metrics'): (metrics, parse_form)}
+
+
+async def respond(send, status, body):
+    """
+    Send a JSON response, or a text one for a string.
+    :param send: The ASGI send channel
+    :param status: The HTTP status
+    :param body: The object to send
+    """
+    if isinstance(body, str):
+        content, content_type = body.encode(), b'text/plain; version=0.0.4'
+    else:
+        content, content_type = json.dumps(body).encode(), b'application/json'
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type),
+                            (b'content-length', str(len(content)).encode())]})
+    await send({'type': 'http.response.body', 'body': content})
+
+
+async def lifespan(receive, send):
+    """
+    Handle the startup and the shutdown of the application.
+    :param receive: The ASGI receive channel
+    :param send: The ASGI send channel
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=True)
+            ldap.disconnect()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI application.
+    :param scope: The connection scope
+    :param receive: The ASGI receive channel
+    :param send: The ASGI send channel
+    """
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    route = ROUTES.get((scope['method'], scope['path']))
+    if route is None:
+        return await respond(send, 404, {'error': 'Not Found'})
+    handler, parse = route
+    start = perf_counter()
+    body = parse(await read_body(receive))
+    try:
+        answer = await asyncio.get_running_loop().run_in_executor(executor, handler, body)
+        status = 200
+    except InvalidBatchException as e:
+        answer, status = {'error': e.args[0]}, 400
+    except Exception:
+        logging.exception('[ASGI][app] Exception on %s %s', scope['method'], scope['path'])
+        answer, status = {'error': 'Internal Server Error'}, 500
+    inc('dhcapi_requests_total', route=scope['path'], status=status)
+    observe('dhcapi_request_seconds', perf_counter() - start, route=scope['path'])
+    return await respond(send, status, answer)
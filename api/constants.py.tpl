@@ -2,23 +2,102 @@
 
 
 CONFIG_FILE = '/srv/dhcapi/dhcp.conf'
+ENV_CACHE_SIZE = 4096 # Number of resolved environments cached by relay IP address
 
 RW_SERVERS = [] # Read/Write LDAP servers
 RO_SERVERS = [] # Read-Only LDAP servers
+LDAP_POOL_SIZE = 8 # Maximum number of connections to each LDAP server, per worker
+LDAP_POOL_MIN = 1 # Connections opened to each LDAP server at startup, per worker
+LDAP_HEALTH_INTERVAL = 10 # Seconds between two health checks of the LDAP servers, 0 to disable
+LDAP_IDLE_REFRESH = 120 # Seconds after which idle LDAP connections are checked
+REQUEST_DEADLINE = 3 # Seconds to answer a request, after which clients retransmit anyway
+# Send lease lookups to a second server if the first one has not answered within the given
+# percentile of the recent lookup latencies
+HEDGE_READS = True
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_DELAY = 0.01 # Minimum seconds before a lookup is sent to a second server
+HEDGE_WORKERS = 16 # Number of threads sending the lookups to a second server, per worker
+ASGI_THREADS = 128 # Requests processed at once by a worker of the ASGI application
+# Searches go to R/O servers first. Read the leases just created, or looked up again before being
+# created, from the R/W server, so that replication lag cannot hide them
+READ_YOUR_WRITES = True
 LDAP_USER = 'cn=admin,dc=maisel,dc=enst-bretagne,dc=fr'
 LDAP_PASSWORD = '' # LDAP password
 LEASES_DN = 'ou=leases,dc=resel,dc=enst-bretagne,dc=fr'
 DEVICES_DN = 'ou=devices,dc=resel,dc=enst-bretagne,dc=fr'
+LEASE_CACHE_SIZE = 16384 # Number of lease IDs whose leases are cached
+LEASE_CACHE_TTL = 60 # Seconds during which cached leases are used, shorter than the offer window
+RENEWAL_FRACTION = 0.5 # Fraction of the lease duration left under which a renewal is written
+HOSTNAME_CACHE_SIZE = 16384 # Number of written hostnames remembered to skip unchanged ones
+# Requests for an IP the client has no lease for are answered again without looking the lease up,
+# until a lease is created for the client by this worker or for a few seconds, as other workers may
+# create one meanwhile
+NEGATIVE_CACHE_SIZE = 16384 # Number of (relay IP, MAC address, requested IP) remembered
+NEGATIVE_CACHE_TTL = 10 # Seconds during which a request is answered without lookup
+# Write renewals from a background thread, in batches, unless the stored expiry is shorter than the
+# lease given to the client. Pending writes are applied at exit, and lost if the worker is killed
+WRITE_BEHIND = False
+WRITE_BEHIND_INTERVAL = 1 # Maximum seconds a queued write waits
+WRITE_BEHIND_BATCH = 100 # Number of queued writes triggering an early batch
+WRITE_BEHIND_RETRIES = 3 # Number of times a failed queued write is queued again
+CLEANUP_PAGE_SIZE = 500 # Number of expired leases fetched at once by the cleanup
+CLEANUP_WORKERS = 4 # Number of connections removing expired leases in parallel, < LDAP_POOL_SIZE
+# Mirror all the leases in memory, loaded at startup and kept up to date by polling the changes.
+# Leases missing from the mirror are still looked up in the LDAP
+LEASE_MIRROR = False
+MIRROR_POLL_INTERVAL = 5 # Seconds between two polls of the changed leases
+MIRROR_POLL_OVERLAP = 10 # Seconds of changes polled again, covering the replication lag
+MIRROR_RESYNC_INTERVAL = 300 # Seconds between two full reloads, dropping the removed leases
+MIRROR_PAGE_SIZE = 1000 # Number of leases fetched at once by a full reload
+# File the workers save their resolved environments, pool bitmaps, server health and lease mirror
+# to, restored by the workers starting afterwards. Disabled if empty
+SNAPSHOT_FILE = ''
+SNAPSHOT_INTERVAL = 60 # Seconds between two snapshots of a worker
+SNAPSHOT_MAX_AGE = 3600 # Seconds after which a snapshot is not restored anymore
+
+
+ALLOCATOR_TTL = 600 # Seconds after which the used IPs of a pool are reloaded from the LDAP
+ALLOCATOR_MAX_CONFLICTS = 3 # Conflicts with the LDAP before the used IPs of a pool are reloaded
+LOCK_STRIPES = 64 # Number of locks serializing the lease creations, shared by pools
+# 'lock' serializes the lease creations of a pool within the process, 'optimistic' does not lock
+# and checks for conflicts in the LDAP instead, on the first available R/W node of RW_SERVERS, which
+# is safe across workers as long as they agree on which nodes are available
+ALLOCATION_MODE = 'lock'
+ALLOCATION_RETRIES = 5 # Conflicts allowed in optimistic mode before giving up
+ALLOCATION_RECHECKS = 3 # Checks again of the first of conflicting leases, waiting for the others
+ALLOCATION_RECHECK_DELAY = 0.01 # Seconds before the first check again, doubled every time
+BATCH_MAX_SIZE = 1000 # Number of clients accepted by a call of the batch routes
+BATCH_FILTER_SIZE = 100 # Number of lease IDs or IPs looked up by a single search of a batch
 
 
 MESSAGES = ['OK', 'No free IP', 'No lease', 'Unaddressable pool', 'Configuration error',
             'LDAP error']
 
 
-DISCOVERY_LINE = '{}// dhcp.discover{{relay_ip={},mac={},ip={},status={}}} 1\n'
+# The transaction lines are given the timestamp, relay IP, MAC, IP, status, vid and zid in this
+# order, and the trace ID of the transaction, which the debug log details, as {trace_id}
+DISCOVERY_LINE = '{}// dhcp.discover{{relay_ip={},mac={},ip={},status={},trace_id={trace_id}}} 1\n'
 DISCOVERY_LOG_FILE = '/tmp/discover'
-REQUEST_LINE = '{}// dhcp.request{{relay_ip={},mac={},ip={},status={}}} 1\n'
+REQUEST_LINE = '{}// dhcp.request{{relay_ip={},mac={},ip={},status={},trace_id={trace_id}}} 1\n'
 REQUEST_LOG_FILE = '/tmp/request'
+# 'text' writes the lines above, 'binary' writes compact records to indexed segments which can be
+# queried with python -m api.txlog, 'both' writes both
+TRANSACTION_LOG = 'text'
+TXLOG_DIR = '/var/lib/dhcapi/txlog' # Directory of the binary transaction log segments
+TXLOG_SEGMENT_BYTES = 67108864 # Size after which a segment is indexed and a new one started
+LOG_QUEUE_SIZE = 100000 # Number of pending log lines after which lines are dropped
+LOG_FLUSH_SIZE = 65536 # Number of pending bytes triggering a write to a log file
+LOG_FLUSH_INTERVAL = 1 # Maximum seconds a log line waits before being written
+LOG_MAX_BYTES = 104857600 # Size after which a log file is rotated, 0 to never rotate
+LOG_BACKUPS = 5 # Number of rotated files kept per log file
+LOG_SAMPLING = {'DEBUG': 1, 'INFO': 1} # Fraction of the debug log records kept, by level
 
 
 SERVER_IP = '' # The server IP address
+TRACE_SLOW = 0.5 # Seconds after which the spans of a transaction are logged as a warning
+ADMIN_TOKEN = '' # Token of the admin routes, which are disabled if it is empty
+PROFILE_MAX_SECONDS = 60 # Maximum duration of a profiling session
+
+
+METRICS_DIR = '/tmp/dhcapi-metrics' # Directory of the metrics of the workers, cleared by gunicorn
+METRICS_INTERVAL = 5 # Seconds between two dumps of the metrics of a worker
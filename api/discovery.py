@@ -2,17 +2,30 @@
 
 
 import logging
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
-from multiprocessing import Lock
 from .exceptions import (LeaseNotFoundException, NoFreeIPException, FieldUndefinedException,
-                         NoRuleMatchedException)
+                         NoRuleMatchedException, DeadlineExceededException)
+from .allocator import ALLOCATORS
 from .loader import get_env
+from .locks import StripedLock
+from .logs import writer
+from . import txlog
 from .messages import Message
 from .models import Lease, BaseResult
-from .constants import DISCOVERY_LINE, DISCOVERY_LOG_FILE
+from .roundrobin import with_deadline, bound
+from .metrics import inc, timed
+from .tracing import traced, span, trace_id
+from .util import SingleFlight
+from .constants import (DISCOVERY_LINE, DISCOVERY_LOG_FILE, LOCK_STRIPES, ALLOCATION_MODE,
+                        READ_YOUR_WRITES, REQUEST_DEADLINE, TRANSACTION_LOG)
 
 
-lock = Lock()
+# Lease creations are serialized by pool, as pools allocate from disjoint ranges
+lock = StripedLock(LOCK_STRIPES)
+# The discoveries running, by lease ID: retransmitted or duplicated DISCOVERs of a client wait for
+# the first one and share its lease
+flights = SingleFlight()
 
 
 class Result(BaseResult):
@@ -32,6 +45,8 @@ class Result(BaseResult):
         return self.offer()
 
 
+@traced('discovery.process')
+@with_deadline(REQUEST_DEADLINE)
 def process(ldap, relay_ip, mac):
     """
     Return an existing lease or create one.
@@ -47,21 +62,150 @@ def process(ldap, relay_ip, mac):
     except FieldUndefinedException as e:
         return Result(Message.CONF_ERROR, e.args[0])
     lid = f'{env["lease_prefix"]}{env["mac"]}'
-    try: # Avoid the costly critical section
-        return Result(Message.OK, env, Lease.from_ldap(ldap, lid))
-    except LeaseNotFoundException:
-        with lock:
-            try: # Just make sure nothing new happened
-                return Result(Message.OK, env, Lease.from_ldap(ldap, lid))
-            except LeaseNotFoundException:
-                try:
-                    c_env = {k: v for k, v in env.items() if k in ['first', 'last', 'mac',
-                                                                   'lease_prefix']}
-                    return Result(Message.OK, env, Lease.create(ldap, **c_env))
-                except NoFreeIPException:
-                    return Result(Message.NO_FREE_IP, env)
-                except:
-                    return Result(Message.LDAP_ERROR, env)
+    try:
+        result, shared = flights.do(lid, discover, ldap, env, lid, timeout=bound(None))
+    except (DeadlineExceededException, FutureTimeoutError): # The first discovery is too slow
+        logging.warning('[DISCOVERY][process] Deadline exceeded for %s', mac)
+        return Result(Message.LDAP_ERROR, env)
+    if not shared:
+        return result
+    inc('dhcapi_coalesced_total', type='discover')
+    return Result(result.message, env, result.lease)
+
+
+def discover(ldap, env, lid):
+    """
+    Return an existing lease or create one.
+    :param ldap: The ldap to connect to
+    :param env: The lease environment
+    :param lid: The lease ID
+    """
+    try:
+        try: # Avoid the costly critical section
+            return Result(Message.OK, env, Lease.from_ldap(ldap, lid))
+        except LeaseNotFoundException:
+            if ALLOCATION_MODE == 'optimistic':
+                return create(ldap, env, verify=True)
+            with lock[env['lease_prefix']]:
+                try: # Just make sure nothing new happened
+                    return Result(Message.OK, env,
+                                  Lease.from_ldap(ldap, lid, primary=READ_YOUR_WRITES))
+                except LeaseNotFoundException:
+                    return create(ldap, env)
+    except DeadlineExceededException: # The client has already given up on this answer
+        logging.warning('[DISCOVERY][discover] Deadline exceeded for %s', env['mac'])
+        return Result(Message.LDAP_ERROR, env)
+
+
+def create(ldap, env, verify=False):
+    """
+    Create a lease.
+    :param ldap: The ldap to connect to
+    :param env: The lease environment
+    :param verify: Whether the lease creation should be checked for conflicts
+    """
+    try:
+        c_env = {k: v for k, v in env.items() if k in ['first', 'last', 'mac', 'lease_prefix']}
+        return Result(Message.OK, env, Lease.create(ldap, **c_env, verify=verify))
+    except NoFreeIPException:
+        return Result(Message.NO_FREE_IP, env)
+    except:
+        return Result(Message.LDAP_ERROR, env)
+
+
+@traced('discovery.process_batch')
+@with_deadline(REQUEST_DEADLINE)
+def process_batch(ldap, clients):
+    """
+    Return the existing leases of several clients or create them, looking up the leases of the
+    clients of a pool together and allocating their new leases in one pass.
+    :param ldap: The ldap to connect to
+    :param clients: The (relay IP, MAC address) of the clients
+    :returns: The results, in the order of the clients
+    """
+    results, pools = [None] * len(clients), {}
+    for i, (relay_ip, mac) in enumerate(clients):
+        logging.info('[DISCOVERY][process_batch] DHCPDISCOVER from %s on %s', mac, relay_ip)
+        try:
+            env = get_env(relay_ip, mac)
+        except NoRuleMatchedException as e:
+            results[i] = Result(Message.UNADDRESSABLE, e.args[0])
+            continue
+        except FieldUndefinedException as e:
+            results[i] = Result(Message.CONF_ERROR, e.args[0])
+            continue
+        pool = pools.setdefault((env['lease_prefix'], env['first'], env['last']), {})
+        pool.setdefault(f'{env["lease_prefix"]}{env["mac"]}', []).append((i, env))
+    for pool in pools.values():
+        leases = discover_pool(ldap, {lid: members[0][1] for lid, members in pool.items()})
+        for lid, members in pool.items():
+            for i, env in members:
+                lease = leases[lid]
+                results[i] = (Result(Message.OK, env, lease) if isinstance(lease, Lease)
+                              else Result(lease, env))
+    return results
+
+
+def discover_pool(ldap, clients):
+    """
+    Find or create the leases of clients of a same pool.
+    :param ldap: The ldap to connect to
+    :param clients: The environments of the clients, by lease ID
+    :returns: The leases, or the messages of the clients without one, by lease ID
+    """
+    leases = {}
+    try:
+        for lid, found in ldap.get_leases(list(clients)).items():
+            leases[lid] = Lease(ldap, **ldap.pick_lease(found))
+        missing = [lid for lid in clients if lid not in leases]
+        if missing and ALLOCATION_MODE == 'optimistic': # Conflicts are checked lease by lease
+            for lid in missing:
+                result = create(ldap, clients[lid], verify=True)
+                leases[lid] = result.lease if result.message == Message.OK else result.message
+        elif missing:
+            with lock[clients[missing[0]]['lease_prefix']]:
+                # Just make sure nothing new happened
+                for lid, found in ldap.get_leases(missing, primary=READ_YOUR_WRITES).items():
+                    leases[lid] = Lease(ldap, **ldap.pick_lease(found))
+                leases.update(create_batch(ldap, {lid: clients[lid] for lid in missing
+                                                  if lid not in leases}))
+    except DeadlineExceededException: # The clients have already given up on these answers
+        logging.warning('[DISCOVERY][discover_pool] Deadline exceeded for %s clients',
+                        len(clients) - len(leases))
+    except:
+        logging.exception('[DISCOVERY][discover_pool] Could not discover %s clients',
+                          len(clients) - len(leases))
+    return {lid: leases.get(lid, Message.LDAP_ERROR) for lid in clients}
+
+
+def create_batch(ldap, clients):
+    """
+    Create the leases of clients of a same pool, allocating their IPs in one pass.
+    :param ldap: The ldap to connect to
+    :param clients: The environments of the clients, by lease ID
+    :returns: The leases, or the messages of the clients without one, by lease ID
+    """
+    if not clients:
+        return {}
+    env = next(iter(clients.values()))
+    allocator = ALLOCATORS.get(env['lease_prefix'], env['first'], env['last'])
+    with span('allocate'), timed('dhcapi_stage_seconds', stage='allocate'):
+        ips = allocator.allocate_many(ldap, len(clients))
+    leases = {}
+    try:
+        for (lid, env), ip in zip(clients.items(), ips):
+            try:
+                leases[lid] = Lease.add(ldap, lid, env['mac'], ip)
+            except DeadlineExceededException:
+                raise
+            except:
+                logging.exception('[DISCOVERY][create_batch] Could not add lease %s', lid)
+                leases[lid] = Message.LDAP_ERROR
+    finally:
+        for (lid, _), ip in zip(clients.items(), ips):
+            if not isinstance(leases.get(lid), Lease):
+                allocator.release(ip)
+    return {lid: leases.get(lid, Message.NO_FREE_IP) for lid in clients}
 
 
 def log(mac, result):
@@ -70,8 +214,11 @@ def log(mac, result):
     :param mac: The machine MAC address
     :param result: The discovery result
     """
-    with open(DISCOVERY_LOG_FILE, 'a') as logfile:
-        logfile.write(DISCOVERY_LINE.format(int(datetime.now().timestamp() * 1000000),
-                                            result.router_ip, mac, result.get_ip(),
-                                            result.message.name, result.env.get('vid', 'UNKNOWN'),
-                                            result.env.get('zid', 'UNKNOWN')))
+    timestamp = int(datetime.now().timestamp() * 1000000)
+    if TRANSACTION_LOG != 'binary':
+        writer(DISCOVERY_LOG_FILE).write(DISCOVERY_LINE.format(
+            timestamp, result.router_ip, mac, result.get_ip(), result.message.name,
+            result.env.get('vid', 'UNKNOWN'), result.env.get('zid', 'UNKNOWN'),
+            trace_id=trace_id()))
+    if TRANSACTION_LOG != 'text':
+        txlog.log(txlog.DISCOVER, timestamp, mac, result)
@@ -1,7 +1,8 @@
 """This module provides all the exceptions needed by the API"""
 
 
-from .roundrobin import NotFoundException, NoMoreIPException, ReadOnlyException
+from .roundrobin import (NotFoundException, NoMoreIPException, ReadOnlyException,
+                         DeadlineExceededException)
 
 
 class LeaseNotFoundException(NotFoundException):
@@ -10,6 +11,9 @@ class LeaseNotFoundException(NotFoundException):
 class NoFreeIPException(Exception):
     """This class represents the fact that no free IP is available"""
 
+class AllocationConflictException(Exception):
+    """This class represents the fact that the allocated IPs kept conflicting with other leases"""
+
 class UnaddressablePoolException(Exception):
     """This class represents the fact that the given IP is not in any addressable pool"""
 
@@ -18,3 +22,6 @@ class FieldUndefinedException(Exception):
 
 class NoRuleMatchedException(Exception):
     """This class represents the fact that no rule has been matched"""
+
+class InvalidBatchException(ValueError):
+    """This class represents the fact that the body of a batch request is invalid"""
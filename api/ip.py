@@ -1,12 +1,64 @@
 """This module provides tools to manipulate IP addresses and pools"""
 
 
-from functools import reduce
+PARSE_CACHE_SIZE = 65536
+_parsed = {} # The integer representations of the recently parsed strings, such as relay IPs
+
+
+def _parse(text):
+    """
+    Convert an IP string into its integer representation
+    :param text: The string
+    :returns: Its integer representation
+    """
+    parts = text.split('.')
+    if len(parts) == 4:
+        a, b, c, d = parts
+        return (int(a) << 24) + (int(b) << 16) + (int(c) << 8) + int(d)
+    ip = 0
+    for part in parts:
+        ip = ip * 256 + int(part)
+    return ip
+
+
+def _int(obj):
+    """
+    Convert an IP-like object into its integer representation
+    :param obj: The IP, string or integer
+    :returns: Its integer representation
+    """
+    if type(obj) is IP: #pylint: disable=C0123
+        return obj._ip #pylint: disable=W0212
+    if isinstance(obj, str):
+        ip = _parsed.get(obj)
+        if ip is None:
+            ip = _parse(obj)
+            if len(_parsed) >= PARSE_CACHE_SIZE:
+                _parsed.clear()
+            _parsed[obj] = ip
+        return ip
+    if isinstance(obj, int):
+        return obj
+    if isinstance(obj, IP):
+        return obj._ip #pylint: disable=W0212
+    raise TypeError(f'Invalid argument: {repr(obj)}')
+
+
+def _from_int(value):
+    """
+    Build an IP from its integer representation without any conversion
+    :param value: The integer
+    :returns: The IP
+    """
+    ip = object.__new__(IP)
+    ip._ip = value #pylint: disable=W0212
+    ip._str = None #pylint: disable=W0212
+    return ip
 
 
 class Network:
     """
-    This class represents an IP network.
+    This class represents an IP network. Networks are immutable.
     :param ip: The network string (IP/Mask, IP/Mask/Contiguous mask)
     If the given mask is contiguous (its MSB=1 and there is no 0 between the MSB and the least
     significant 1) and no other contiguous mask is provided, the result will be the one expected.
@@ -14,31 +66,56 @@ class Network:
     ignoring some bits; when computing the base IP of the network, the ignored bits may be needed.
     That is what this algorithm assumes.
     """
+    __slots__ = ('_ip', '_mask', '_contiguous_mask')
+
     def __init__(self, network):
         network_parts = network.split('/')
         ip, mask = network_parts[:2]
-        self.ip = IP(ip)
+        self._ip = IP(ip)
         try:
             int_mask = int(mask)
-            self.mask = IP((2**int_mask-1) * 2**(32-int_mask))
+            self._mask = _from_int((2**int_mask-1) * 2**(32-int_mask))
         except ValueError:
-            self.mask = IP(mask)
+            self._mask = IP(mask)
         if len(network_parts) == 2:
-            self.contiguous_mask = IP('255.255.255.255') - IP((self.mask.ip&-self.mask.ip)-1)
+            self._contiguous_mask = _from_int(0xffffffff - ((self._mask._ip&-self._mask._ip)-1))
         elif len(network_parts) == 3:
             contiguous_mask = network_parts[2]
             try:
                 int_contiguous_mask = int(contiguous_mask)
-                self.contiguous_mask = IP((2**int_contiguous_mask-1) * 2**(32-int_contiguous_mask))
+                self._contiguous_mask = _from_int((2**int_contiguous_mask-1)
+                                                  * 2**(32-int_contiguous_mask))
             except ValueError:
-                self.contiguous_mask = IP(contiguous_mask)
+                self._contiguous_mask = IP(contiguous_mask)
+
+    @property
+    def ip(self):
+        """The network IP"""
+        return self._ip
+
+    @property
+    def mask(self):
+        """The network mask"""
+        return self._mask
+
+    @property
+    def contiguous_mask(self):
+        """The contiguous mask giving the base IP of the network"""
+        return self._contiguous_mask
+
+    def __reduce__(self):
+        """
+        Pickle the network through its string representation
+        :returns: The class and its arguments
+        """
+        return type(self), (f'{self._ip}/{self._mask}/{self._contiguous_mask}',)
 
     def __str__(self):
         """
         Return the string representation of the network
         :returns: The string representation
         """
-        return f'{self.ip}/{self.mask}'
+        return f'{self._ip}/{self._mask}'
 
     def __repr__(self):
         """
@@ -53,7 +130,7 @@ class Network:
         :param ip: The ip
         :returns: Whether the IP is in the network
         """
-        return not (ip^self.ip) & self.mask
+        return not (_int(ip) ^ self._ip._ip) & self._mask._ip
 
     def base_ip(self, ip=None):
         """
@@ -62,66 +139,103 @@ class Network:
         :param ip: The IP to consider
         """
         if ip is None:
-            ip = self.ip
-        return ip & self.contiguous_mask
+            ip = self._ip
+        return _from_int(_int(ip) & self._contiguous_mask._ip)
 
-class IP:
+class NetworkIndex:
     """
-    This class represents an IP address
-    :param ip: The IP string or integer
+    This class indexes networks by mask in order to find the first network containing an IP without
+    checking them one by one.
+    :param networks: The networks, by order of priority
     """
-    def __init__(self, ip):
-        self.ip = self._int(ip)
+    def __init__(self, networks):
+        groups = {}
+        for i, network in enumerate(networks):
+            mask = int(network.mask)
+            groups.setdefault(mask, {}).setdefault(int(network.ip) & mask, i)
+        # Masks are sorted by their first network, so that the lookup can stop as soon as no
+        # remaining mask can yield a better network
+        self.groups = sorted(((min(bases.values()), mask, bases) for mask, bases in groups.items()),
+                             key=lambda group: group[0])
 
-    @classmethod
-    def _int(cls, obj):
+    def find(self, ip):
         """
-        Convert an IP-like object into its integer representation
-        :param obj: The object
-        :returns: Its integer representation
+        Find the first network containing an IP.
+        :param ip: The IP
+        :returns: The index of the network, or None if no network contains the IP
         """
-        if isinstance(obj, str):
-            return reduce(lambda x, y: x*2**8+int(y), obj.split('.'), 0)
-        if isinstance(obj, int):
-            return obj
-        if isinstance(obj, cls):
-            return obj.ip
-        raise TypeError(f'Invalid argument: {repr(obj)}')
+        ip = int(ip)
+        best = None
+        for first, mask, bases in self.groups:
+            if best is not None and first > best:
+                break
+            i = bases.get(ip & mask)
+            if i is not None and (best is None or i < best):
+                best = i
+        return best
 
-    def _op(self, op, other):
-        """
-        Apply a binary operator on the integer representations of two IP addresses
-        :param op: The operator to apply
-        :param other: The other IP-like object
-        """
-        return IP(op(self._int(self), self._int(other)))
+class IP:
+    """
+    This class represents an IP address. IPs are immutable and hashable like their integer
+    representation, so that they can be shared, and used in sets and as dictionary keys. Their
+    string representation is computed once.
+    :param ip: The IP string or integer
+    """
+    __slots__ = ('_ip', '_str')
+
+    def __new__(cls, ip):
+        if type(ip) is cls: #pylint: disable=C0123
+            return ip
+        self = object.__new__(cls)
+        self._ip = _int(ip)
+        self._str = None
+        return self
 
-    def _rop(self, op, other):
+    @property
+    def ip(self):
+        """The integer representation of the IP address"""
+        return self._ip
+
+    def __reduce__(self):
         """
-        Apply a binary operator on the integer representations of two IP addresses after reversing
-        the operands
-        :param op: The operator to apply
-        :param other: The other IP-like object
+        Pickle the IP through its integer representation
+        :returns: The class and its arguments
         """
-        return IP(op(self._int(other), self._int(self)))
+        return type(self), (self._ip,)
 
     def __int__(self):
         """
         Return the integer representation of the IP address
         :returns: The integer representation
         """
-        return self.ip
+        return self._ip
+
+    def __hash__(self):
+        """
+        Return the hash of the integer representation of the IP address
+        :returns: The hash
+        """
+        return hash(self._ip)
 
     def __str__(self):
         """
         Return the string representation of the IP address
         :returns: The string representation
         """
-        def int2ip_rec(i, numbers):
-            if i or numbers > 0:
-                return int2ip_rec(i//256, numbers-1) + [str(i%256)]
-            return []
-        return '.'.join(int2ip_rec(self.ip, 4))
+        if self._str is not None:
+            return self._str
+        ip = self._ip
+        if 0 <= ip < 1 << 32:
+            self._str = f'{ip >> 24}.{ip >> 16 & 255}.{ip >> 8 & 255}.{ip & 255}'
+        elif ip > 0: # Every byte beyond the 4th one adds a number
+            numbers = []
+            while ip:
+                numbers.append(str(ip & 255))
+                ip >>= 8
+            self._str = '.'.join(reversed(numbers))
+        else:
+            raise ValueError(f'Negative IP: {ip}')
+        return self._str
 
     def __repr__(self):
         """
@@ -132,65 +246,69 @@ class IP:
 
     def __xor__(self, other):
         """^"""
-        return self._op(int.__xor__, other)
+        return _from_int(self._ip ^ _int(other))
 
-    def __rxor__(self, other):
-        """^"""
-        return self._rop(int.__xor__, other)
+    __rxor__ = __xor__
 
     def __and__(self, other):
         """&"""
-        return self._op(int.__and__, other)
+        return _from_int(self._ip & _int(other))
 
-    def __rand__(self, other):
-        """&"""
-        return self._rop(int.__and__, other)
+    __rand__ = __and__
 
     def __add__(self, other):
         """+"""
-        return self._op(int.__add__, other)
+        return _from_int(self._ip + _int(other))
 
-    def __radd__(self, other):
-        """+"""
-        return self._rop(int.__add__, other)
+    __radd__ = __add__
 
     def __sub__(self, other):
         """-"""
-        return self._op(int.__sub__, other)
+        return _from_int(self._ip - _int(other))
 
     def __rsub__(self, other):
         """-"""
-        return self._rop(int.__sub__, other)
+        return _from_int(_int(other) - self._ip)
 
     def __lt__(self, other):
         """<"""
-        return self._op(int.__lt__, other)
+        return self._ip < _int(other)
 
     def __le__(self, other):
         """<="""
-        return self._op(int.__le__, other)
+        return self._ip <= _int(other)
 
     def __gt__(self, other):
         """>"""
-        return self._op(int.__gt__, other)
+        return self._ip > _int(other)
 
     def __ge__(self, other):
         """>="""
-        return self._op(int.__ge__, other)
+        return self._ip >= _int(other)
 
     def __eq__(self, other):
-        """=="""
-        return self._op(int.__eq__, other)
+        """==, with IPs and integers only, so that equal objects have equal hashes"""
+        if isinstance(other, str):
+            return NotImplemented
+        try:
+            return self._ip == _int(other)
+        except TypeError:
+            return NotImplemented
 
     def __ne__(self, other):
-        """!="""
-        return self._op(int.__ne__, other)
+        """!=, with IPs and integers only, so that equal objects have equal hashes"""
+        if isinstance(other, str):
+            return NotImplemented
+        try:
+            return self._ip != _int(other)
+        except TypeError:
+            return NotImplemented
 
     def __bool__(self):
         """
         Return if the IP is different from 0.0.0.0
         """
-        return self.ip != 0
+        return self._ip != 0
 
     def extract(self, mask):
         """
@@ -198,5 +316,5 @@ class IP:
         :param mask: The mask
         :returns: The integer result
         """
-        imask = self._int(mask)
-        return int(self&mask) // (imask&-imask)
+        imask = _int(mask)
+        return (self._ip & imask) // (imask & -imask)
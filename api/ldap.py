@@ -1,70 +1,334 @@
 """This module defines the tools used by the API to communicate with the LDAP"""
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from .constants import LEASES_DN
+from .allocator import ALLOCATORS
+from .constants import (LEASES_DN, LEASE_CACHE_SIZE, LEASE_CACHE_TTL, WRITE_BEHIND,
+                        WRITE_BEHIND_INTERVAL, WRITE_BEHIND_BATCH, WRITE_BEHIND_RETRIES,
+                        CLEANUP_PAGE_SIZE,
+                        CLEANUP_WORKERS, HEDGE_READS, HEDGE_PERCENTILE, HEDGE_MIN_DELAY,
+                        HEDGE_WORKERS, BATCH_FILTER_SIZE)
 from .exceptions import LeaseNotFoundException
+from .metrics import inc, timed
+from .tracing import span
 from .roundrobin import RoundRobinLdap
+from .roundrobin.hedging import Hedger
+from .util import LRUCache
+from .writebehind import WriteBehind
+
+
+LEASE_ATTRIBUTES = ['leaseID', 'macAddress', 'ipHostNumber', 'leaseExpiry']
 
 
 class Ldap(RoundRobinLdap):
     """This class extends the Round-Robin LDAP by adding methods useful for the API"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.leases = LRUCache(LEASE_CACHE_SIZE, LEASE_CACHE_TTL, 'leases')
+        self.writer = None
+        self.mirror = None
+        if HEDGE_READS:
+            self.hedger = Hedger(HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_WORKERS)
 
-    def get_lease(self, lid, ip=None):
+    @span('get_lease')
+    @timed('dhcapi_stage_seconds', stage='get_lease')
+    def get_lease(self, lid, ip=None, primary=False):
         """
-        Get a lease from the LDAP server.
+        Get a lease from the LDAP server. The leases of a lease ID are mirrored or cached.
         :param lid: The lease ID
+        :param ip: The optional lease IP address
+        :param primary: Whether to read from the node for writes, bypassing the mirror and the
+                        cache, otherwise the search may be hedged across the nodes for reads
         :returns: A dictionary representing the lease
         """
-        if not self.search(f'(&(objectclass=reselLease)(leaseID={lid}-*))', LEASES_DN,
-                           ['leaseID', 'macAddress', 'ipHostNumber', 'leaseExpiry']):
-            raise LeaseNotFoundException()
+        leases = None
+        if not primary: # The mirror and the cache may be filled from a lagging replica
+            leases = self.mirror.leases(lid) if self.mirror is not None else None
+            if leases is None:
+                leases = self.leases.get(lid)
+        if leases is None:
+            query = f'(&(objectclass=reselLease)(leaseID={lid}-*))'
+            results = (self.search(query, LEASES_DN, LEASE_ATTRIBUTES, True) if primary
+                       else self.hedged_search(query, LEASES_DN, LEASE_ATTRIBUTES))
+            if not results:
+                raise LeaseNotFoundException()
+            leases = [self.to_lease(result) for result in results]
+            self.leases.set(lid, leases)
+        return self.pick_lease(leases, ip)
 
-        results = self.get_results()
+    @span('get_leases')
+    @timed('dhcapi_stage_seconds', stage='get_leases')
+    def get_leases(self, lids, primary=False):
+        """
+        Get the leases of several lease IDs, with a single search for BATCH_FILTER_SIZE lease IDs.
+        The leases of a lease ID are mirrored or cached.
+        :param lids: The lease IDs
+        :param primary: Whether to read from the node for writes, bypassing the mirror and the
+                        cache
+        :returns: The leases of the lease IDs which have some, by lease ID
+        """
+        found, missing = {}, []
+        for lid in dict.fromkeys(lids):
+            leases = None
+            if not primary:
+                leases = self.mirror.leases(lid) if self.mirror is not None else None
+                if leases is None:
+                    leases = self.leases.get(lid)
+            if leases is None:
+                missing.append(lid)
+            else:
+                found[lid] = leases
+        fetched = {}
+        for i in range(0, len(missing), BATCH_FILTER_SIZE):
+            terms = ''.join(f'(leaseID={lid}-*)' for lid in missing[i:i+BATCH_FILTER_SIZE])
+            for result in self.search(f'(&(objectclass=reselLease)(|{terms}))', LEASES_DN,
+                                      LEASE_ATTRIBUTES, primary):
+                lease = self.to_lease(result)
+                fetched.setdefault(lease['lease_id'].rsplit('-', 1)[0], []).append(lease)
+        for lid in missing:
+            if lid in fetched:
+                self.leases.set(lid, fetched[lid])
+                found[lid] = fetched[lid]
+        return found
+
+    @staticmethod
+    def to_lease(result):
+        """
+        Convert a search result into a lease.
+        :param result: The search result
+        :returns: A dictionary representing the lease
+        """
+        return {'lease_id': result.leaseID.value,
+                'mac_address': result.macAddress.value,
+                'ip_address': result.ipHostNumber.value,
+                'lease_expiry': result.leaseExpiry.value}
 
+    @staticmethod
+    def pick_lease(leases, ip=None):
+        """
+        Pick the lease to use among the leases of a lease ID.
+        :param leases: The leases
+        :param ip: The optional lease IP address
+        :returns: A dictionary representing the lease
+        """
         if ip is not None:
-            results = list(filter(lambda x: x.ipHostNumber.value == ip, results))
-            if len(results) == 0:
+            leases = [lease for lease in leases if lease['ip_address'] == str(ip)]
+            if len(leases) == 0:
                 raise LeaseNotFoundException()
 
         # We only keep the longest lease
-        result = max(results, key=lambda x: x.leaseExpiry.value)
-        return {'lease_id': result.leaseID.value,
-                'mac_address': result.macAddress.value,
-                'ip_address': result.ipHostNumber.value,
-                'lease_expiry': result.leaseExpiry.value
-               }
+        return dict(max(leases, key=lambda x: x['lease_expiry']))
+
+    def do(self, action, *args, write=None, server=None, **kwargs):
+        """
+        Execute an action on the LDAP server, measuring its duration.
+        :param action: The action to perform
+        :param args: The args to pass
+        :param write: Whether to use the node for writes, by default only for modifications
+        :param server: The node to use without failing over, by default the current one
+        :param kwargs: The kwargs to pass
+        :returns: The action result, or the list of entries found for a search
+        """
+        with span(f'ldap.{action}'), timed('dhcapi_ldap_seconds', action=action):
+            return super().do(action, *args, write=write, server=server, **kwargs)
+
+    @span('ldap.failover')
+    def failover(self, server, write=True):
+        """
+        Switch to the next available node, counting the switches.
+        :param server: The node which failed
+        :param write: Whether the node was used for writes or for reads
+        """
+        failing = server is not None and self.ip.current(write) is server
+        try:
+            super().failover(server, write)
+        finally:
+            if failing:
+                inc('dhcapi_ldap_failovers_total', role='write' if write else 'read')
+
+    def hedged(self, won):
+        """
+        Count the searches sent to a second node.
+        :param won: Whether the second node answered first
+        """
+        inc('dhcapi_hedged_searches_total', result='won' if won else 'lost')
+
+    def invalidate(self, dn):
+        """
+        Remove the cached leases of an entry.
+        :param dn: The entry DN
+        """
+        rdn, _, parent = dn.partition(',')
+        if parent == LEASES_DN and rdn.startswith('leaseID='):
+            self.leases.pop(rdn[len('leaseID='):].rsplit('-', 1)[0])
 
+    @timed('dhcapi_stage_seconds', stage='get_used_ips')
     def get_used_ips(self, partial_lid):
         """
-        Get the used IPs pertaining to a same lease prefix.
+        Get the used IPs pertaining to a same lease prefix, from the mirror once it is loaded.
         :param partial_lid: The lease ID prefix
         :returns: A list of used IP addresses
         """
-        self.search(f'(&(objectclass=reselLease)(leaseID={partial_lid}*))', LEASES_DN,
-                    ['ipHostNumber'])
-        return [result.ipHostNumber.value for result in self.get_results()]
+        if self.mirror is not None and self.mirror.ready:
+            return self.mirror.used_ips(partial_lid)
+        return [result.ipHostNumber.value for result in
+                self.search(f'(&(objectclass=reselLease)(leaseID={partial_lid}*))', LEASES_DN,
+                            ['ipHostNumber'])]
+
+    def get_ip_leases(self, partial_lid, ip, server=None):
+        """
+        Get the leases holding an IP with the given lease prefix, from the node for writes.
+        :param partial_lid: The lease ID prefix
+        :param ip: The IP address
+        :param server: The node to read from, by default the current node for writes
+        :returns: A list of lease IDs
+        """
+        return [result.leaseID.value for result in
+                self.search(f'(&(objectclass=reselLease)(leaseID={partial_lid}*)'
+                            f'(ipHostNumber={ip}))', LEASES_DN, ['leaseID'], True, server)]
+
+    def is_ip_used(self, partial_lid, ip):
+        """
+        Check if an IP is used by a lease with the given lease prefix.
+        :param partial_lid: The lease ID prefix
+        :param ip: The IP address
+        :returns: Whether the IP is used
+        """
+        return len(self.get_ip_leases(partial_lid, ip)) > 0
+
+    def get_used_ips_among(self, partial_lid, ips):
+        """
+        Find which of several IPs are used by leases with the given lease prefix, from the node for
+        writes, with a single search for BATCH_FILTER_SIZE IPs.
+        :param partial_lid: The lease ID prefix
+        :param ips: The IP addresses
+        :returns: The set of the used IP addresses
+        """
+        used = set()
+        for i in range(0, len(ips), BATCH_FILTER_SIZE):
+            terms = ''.join(f'(ipHostNumber={ip})' for ip in ips[i:i+BATCH_FILTER_SIZE])
+            used.update(result.ipHostNumber.value for result in
+                        self.search(f'(&(objectclass=reselLease)(leaseID={partial_lid}*)'
+                                    f'(|{terms}))', LEASES_DN, ['ipHostNumber'], True))
+        return used
 
-    def add_lease(self, lid, mac_address, ip_address, lease_expiry):
+    def get_expired_among(self, leases, now):
+        """
+        Find which of several leases are expired on the node for writes, with a single search for
+        BATCH_FILTER_SIZE leases.
+        :param leases: The lease IDs and IPs
+        :param now: The current time
+        :returns: The lease IDs and IPs of the expired leases
+        """
+        expired, expiry = set(), now.strftime('%Y%m%d%H%M%S%z')
+        for i in range(0, len(leases), BATCH_FILTER_SIZE):
+            terms = ''.join(f'(leaseID={lease[0]})' for lease in leases[i:i+BATCH_FILTER_SIZE])
+            expired.update(result.leaseID.value for result in
+                           self.search(f'(&(objectclass=reselLease)(leaseExpiry<={expiry})'
+                                       f'(|{terms}))', LEASES_DN, ['leaseID'], True))
+        return [lease for lease in leases if lease[0] in expired]
+
+    def add_lease(self, lid, mac_address, ip_address, lease_expiry, server=None):
         """
         Add a lease to the LDAP.
         :param lid: The lease ID
         :param mac_address: The machine MAC address
         :param ip_address: The machine IP address
         :param lease_expiry: The lease expiry
+        :param server: The node to write to, by default the current node for writes
         """
         logging.info('[LDAP][add_lease] Adding lease %s for machine %s/%s', lid, mac_address,
                      ip_address)
-        return self.do('add', f'leaseID={lid},{LEASES_DN}', 'reselLease',
-                       {'macAddress': mac_address, 'ipHostNumber': ip_address,
-                        'leaseExpiry': lease_expiry})
+        try:
+            result = self.do('add', f'leaseID={lid},{LEASES_DN}', 'reselLease',
+                             {'macAddress': mac_address, 'ipHostNumber': ip_address,
+                              'leaseExpiry': lease_expiry}, server=server)
+            if self.mirror is not None:
+                self.mirror.added({'lease_id': lid, 'mac_address': mac_address,
+                                   'ip_address': ip_address, 'lease_expiry': lease_expiry})
+            return result
+        finally:
+            self.invalidate(f'leaseID={lid},{LEASES_DN}')
+
+    def update(self, dn, key, value, defer=False):
+        """
+        Update an element in the LDAP server.
+        :param dn: The base DN
+        :param key: The key to alter
+        :param value: The value to set
+        :param defer: Whether the update may be queued if write-behind is enabled
+        """
+        try:
+            if defer and WRITE_BEHIND:
+                self.raise_ro_fast()
+                if self.writer is None:
+                    self.writer = WriteBehind(self, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_BATCH,
+                                              WRITE_BEHIND_RETRIES)
+                self.writer.put(dn, key, value)
+            else:
+                super().update(dn, key, value)
+            if self.mirror is not None:
+                self.mirror.modified(dn, key, value)
+        finally:
+            self.invalidate(dn)
+
+    def delete(self, dn):
+        """
+        Remove an entry from the LDAP server.
+        :param dn: The base DN
+        """
+        try:
+            super().delete(dn)
+            if self.mirror is not None:
+                self.mirror.removed(dn)
+        finally:
+            self.invalidate(dn)
 
     def remove_expired_leases(self):
-        """Remove expired leases"""
+        """
+        Remove expired leases. The leases are listed by the mirror once it is loaded and confirmed
+        to be expired by the node for writes, otherwise fetched page by page from the node for
+        writes, so that the renewals not replicated yet are seen, and the leases of a page are
+        removed in parallel over several connections.
+        :returns: The numbers of found, removed and failed leases
+        """
         logging.info('[LDAP][remove_expired_leases] Removing expired leases')
-        expiry = datetime.now().astimezone().strftime('%Y%m%d%H%M%S%z')
-        self.search(f'(&(objectclass=reselLease)(leaseExpiry<={expiry}))', LEASES_DN)
-        results = self.get_results()
-        for result in results:
-            self.delete(result.entry_dn)
-        logging.info('[LDAP][remove_expired_leases] Removed %s leases', len(results))
+        now = datetime.now().astimezone()
+        counts = {'found': 0, 'removed': 0, 'failed': 0}
+
+        def remove(lease):
+            lease_id, ip = lease
+            dn = f'leaseID={lease_id},{LEASES_DN}'
+            try:
+                self.delete(dn)
+            except Exception as e:
+                logging.warning('[LDAP][remove_expired_leases] Removal of %s failed. Reason:\n'
+                                '                             %s', dn, e)
+                return False
+            ALLOCATORS.release(lease_id, ip)
+            return True
+
+        with ThreadPoolExecutor(CLEANUP_WORKERS) as executor:
+            def remove_page(page):
+                counts['found'] += len(page)
+                for removed in executor.map(remove, page):
+                    counts['removed' if removed else 'failed'] += 1
+                logging.info('[LDAP][remove_expired_leases] Removed %s leases so far',
+                             counts['removed'])
+
+            if self.mirror is not None and self.mirror.ready:
+                expired = self.mirror.expired(now)
+                for i in range(0, len(expired), CLEANUP_PAGE_SIZE):
+                    # The mirror may have missed renewals made by other processes
+                    remove_page(self.get_expired_among(expired[i:i+CLEANUP_PAGE_SIZE], now))
+            else:
+                self.paged_search(f'(&(objectclass=reselLease)'
+                                  f'(leaseExpiry<={now.strftime("%Y%m%d%H%M%S%z")}))', LEASES_DN,
+                                  lambda page: remove_page([(result.leaseID.value,
+                                                             result.ipHostNumber.value)
+                                                            for result in page]),
+                                  ['leaseID', 'ipHostNumber'], CLEANUP_PAGE_SIZE, True)
+        logging.info('[LDAP][remove_expired_leases] Removed %s leases, %s failed',
+                     counts['removed'], counts['failed'])
+        return counts
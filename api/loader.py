@@ -1,102 +1,297 @@
 """This module loads the DHCP configuration and gives functions to process it"""
 
 
+from functools import lru_cache
+from string import Formatter
 import toml
 from .exceptions import FieldUndefinedException, NoRuleMatchedException
-from .ip import Network, IP
-from .constants import CONFIG_FILE
+from .ip import Network, NetworkIndex, IP
+from .metrics import inc, timed
+from .tracing import span
+from .util import LRUCache
+from .constants import CONFIG_FILE, ENV_CACHE_SIZE
 
 
 CONF = toml.load(CONFIG_FILE)
 DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+FORMATTER = Formatter()
 
 
-def parse(value, env):
+class Template:
+    """
+    This class represents a format string split into its static and dynamic parts.
+    :param value: The format string
+    """
+    def __init__(self, value):
+        self.parts = []
+        self.fields = set()
+        for literal, field, spec, conversion in FORMATTER.parse(value):
+            if literal:
+                self.parts.append(literal)
+            if field is not None:
+                self.parts.append((field, spec, conversion))
+                self.fields.add(field.split('.', 1)[0].split('[', 1)[0])
+        self.static = None if self.fields else ''.join(self.parts)
+
+    def render(self, env, reads):
+        """
+        Format the template.
+        :param env: The environment for value substitution
+        :param reads: The set in which the names read from the environment are recorded
+        :returns: The formatted string
+        """
+        if self.static is not None:
+            return self.static
+        reads |= self.fields
+        return ''.join(part if isinstance(part, str) else self._field(env, *part)
+                       for part in self.parts)
+
+    @staticmethod
+    def _field(env, field, spec, conversion):
+        """
+        Format a replacement field.
+        :param env: The environment for value substitution
+        :param field: The field name
+        :param spec: The format specification
+        :param conversion: The conversion to apply
+        :returns: The formatted field
+        """
+        value = FORMATTER.get_field(field, (), env)[0]
+        return FORMATTER.format_field(FORMATTER.convert_field(value, conversion), spec)
+
+
+@lru_cache(maxsize=4096)
+def template(value):
+    """
+    Get the template corresponding to a format string
+    :param value: The format string
+    :returns: The template
+    """
+    return Template(value)
+
+
+def compile_value(value):
+    """
+    Compile a value by visiting its structure recursively and turning its strings into templates
+    :param value: The value to compile
+    :returns: The compiled value
+    """
+    if isinstance(value, str):
+        return template(value)
+    if isinstance(value, list):
+        return [compile_value(x) for x in value]
+    if isinstance(value, dict):
+        return {k: compile_value(v) for k, v in value.items()}
+    return value
+
+
+def parse(value, env, reads):
     """
     Smart parse a value by visiting its structure recursively and formatting its strings
-    :param value: The value to parse
+    :param value: The value to parse, which may already be compiled
     :param env: The environment for value substitution in strings
+    :param reads: The set in which the names read from the environment are recorded
     :returns: The parsed value
     """
     if isinstance(value, str):
-        return value.format(**env)
+        value = template(value)
+    if isinstance(value, Template):
+        return value.render(env, reads)
     if isinstance(value, list):
-        return [parse(x, env) for x in value]
+        return [parse(x, env, reads) for x in value]
     if isinstance(value, dict):
-        return {k: parse(v, env) for k, v in value.items()}
+        return {k: parse(v, env, reads) for k, v in value.items()}
     return value
 
 
-def set_vals(conf, env):
+def mask_extract(ip, mask):
+    """Helper function around IP.extract"""
+    return IP(ip).extract(IP(mask))
+
+
+FUNCTIONS = {'mask_extract': mask_extract}
+
+
+class Evaluation:
     """
-    Define the values from the configuration in the environment
-    :param conf: The configuration to process
-    :parm env: The environment
+    This class holds the environment of a configuration evaluation and keeps track of the values
+    depending on the client MAC address.
+    :param relay_ip: The relay IP address
+    :param mac: The client MAC address
     """
-    for name in [x for x in conf if x[:1].islower()]:
-        value = conf[name]
-        if isinstance(value, dict) and 'call' in value:
-            env[name] = env[value['call']](*(parse(x, env) for x in value['args']))
-            if 'values' in value:
-                values = value['values']
-                for i, v in enumerate(values):
-                    # Here we avoid a common problem with closures
-                    env[v] = (lambda i, name: lambda e: e[name] == i)(i, name)
+    def __init__(self, relay_ip, mac):
+        self.env = {'relay_ip': relay_ip, 'mac': mac, **FUNCTIONS}
+        self.dynamic = {'mac'}
+        self.mac_dependent = False
+
+    def set(self, name, value, reads):
+        """
+        Define a value in the environment.
+        :param name: The value name
+        :param value: The value
+        :param reads: The names the value has been computed from
+        """
+        self.env[name] = value
+        if reads & self.dynamic:
+            self.dynamic.add(name)
         else:
-            env[name] = parse(value, env)
+            self.dynamic.discard(name)
 
 
-def visit_subrules(conf, env):
+class Call:
     """
-    Recursively visit matching subrules of a configuration
-    :param conf: The configuration to process
-    :param env: The environment
+    This class represents a compiled function call of the configuration.
+    :param name: The name of the value defined by the call
+    :param value: The call definition
     """
-    set_vals(conf, env)
-    for subrule in [x for x in conf if isinstance(conf[x], dict) and x[:1].isupper()]:
-        if env[subrule](env):
-            visit_subrules(conf[subrule], env)
-            return
+    def __init__(self, name, value):
+        self.name = name
+        self.function = value['call']
+        self.bound = FUNCTIONS.get(self.function)
+        self.args = [compile_value(x) for x in value['args']]
+        # Here we avoid a common problem with closures
+        self.predicates = [(v, (lambda i: lambda e: e[name] == i)(i))
+                           for i, v in enumerate(value.get('values', []))]
 
+    def apply(self, evaluation):
+        """
+        Call the function and define the resulting values in the environment.
+        :param evaluation: The current evaluation
+        """
+        env = evaluation.env
+        reads = {self.function}
+        function = self.bound if self.bound is not None else env[self.function]
+        evaluation.set(self.name, function(*(parse(x, env, reads) for x in self.args)), reads)
+        for v, predicate in self.predicates:
+            evaluation.set(v, predicate, {self.name})
 
-def mask_extract(ip, mask):
-    """Helper function around IP.extract"""
-    return IP(ip).extract(IP(mask))
 
+class Rule:
+    """
+    This class represents a compiled configuration section.
+    :param conf: The configuration section
+    """
+    def __init__(self, conf):
+        self.values = []
+        for name in [x for x in conf if x[:1].islower()]:
+            value = conf[name]
+            if isinstance(value, dict) and 'call' in value:
+                self.values.append((name, Call(name, value)))
+            else:
+                self.values.append((name, compile_value(value)))
+        self.subrules = [(x, Rule(conf[x])) for x in conf
+                         if isinstance(conf[x], dict) and x[:1].isupper()]
+
+    def set_vals(self, evaluation):
+        """
+        Define the values of the section in the environment
+        :param evaluation: The current evaluation
+        """
+        for name, value in self.values:
+            if isinstance(value, Call):
+                value.apply(evaluation)
+            else:
+                reads = set()
+                evaluation.set(name, parse(value, evaluation.env, reads), reads)
 
+    def visit(self, evaluation):
+        """
+        Recursively visit the matching subrules of the section
+        :param evaluation: The current evaluation
+        """
+        self.set_vals(evaluation)
+        for name, subrule in self.subrules:
+            if name in evaluation.dynamic:
+                evaluation.mac_dependent = True
+            if evaluation.env[name](evaluation.env):
+                subrule.visit(evaluation)
+                return
+
+
+class Config:
+    """
+    This class represents the compiled DHCP configuration.
+    :param conf: The parsed configuration
+    """
+    def __init__(self, conf):
+        self.root = Rule(conf)
+        self.sections = [(Network(conf[name]['match']), rule) for name, rule in self.root.subrules]
+        self.index = NetworkIndex(network for network, _ in self.sections)
+
+    def resolve(self, relay_ip, mac):
+        """
+        Get the environment matching the configuration
+        :param relay_ip: The relay IP address
+        :param mac: The client MAC address
+        :returns: The environment and whether it depends on the MAC address
+        """
+        evaluation = Evaluation(relay_ip, mac)
+        env = evaluation.env
+        self.root.set_vals(evaluation)
+        relay_ip = IP(relay_ip)
+        i = self.index.find(relay_ip)
+        if i is None:
+            raise NoRuleMatchedException(env)
+        network, rule = self.sections[i]
+        rule.visit(evaluation)
+        if any(k not in env for k in ['lease_duration', 'first', 'last']):
+            raise FieldUndefinedException(env)
+        filtered_env = {}
+        for k, v in env.items():
+            if k[:1].islower():
+                reads = {k}
+                filtered_env[k] = parse(v, env, reads)
+                if k != 'mac' and reads & evaluation.dynamic:
+                    evaluation.mac_dependent = True
+        first = filtered_env['first']
+        last = filtered_env['last']
+        base = network.base_ip(relay_ip)
+        filtered_env['first'] = base + first if first[:1] == '+' else IP(first)
+        filtered_env['last'] = base + last if last[:1] == '+' else IP(last)
+        filtered_env['mask'] = filtered_env.get('mask', network.contiguous_mask)
+        if 'router_ip' in filtered_env:
+            router_ip = filtered_env['router_ip']
+            filtered_env['router_ip'] = (base + router_ip if router_ip[:1] == '+'
+                                                          else IP(router_ip))
+        else:
+            filtered_env['router_ip'] = relay_ip
+        if 'lease_prefix' not in filtered_env:
+            filtered_env['lease_prefix'] = ''
+        duration = filtered_env['lease_duration']
+        if isinstance(duration, str):
+            filtered_env['lease_duration'] = int(duration[:-1]) * DURATIONS[duration[-1]]
+        return filtered_env, evaluation.mac_dependent
+
+
+RULES = Config(CONF)
+ENV_CACHE = LRUCache(ENV_CACHE_SIZE, name='envs')
+# The environments of the relay IP addresses no rule matches, which only depends on the relay IP
+UNMATCHED = LRUCache(ENV_CACHE_SIZE, name='unmatched')
+
+
+@span('get_env')
+@timed('dhcapi_stage_seconds', stage='get_env')
 def get_env(relay_ip, mac):
     """
-    Get the environment matching the configuration
+    Get the environment matching the configuration. Environments which do not depend on the client
+    MAC address are cached by relay IP address, and so are the relay IP addresses no rule matches.
     :param relay_ip: The relay IP address
     :param mac: The client MAC address
     :returns: The environment
     """
-    env = {'relay_ip': relay_ip, 'mac': mac, 'mask_extract': mask_extract}
-    set_vals(CONF, env)
-    for conf in [conf for k, conf in CONF.items() if isinstance(conf, dict) and k[:1].isupper()]:
-        network = Network(conf['match'])
-        if relay_ip in network:
-            visit_subrules(conf, env)
-            if any(k not in env for k in ['lease_duration', 'first', 'last']):
-                raise FieldUndefinedException(env)
-            filtered_env = parse({k: v for k, v in env.items() if k[:1].islower()}, env)
-            first = filtered_env['first']
-            last = filtered_env['last']
-            relay_ip = IP(relay_ip)
-            base = network.base_ip(relay_ip)
-            filtered_env['first'] = base + first if first[:1] == '+' else IP(first)
-            filtered_env['last'] = base + last if last[:1] == '+' else IP(last)
-            filtered_env['mask'] = filtered_env.get('mask', network.contiguous_mask)
-            if 'router_ip' in filtered_env:
-                router_ip = filtered_env['router_ip']
-                filtered_env['router_ip'] = (base + router_ip if router_ip[:1] == '+'
-                                                              else IP(router_ip))
-            else:
-                filtered_env['router_ip'] = relay_ip
-            if 'lease_prefix' not in filtered_env:
-                filtered_env['lease_prefix'] = ''
-            duration = filtered_env['lease_duration']
-            if isinstance(duration, str):
-                filtered_env['lease_duration'] = int(duration[:-1]) * DURATIONS[duration[-1]]
-            return filtered_env
-    raise NoRuleMatchedException(env)
+    key = int(IP(relay_ip))
+    env = ENV_CACHE.get(key)
+    if env is None:
+        unmatched = UNMATCHED.get(key)
+        if unmatched is not None:
+            inc('dhcapi_negative_hits_total', message='UNADDRESSABLE')
+            raise NoRuleMatchedException({**unmatched, 'relay_ip': relay_ip, 'mac': mac})
+        try:
+            env, mac_dependent = RULES.resolve(relay_ip, mac)
+        except NoRuleMatchedException as e:
+            UNMATCHED.set(key, e.args[0])
+            raise
+        if mac_dependent:
+            return env
+        ENV_CACHE.set(key, env)
+    return {**env, 'relay_ip': relay_ip, 'mac': mac}
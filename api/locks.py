@@ -0,0 +1,58 @@
+"""This module provides the locks serializing the lease creations of a same pool"""
+
+from multiprocessing import Lock
+from time import perf_counter
+from zlib import crc32
+from .exceptions import DeadlineExceededException
+from .metrics import inc, observe
+from .roundrobin import remaining
+
+
+class Stripe:
+    """
+    This class represents one of the locks of a striped lock, counting its contentions.
+    :param index: The index of the lock among the locks of the striped lock
+    """
+    def __init__(self, index):
+        self.index = index
+        self.lock = Lock()
+
+    def __enter__(self):
+        """
+        Acquire the lock, measuring the time spent waiting for it if it is already held, and
+        waiting no longer than the current request has time left
+        """
+        wait_time = 0.
+        if not self.lock.acquire(False):
+            start = perf_counter()
+            acquired = self.lock.acquire(timeout=remaining())
+            wait_time = perf_counter() - start
+            inc('dhcapi_lock_contentions_total', stripe=self.index)
+            if not acquired:
+                observe('dhcapi_stage_seconds', wait_time, stage='lock_wait')
+                raise DeadlineExceededException()
+        observe('dhcapi_stage_seconds', wait_time, stage='lock_wait')
+        inc('dhcapi_lock_acquisitions_total', stripe=self.index)
+        return self
+
+    def __exit__(self, *args):
+        """Release the lock"""
+        self.lock.release()
+
+
+class StripedLock:
+    """
+    This class implements a fixed set of locks indexed by key, so that unrelated keys rarely share
+    the same lock. Keys are hashed with CRC32 so that forked workers agree on the stripes.
+    :param stripes: The number of locks
+    """
+    def __init__(self, stripes):
+        self.stripes = [Stripe(i) for i in range(stripes)]
+
+    def __getitem__(self, key):
+        """
+        Get the lock of a key.
+        :param key: The key
+        :returns: The lock
+        """
+        return self.stripes[crc32(key.encode()) % len(self.stripes)]
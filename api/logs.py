@@ -0,0 +1,201 @@
+"""This module provides the buffered logging of the API, written to disk by background threads"""
+
+import atexit
+import logging
+import os
+from queue import Queue, Empty, Full
+from random import random
+from threading import Thread, Lock
+from time import monotonic
+from .metrics import inc
+from .constants import (LOG_QUEUE_SIZE, LOG_FLUSH_SIZE, LOG_FLUSH_INTERVAL, LOG_MAX_BYTES,
+                        LOG_BACKUPS, LOG_SAMPLING)
+
+
+class LogWriter:
+    """
+    This class appends lines to a file from a background thread. Lines are queued without blocking,
+    and written in batches once enough of them are pending or after an interval. The file is
+    rotated once it grows too large.
+    :param path: The file path
+    :param flush_size: The number of pending bytes triggering a write
+    :param flush_interval: The maximum number of seconds a line waits before being written
+    :param max_bytes: The file size after which it is rotated, or 0 to never rotate it
+    :param backups: The number of rotated files kept
+    :param queue_size: The maximum number of pending lines, after which lines are dropped
+    """
+    def __init__(self, path, flush_size, flush_interval, max_bytes, backups, queue_size):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = Queue(queue_size)
+        self.formatter = None
+        self.file = None
+        self.name = os.path.basename(path)
+        self.written = 0
+        self.pid = os.getpid()
+        self.thread = Thread(target=self.run, name=f'log-{self.name}', daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        """
+        Queue a line, raw bytes, or a log record which is formatted by the background thread.
+        :param line: The line, the bytes or the log record
+        """
+        try:
+            self.queue.put_nowait(line)
+        except Full:
+            inc('dhcapi_log_dropped_total', file=self.name)
+
+    def close(self, timeout=5):
+        """
+        Write the pending lines and stop the background thread.
+        :param timeout: The maximum number of seconds to wait for the pending lines to be written
+        """
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Full:
+            return
+        self.thread.join(timeout)
+
+    def run(self):
+        """Write the pending lines until closed"""
+        batch, size = [], 0
+        deadline = monotonic() + self.flush_interval
+        while True:
+            try:
+                line = self.queue.get(timeout=max(0, deadline - monotonic()))
+                if line is None: # Closed
+                    if batch:
+                        self.flush(b''.join(batch))
+                    return
+                if isinstance(line, logging.LogRecord):
+                    line = self.formatter.format(line) + '\n'
+                if isinstance(line, str):
+                    line = line.encode()
+                batch.append(line)
+                size += len(line)
+            except Empty:
+                pass
+            except Exception: # A record which cannot be formatted must not stop the thread
+                continue
+            if size >= self.flush_size or monotonic() >= deadline:
+                if batch:
+                    self.flush(b''.join(batch))
+                batch, size = [], 0
+                deadline = monotonic() + self.flush_interval
+
+    def flush(self, data):
+        """
+        Append data to the file in a single write, so that the lines of several processes
+        appending to the same file do not interleave.
+        :param data: The data
+        """
+        try:
+            if self.file is None:
+                self.file = open(self.path, 'ab', buffering=0)
+            self.file.write(data)
+            self.written += len(data)
+            if self.max_bytes and self.file.tell() >= self.max_bytes:
+                self.rotate()
+        except OSError:
+            self.file = None
+
+    def rotate(self):
+        """Rename the file and its backups, unless another process already did it, and reopen it"""
+        try:
+            rotated = os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except OSError:
+            rotated = True
+        self.file.close()
+        self.file = None
+        if rotated:
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+
+WRITERS = {}
+WRITERS_LOCK = Lock()
+
+
+def writer(path):
+    """
+    Get the writer of a file, starting it if needed. Threads do not survive forks, so every
+    process gets its own writer.
+    :param path: The file path
+    :returns: The writer
+    """
+    log_writer = WRITERS.get(path)
+    if log_writer is None or log_writer.pid != os.getpid():
+        with WRITERS_LOCK:
+            log_writer = WRITERS.get(path)
+            if log_writer is None or log_writer.pid != os.getpid():
+                log_writer = WRITERS[path] = LogWriter(path, LOG_FLUSH_SIZE, LOG_FLUSH_INTERVAL,
+                                                       LOG_MAX_BYTES, LOG_BACKUPS, LOG_QUEUE_SIZE)
+    return log_writer
+
+
+def close_writers():
+    """Write the pending lines of the writers of the process, which is exiting"""
+    for log_writer in list(WRITERS.values()):
+        log_writer.close()
+
+
+atexit.register(close_writers)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    This class keeps a fraction of the log records of each level.
+    :param rates: The fraction of records kept by level name, the other levels being kept entirely
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {logging.getLevelName(level): rate for level, rate in rates.items()}
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1)
+        return rate >= 1 or random() < rate
+
+
+class WriterHandler(logging.Handler):
+    """
+    This class hands the log records over to a writer, which formats them in the background.
+    :param path: The log file path
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def emit(self, record):
+        log_writer = writer(self.path)
+        log_writer.formatter = self.formatter
+        log_writer.write(record)
+
+
+def setup(path, level, fmt, filters=()):
+    """
+    Send the records of the root logger to a file, through a writer.
+    :param path: The log file path
+    :param level: The log level
+    :param fmt: The log format
+    :param filters: The additional filters of the records, which may add them attributes
+    """
+    handler = WriterHandler(path)
+    handler.setFormatter(logging.Formatter(fmt))
+    handler.addFilter(SamplingFilter(LOG_SAMPLING))
+    for log_filter in filters:
+        handler.addFilter(log_filter)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
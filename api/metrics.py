@@ -0,0 +1,207 @@
+"""
+This module provides the metrics of the API: counters and latency histograms. Every worker dumps
+its metrics to a file of a shared directory, and the metrics of the running workers are summed up
+when they are exposed, in the Prometheus text format.
+"""
+
+import atexit
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from glob import glob
+from threading import Thread, Lock, Event
+from time import perf_counter
+from .constants import METRICS_DIR, METRICS_INTERVAL
+
+
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+def is_running(pid):
+    """
+    Check if a process is running.
+    :param pid: The process ID
+    :returns: Whether the process is running
+    """
+    try:
+        os.kill(int(pid), 0)
+    except PermissionError: # Running as another user
+        return True
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+class Metrics:
+    """
+    This class holds the metrics of a worker and dumps them periodically from a background thread.
+    :param directory: The directory the workers dump their metrics to
+    :param interval: The number of seconds between two dumps
+    """
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.lock = Lock()
+        self.pid = None
+        self.stopped = Event()
+
+    def _check_pid(self):
+        """Start over in a new worker, as threads and files must not be shared with its parent"""
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.counters.clear()
+                    self.histograms.clear()
+                    self.pid = os.getpid()
+                    Thread(target=self.run, name='metrics', daemon=True).start()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increment a counter.
+        :param name: The counter name
+        :param value: The increment
+        :param labels: The counter labels
+        """
+        self._check_pid()
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in a histogram.
+        :param name: The histogram name
+        :param value: The value
+        :param labels: The histogram labels
+        """
+        self._check_pid()
+        key = (name, tuple(sorted(labels.items())))
+        i = next((i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0., 0]
+            histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """
+        Record the duration of a block, or of the calls of a function when used as a decorator.
+        :param name: The histogram name
+        :param labels: The histogram labels
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def dump(self):
+        """Write the metrics of the worker to its file"""
+        with self.lock:
+            data = {'counters': [[name, dict(labels), value]
+                                 for (name, labels), value in self.counters.items()],
+                    'histograms': [[name, dict(labels), list(counts), total, count]
+                                   for (name, labels), (counts, total, count)
+                                   in self.histograms.items()]}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(f'{path}.tmp', path)
+
+    def run(self):
+        """Dump the metrics periodically"""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.dump()
+            except OSError:
+                pass
+
+    def close(self):
+        """Stop dumping the metrics of the worker, which is exiting, and remove its file"""
+        if self.pid != os.getpid():
+            return
+        self.stopped.set()
+        try:
+            os.remove(os.path.join(self.directory, f'{os.getpid()}.json'))
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove the files of the workers of a previous run"""
+        for path in glob(os.path.join(self.directory, '*.json*')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def collect(self):
+        """
+        Sum up the metrics of the running workers, the files of the workers which were killed
+        without removing them being skipped.
+        :returns: The counters and the histograms by name and labels
+        """
+        self.dump()
+        counters = defaultdict(float)
+        histograms = {}
+        for path in glob(os.path.join(self.directory, '*.json')):
+            if not is_running(os.path.basename(path)[:-len('.json')]):
+                continue
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in data['counters']:
+                counters[(name, tuple(sorted(labels.items())))] += value
+            for name, labels, counts, total, count in data['histograms']:
+                key = (name, tuple(sorted(labels.items())))
+                histogram = histograms.setdefault(key, [[0] * (len(BUCKETS) + 1), 0., 0])
+                histogram[0] = [x + y for x, y in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+        return counters, histograms
+
+    def render(self):
+        """
+        Expose the metrics of all the workers in the Prometheus text format.
+        :returns: The metrics text
+        """
+        def number(value):
+            return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+        def labels_text(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+        counters, histograms = self.collect()
+        lines, typed = [], set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{labels_text(labels)} {number(value)}')
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ['+Inf'], counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{labels_text(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{labels_text(labels)} {number(total)}')
+            lines.append(f'{name}_count{labels_text(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics(METRICS_DIR, METRICS_INTERVAL)
+atexit.register(METRICS.close)
+inc = METRICS.inc
+observe = METRICS.observe
+timed = METRICS.timed
@@ -0,0 +1,294 @@
+"""
+This module provides the lease mirror: all the leases of the LDAP, loaded in memory and indexed, so
+that lease lookups do not reach the LDAP. The mirror is kept up to date by polling the changes since
+the last modification seen, and by the writes of the process. Deletions made by other processes
+cannot be polled, so the mirror is also reloaded periodically, and the expired leases, which the
+other processes may have removed, are looked up in the LDAP.
+"""
+
+import logging
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta, timezone
+from threading import Thread, Event, RLock
+from time import monotonic
+from .constants import LEASES_DN
+from .metrics import inc
+
+
+ATTRIBUTES = ['leaseID', 'macAddress', 'ipHostNumber', 'leaseExpiry', 'modifyTimestamp']
+
+
+def lease_id_of(dn):
+    """
+    Get the lease ID of a lease DN.
+    :param dn: The DN
+    :returns: The lease ID, or None if the DN is not the DN of a lease
+    """
+    rdn, _, parent = dn.partition(',')
+    if parent == LEASES_DN and rdn.startswith('leaseID='):
+        return rdn[len('leaseID='):]
+    return None
+
+
+class Index:
+    """
+    This class indexes leases by lease ID, by lease ID without its random suffix, by lease ID order
+    for the lookups by prefix, and by expiry.
+    """
+    def __init__(self):
+        self.leases = {}
+        self.by_lid = {}
+        self.ids = []
+        self.expiries = []
+
+    @classmethod
+    def of(cls, leases):
+        """
+        Index leases at once.
+        :param leases: The leases
+        :returns: The index
+        """
+        index = cls()
+        for lease in leases:
+            index.leases[lease['lease_id']] = lease
+        for lease_id, lease in index.leases.items():
+            index.by_lid.setdefault(lease_id.rsplit('-', 1)[0], {})[lease_id] = lease
+        index.ids = sorted(index.leases)
+        index.expiries = sorted((lease['lease_expiry'], lease_id)
+                                for lease_id, lease in index.leases.items())
+        return index
+
+    def put(self, lease):
+        """
+        Add or replace a lease.
+        :param lease: The lease
+        """
+        lease_id = lease['lease_id']
+        self.remove(lease_id)
+        self.leases[lease_id] = lease
+        self.by_lid.setdefault(lease_id.rsplit('-', 1)[0], {})[lease_id] = lease
+        insort(self.ids, lease_id)
+        insort(self.expiries, (lease['lease_expiry'], lease_id))
+
+    def remove(self, lease_id):
+        """
+        Remove a lease.
+        :param lease_id: The lease ID
+        :returns: The lease, or None if it was not indexed
+        """
+        lease = self.leases.pop(lease_id, None)
+        if lease is None:
+            return None
+        lid = lease_id.rsplit('-', 1)[0]
+        del self.by_lid[lid][lease_id]
+        if not self.by_lid[lid]:
+            del self.by_lid[lid]
+        del self.ids[bisect_left(self.ids, lease_id)]
+        del self.expiries[bisect_left(self.expiries, (lease['lease_expiry'], lease_id))]
+        return lease
+
+
+class LeaseMirror(Thread):
+    """
+    This class mirrors the leases of the LDAP in memory, and synchronizes them from a background
+    thread.
+    :param ldap: The ldap to connect to
+    :param interval: The number of seconds between two polls of the changes
+    :param resync: The number of seconds between two full reloads
+    :param overlap: The number of seconds of changes polled again, covering the replication lag
+    :param page_size: The number of leases fetched at once by a full reload
+    """
+    def __init__(self, ldap, interval, resync, overlap, page_size):
+        super().__init__(name='lease-mirror', daemon=True)
+        self.ldap = ldap
+        self.interval = interval
+        self.resync = resync
+        self.overlap = overlap
+        self.page_size = page_size
+        self.index = Index()
+        self.lock = RLock()
+        self.ready = False
+        self.loaded_at = None
+        self.high_water = None
+        self.journal = None
+        self.stopped = Event()
+
+    def run(self):
+        """Load the leases, then poll their changes and reload them periodically until stopped"""
+        while not self.stopped.is_set():
+            try:
+                if self.loaded_at is None or monotonic() - self.loaded_at > self.resync:
+                    self.load()
+                else:
+                    self.poll()
+            except Exception as e: # The mirror is only as old as its last synchronization
+                logging.error('[MIRROR][run] Synchronization failed. Reason:\n'
+                              '              %s', e)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop synchronizing the leases"""
+        self.stopped.set()
+
+    def load(self):
+        """Load all the leases into a new index, which replaces the current one"""
+        start = monotonic()
+        leases, high_water = [], None
+        with self.lock:
+            self.journal = []
+
+        def add_page(page):
+            nonlocal high_water
+            for result in page:
+                leases.append(self.ldap.to_lease(result))
+                modified = getattr(result, 'modifyTimestamp', None)
+                if modified is not None and modified.value is not None:
+                    high_water = max(high_water or modified.value, modified.value)
+
+        try:
+            self.ldap.paged_search('(objectclass=reselLease)', LEASES_DN, add_page, ATTRIBUTES,
+                                   self.page_size)
+            index = Index.of(leases)
+            with self.lock:
+                for method, args in self.journal: # The writes made during the load
+                    getattr(index, method)(*args)
+                self.index = index
+                self.high_water = high_water or self.high_water
+                self.loaded_at = monotonic()
+                self.ready = True
+        finally:
+            with self.lock:
+                self.journal = None
+        logging.info('[MIRROR][load] Loaded %s leases in %.2fs', len(index.leases),
+                     monotonic() - start)
+
+    def poll(self):
+        """Apply the changes made since the last modification seen"""
+        if self.high_water is None:
+            return
+        since = ((self.high_water - timedelta(seconds=self.overlap)).astimezone(timezone.utc)
+                 .strftime('%Y%m%d%H%M%SZ'))
+        results = self.ldap.search(f'(&(objectclass=reselLease)(|(modifyTimestamp>={since})'
+                                   f'(createTimestamp>={since})))', LEASES_DN, ATTRIBUTES)
+        with self.lock:
+            for result in results:
+                self.index.put(self.ldap.to_lease(result))
+                modified = getattr(result, 'modifyTimestamp', None)
+                if modified is not None and modified.value is not None:
+                    self.high_water = max(self.high_water, modified.value)
+            self.ready = True # A restored mirror is used once caught up
+        inc('dhcapi_mirror_polled_total', len(results))
+
+    def dump(self):
+        """
+        Get the state of the mirror, to be restored by another process.
+        :returns: The leases, the last modification seen and the age of the last full load, or
+                  None if the mirror is not loaded
+        """
+        with self.lock:
+            if not self.ready:
+                return None
+            return (list(self.index.leases.values()), self.high_water,
+                    monotonic() - self.loaded_at)
+
+    def restore(self, leases, high_water, age):
+        """
+        Restore the state of a mirror. The restored leases are only used once the changes since
+        the last modification seen are polled, and they are fully reloaded instead when the
+        restored load is too old.
+        :param leases: The leases
+        :param high_water: The last modification seen
+        :param age: The age of the last full load
+        :returns: Whether the state was restored
+        """
+        if high_water is None: # Nothing could be polled
+            return False
+        index = Index.of(leases)
+        with self.lock:
+            if self.ready: # Loaded in the meantime
+                return False
+            self.index = index
+            self.high_water = high_water
+            self.loaded_at = monotonic() - age
+        return True
+
+    def apply(self, method, *args):
+        """
+        Apply a change to the index, and to the index being loaded if any.
+        :param method: The index method
+        :param args: The method arguments
+        """
+        with self.lock:
+            getattr(self.index, method)(*args)
+            if self.journal is not None:
+                self.journal.append((method, args))
+
+    def added(self, lease):
+        """
+        Mirror a lease added by the process.
+        :param lease: The lease
+        """
+        self.apply('put', lease)
+
+    def modified(self, dn, key, value):
+        """
+        Mirror a modification made by the process.
+        :param dn: The entry DN
+        :param key: The modified attribute
+        :param value: The new value
+        """
+        lease_id = lease_id_of(dn)
+        attribute = {'leaseExpiry': 'lease_expiry', 'ipHostNumber': 'ip_address',
+                     'macAddress': 'mac_address'}.get(key)
+        with self.lock:
+            lease = self.index.leases.get(lease_id)
+            if lease is not None and attribute is not None:
+                self.apply('put', {**lease, attribute: value})
+
+    def removed(self, dn):
+        """
+        Mirror a removal made by the process.
+        :param dn: The entry DN
+        """
+        lease_id = lease_id_of(dn)
+        if lease_id is not None:
+            self.apply('remove', lease_id)
+
+    def leases(self, lid):
+        """
+        Get the unexpired leases of a lease ID.
+        :param lid: The lease ID, without its random suffix
+        :returns: The leases, or None if there are none or the mirror is not loaded yet
+        """
+        if not self.ready:
+            return None
+        now = datetime.now().astimezone()
+        with self.lock:
+            leases = self.index.by_lid.get(lid) or {}
+            leases = [lease for lease in leases.values() if lease['lease_expiry'] > now] or None
+        inc('dhcapi_mirror_lookups_total', result='miss' if leases is None else 'hit')
+        return leases
+
+    def used_ips(self, partial_lid):
+        """
+        Get the used IPs pertaining to a same lease prefix.
+        :param partial_lid: The lease ID prefix
+        :returns: A list of used IP addresses
+        """
+        with self.lock:
+            ids = self.index.ids
+            start = bisect_left(ids, partial_lid)
+            end = bisect_left(ids, partial_lid + '\U0010ffff', start)
+            return [self.index.leases[lease_id]['ip_address'] for lease_id in ids[start:end]]
+
+    def expired(self, now):
+        """
+        Get the expired leases.
+        :param now: The current time
+        :returns: The lease IDs and IPs of the leases expired at the given time
+        """
+        with self.lock:
+            expiries = self.index.expiries
+            end = bisect_right(expiries, (now, '\U0010ffff'))
+            return [(lease_id, self.index.leases[lease_id]['ip_address'])
+                    for _, lease_id in expiries[:end]]
@@ -5,11 +5,24 @@ import os
 import struct
 from abc import abstractmethod
 from datetime import datetime, timedelta
-from .constants import LEASES_DN, SERVER_IP, DEVICES_DN
-from .exceptions import NoFreeIPException
+from .allocator import ALLOCATORS
+from time import sleep
+from .constants import (LEASES_DN, SERVER_IP, DEVICES_DN, ALLOCATION_RETRIES, ALLOCATION_RECHECKS,
+                        ALLOCATION_RECHECK_DELAY, RENEWAL_FRACTION, HOSTNAME_CACHE_SIZE,
+                        READ_YOUR_WRITES, NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL)
+from .exceptions import AllocationConflictException
 from .messages import Message
-from .ip import IP
-from .util import first_available
+from .metrics import timed
+from .roundrobin import bound
+from .tracing import span
+from .util import LRUCache, NegativeCache
+
+
+# The hostnames last written by this process, by MAC address
+HOSTNAMES = LRUCache(HOSTNAME_CACHE_SIZE, name='hostnames')
+# The environments of the requests answered with no lease once confirmed by the node for writes, by
+# (relay IP, MAC address, requested IP), invalidated by MAC address
+NO_LEASES = NegativeCache(NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL, 'no_leases')
 
 
 class Lease:
@@ -29,18 +42,19 @@ class Lease:
         self.lease_expiry = lease_expiry
 
     @classmethod
-    def from_ldap(cls, ldap, lease_id, ip=None):
+    def from_ldap(cls, ldap, lease_id, ip=None, primary=False):
         """
         Fetch a DHCP lease from the LDAP.
         :param ldap: The ldap to connect to
         :param lease_id: The beginning of the lease ID
         :param ip: The optional lease IP address
+        :param primary: Whether to read from the node for writes
         """
-        lease_data = ldap.get_lease(lease_id, ip)
+        lease_data = ldap.get_lease(lease_id, ip, primary)
         return cls(ldap, **lease_data)
 
     @classmethod
-    def create(cls, ldap, first, last, mac, lease_prefix):
+    def create(cls, ldap, first, last, mac, lease_prefix, verify=False):
         """
         Create a DHCP lease.
         :param ldap: The ldap to connect to
@@ -48,33 +62,101 @@ class Lease:
         :param last: The last addressable IP
         :param mac: The MAC address
         :param lease_prefix: The lease prefix
+        :param verify: Whether to check that no other lease got the same IP after adding the lease,
+                       which is needed when the creation is not serialized. The lease is then added
+                       and checked on the master, so that the concurrent leases of all the workers
+                       are written to and read from the same node
         """
-        int_ips = sorted(set(int(IP(ip)) for ip in ldap.get_used_ips(f'{lease_prefix}')))
-        ip = IP(first_available(int_ips, int(first)))
-        if ip > last:
-            raise NoFreeIPException
+        allocator = ALLOCATORS.get(lease_prefix, first, last)
+        lid = f'{lease_prefix}{mac}'
+        for _ in range(ALLOCATION_RETRIES if verify else 1):
+            with span('allocate'), timed('dhcapi_stage_seconds', stage='allocate'):
+                ip = allocator.allocate(ldap)
+
+            try:
+                server = ldap.master() if verify else None
+                lease_id = cls.add(ldap, lid, mac, ip, server).lease_id
+            except:
+                allocator.release(ip)
+                raise
+            if not verify or cls.claim(ldap, lease_prefix, ip, lease_id, server):
+                return cls.from_ldap(ldap, lid, primary=READ_YOUR_WRITES)
+            logging.warning('[LEASE][create] Conflict on %s for lease %s', ip, lease_id)
+        raise AllocationConflictException()
 
+    @staticmethod
+    def claim(ldap, lease_prefix, ip, lease_id, server):
+        """
+        Check that a lease added without serialization is alone to hold its IP, and remove it
+        otherwise. Of two concurrent leases added to the same node, the last one to be added always
+        sees the other one. Of leases seeing each other, the one with the smallest lease ID checks
+        again while the others are removed, so that they do not all move to the next IP at once.
+        :param ldap: The ldap to connect to
+        :param lease_prefix: The lease prefix
+        :param ip: The IP address
+        :param lease_id: The lease ID
+        :param server: The node the lease was added to
+        :returns: Whether the lease keeps the IP
+        """
+        for i in range(ALLOCATION_RECHECKS + 1):
+            holders = ldap.get_ip_leases(lease_prefix, str(ip), server)
+            if holders == [lease_id]:
+                return True
+            if i == ALLOCATION_RECHECKS or lease_id != min(holders + [lease_id]):
+                break
+            sleep(bound(ALLOCATION_RECHECK_DELAY * 2 ** i))
+        ldap.delete(f'leaseID={lease_id},{LEASES_DN}')
+        return False
+
+    @classmethod
+    def add(cls, ldap, lid, mac, ip, server=None):
+        """
+        Add a DHCP lease for an allocated IP to the LDAP.
+        :param ldap: The ldap to connect to
+        :param lid: The lease ID, which is given a random suffix
+        :param mac: The MAC address
+        :param ip: The IP address
+        :param server: The node to write to, by default the current node for writes
+        :returns: The lease
+        """
         seed = struct.unpack('I', os.urandom(4))[0]
 
         # We leave 5 minutes for the client to accept the lease
-        lid = f'{lease_prefix}{mac}'
-        ldap.add_lease(f'{lid}-{seed}', mac, str(ip),
-                       datetime.now().astimezone() + timedelta(seconds=300))
-        return cls.from_ldap(ldap, lid)
-
+        lease_id = f'{lid}-{seed}'
+        lease_expiry = datetime.now().astimezone() + timedelta(seconds=300)
+        ldap.add_lease(lease_id, mac, str(ip), lease_expiry, server)
+        NO_LEASES.invalidate(mac)
+        return cls(ldap, lease_id, mac, str(ip), lease_expiry)
+
+    @span('update')
+    @timed('dhcapi_stage_seconds', stage='update')
     def update(self, duration, hostname):
         """
-        Update the lease expiry
+        Update the lease expiry, unless enough of the lease is left, and the device hostname, unless
+        it has not changed.
         :param duration: The lease duration
         :param hostname: The device hostname
+        :returns: The lease duration to give to the client
         """
         if self.ldap.can_write:
-            self.ldap.update(f'leaseID={self.lease_id},{LEASES_DN}', 'leaseExpiry',
-                             datetime.now().astimezone() + timedelta(seconds=duration+300))
-            try:
-                self.ldap.update(f'macAddress={self.mac_address},{DEVICES_DN}', 'host', hostname)
-            except:
-                logging.warning('[REQUESTING][update] Exception ignored. See above.')
+            remaining = (self.lease_expiry - datetime.now().astimezone()).total_seconds() - 300
+            if remaining >= RENEWAL_FRACTION * duration:
+                # The client must not get more than what is left in the LDAP
+                duration = int(min(remaining, duration))
+            else:
+                # The write is deferred only if the stored expiry covers the lease given
+                now = datetime.now().astimezone()
+                self.ldap.update(f'leaseID={self.lease_id},{LEASES_DN}', 'leaseExpiry',
+                                 now + timedelta(seconds=duration+300),
+                                 defer=self.lease_expiry >= now + timedelta(seconds=duration))
+            if HOSTNAMES.get(self.mac_address) != hostname:
+                try:
+                    self.ldap.update(f'macAddress={self.mac_address},{DEVICES_DN}', 'host',
+                                     hostname, defer=True)
+                    HOSTNAMES.set(self.mac_address, hostname)
+                except:
+                    logging.warning('[REQUESTING][update] Exception ignored. See above.')
+        return duration
 
 
 class BaseResult:
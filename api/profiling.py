@@ -0,0 +1,99 @@
+"""
+This module provides the on-demand profiling of a live worker, either with cProfile on a sample of
+its requests, or by sampling the stacks of all its threads.
+"""
+
+import cProfile
+import marshal
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock, get_ident
+from time import monotonic, sleep
+
+
+class Session:
+    """
+    This class represents a profiling session.
+    :param mode: 'cprofile' to profile requests with cProfile, 'sample' to sample the thread stacks
+    """
+    def __init__(self, mode):
+        self.mode = mode
+        self.profile = cProfile.Profile() if mode == 'cprofile' else None
+        self.stacks = Counter()
+        self.lock = Lock()
+
+
+SESSION = None
+SESSION_LOCK = Lock()
+
+
+@contextmanager
+def request():
+    """
+    Profile the current request with cProfile if a session is running and no other request is
+    being profiled, as cProfile can only follow one thread at a time.
+    """
+    session = SESSION
+    if session is None or session.profile is None or not session.lock.acquire(False):
+        yield
+        return
+    try:
+        session.profile.enable()
+        try:
+            yield
+        finally:
+            session.profile.disable()
+    finally:
+        session.lock.release()
+
+
+def sample(session, seconds, interval):
+    """
+    Sample the stacks of the other threads.
+    :param session: The session
+    :param seconds: The number of seconds to sample for
+    :param interval: The number of seconds between two samples
+    """
+    me = get_ident()
+    end = monotonic() + seconds
+    while monotonic() < end:
+        for thread, frame in sys._current_frames().items(): #pylint: disable=W0212
+            if thread == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_filename}:{frame.f_code.co_name}')
+                frame = frame.f_back
+            session.stacks[';'.join(reversed(stack))] += 1
+        sleep(interval)
+
+
+def run(mode, seconds, interval=0.005):
+    """
+    Profile the worker for some time. Only one session runs at a time.
+    :param mode: 'cprofile' or 'sample'
+    :param seconds: The number of seconds to profile for
+    :param interval: The number of seconds between two samples in 'sample' mode
+    :returns: For 'cprofile', the statistics in the format of pstats.Stats.dump_stats, for
+              'sample', the sampled stacks in the folded format of flame graphs, or None if another
+              session is running
+    """
+    global SESSION #pylint: disable=W0603
+    if not SESSION_LOCK.acquire(False):
+        return None
+    try:
+        session = SESSION = Session(mode)
+        if mode == 'cprofile':
+            sleep(seconds)
+        else:
+            sample(session, seconds, interval)
+        SESSION = None
+        if mode == 'cprofile':
+            with session.lock: # Wait for the request being profiled
+                session.profile.create_stats()
+            return marshal.dumps(session.profile.stats)
+        return ''.join(f'{stack} {count}\n' for stack, count in session.stacks.most_common())
+    finally:
+        SESSION = None
+        SESSION_LOCK.release()
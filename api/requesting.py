@@ -5,9 +5,14 @@ import logging
 from datetime import datetime
 from .exceptions import LeaseNotFoundException, FieldUndefinedException, NoRuleMatchedException
 from .loader import get_env
+from .logs import writer
+from . import txlog
 from .messages import Message
-from .models import Lease, BaseResult
-from .constants import REQUEST_LINE, REQUEST_LOG_FILE
+from .metrics import inc
+from .models import Lease, BaseResult, NO_LEASES
+from .roundrobin import with_deadline
+from .tracing import traced, trace_id
+from .constants import REQUEST_LINE, REQUEST_LOG_FILE, REQUEST_DEADLINE, TRANSACTION_LOG
 
 
 class Result(BaseResult):
@@ -21,7 +26,7 @@ class Result(BaseResult):
     def __init__(self, message, env, lease=None, hostname=''):
         super().__init__(message, env, lease)
         if lease is not None: # No real need to lock
-            lease.update(self.lease_duration, hostname)
+            self.lease_duration = lease.update(self.lease_duration, hostname)
 
     def _no_lease(self):
         """NAK"""
@@ -32,6 +37,8 @@ class Result(BaseResult):
         return self.ack()
 
 
+@traced('requesting.process')
+@with_deadline(REQUEST_DEADLINE)
 def process(ldap, relay_ip, ip, mac, hostname):
     """
     Return the existing lease if it exists.
@@ -42,29 +49,113 @@ def process(ldap, relay_ip, ip, mac, hostname):
     :param hostname: The client's hostname
     """
     logging.info('[REQUESTING][process] DHCPREQUEST of %s*%s on %s', ip, mac, relay_ip)
+    env = NO_LEASES.get((relay_ip, mac, ip), mac)
+    if env is not None:
+        inc('dhcapi_negative_hits_total', message=Message.NO_LEASE.name)
+        return Result(Message.NO_LEASE, env)
     try:
         env = get_env(relay_ip, mac)
     except NoRuleMatchedException as e:
         return Result(Message.UNADDRESSABLE, e.args[0])
-    except FieldUndefinedException:
+    except FieldUndefinedException as e:
         return Result(Message.CONF_ERROR, e.args[0])
     lid = f'{env["lease_prefix"]}{env["mac"]}'
     try:
-        return Result(Message.OK, env, Lease.from_ldap(ldap, lid, ip), hostname)
-    except LeaseNotFoundException:
+        try:
+            lease = Lease.from_ldap(ldap, lid, ip)
+        except LeaseNotFoundException: # The replicas may not have the offered lease yet
+            lease = Lease.from_ldap(ldap, lid, ip, primary=True)
+        return Result(Message.OK, env, lease, hostname)
+    except LeaseNotFoundException: # Confirmed by the node for writes
+        NO_LEASES.set((relay_ip, mac, ip), env)
         return Result(Message.NO_LEASE, env)
     except:
         return Result(Message.LDAP_ERROR, env)
 
 
+@traced('requesting.process_batch')
+@with_deadline(REQUEST_DEADLINE)
+def process_batch(ldap, clients):
+    """
+    Return the existing leases of several clients, looking up the leases of the clients of a pool
+    together.
+    :param ldap: The ldap to connect to
+    :param clients: The (relay IP, requested IP, MAC address, hostname) of the clients
+    :returns: The results, in the order of the clients
+    """
+    results, pools = [None] * len(clients), {}
+    for i, (relay_ip, ip, mac, _) in enumerate(clients):
+        logging.info('[REQUESTING][process_batch] DHCPREQUEST of %s*%s on %s', ip, mac, relay_ip)
+        env = NO_LEASES.get((relay_ip, mac, ip), mac)
+        if env is not None:
+            inc('dhcapi_negative_hits_total', message=Message.NO_LEASE.name)
+            results[i] = Result(Message.NO_LEASE, env)
+            continue
+        try:
+            env = get_env(relay_ip, mac)
+        except NoRuleMatchedException as e:
+            results[i] = Result(Message.UNADDRESSABLE, e.args[0])
+            continue
+        except FieldUndefinedException as e:
+            results[i] = Result(Message.CONF_ERROR, e.args[0])
+            continue
+        pools.setdefault(env['lease_prefix'], []).append((i, env))
+    for members in pools.values():
+        try:
+            leases = ldap.get_leases([f'{env["lease_prefix"]}{env["mac"]}' for _, env in members])
+            # The replicas may not have the offered leases yet
+            missing = [f'{env["lease_prefix"]}{env["mac"]}' for i, env in members
+                       if not has_lease(leases.get(f'{env["lease_prefix"]}{env["mac"]}'),
+                                        clients[i][1])]
+            if missing:
+                confirmed = ldap.get_leases(missing, primary=True)
+                leases.update({lid: confirmed.get(lid) for lid in missing})
+        except:
+            logging.exception('[REQUESTING][process_batch] Could not look up %s leases',
+                              len(members))
+            leases = None
+        for i, env in members:
+            relay_ip, ip, mac, hostname = clients[i]
+            found = None if leases is None else leases.get(f'{env["lease_prefix"]}{env["mac"]}')
+            if leases is None:
+                results[i] = Result(Message.LDAP_ERROR, env)
+            elif found is None: # Confirmed by the node for writes
+                NO_LEASES.set((relay_ip, mac, ip), env)
+                results[i] = Result(Message.NO_LEASE, env)
+            else:
+                try:
+                    results[i] = Result(Message.OK, env,
+                                        Lease(ldap, **ldap.pick_lease(found, ip)), hostname)
+                except LeaseNotFoundException:
+                    NO_LEASES.set((relay_ip, mac, ip), env)
+                    results[i] = Result(Message.NO_LEASE, env)
+                except:
+                    results[i] = Result(Message.LDAP_ERROR, env)
+    return results
+
+
+def has_lease(leases, ip):
+    """
+    Check if a request would be answered with one of the leases of its lease ID.
+    :param leases: The leases of the lease ID, or None if it has none
+    :param ip: The requested IP
+    :returns: Whether a lease holds the requested IP
+    """
+    return leases is not None and (ip is None or any(lease['ip_address'] == str(ip)
+                                                     for lease in leases))
+
+
 def log(mac, result):
     """
     Save the request result.
     :param mac: The machine MAC address
     :param result: The discovery result
     """
-    with open(REQUEST_LOG_FILE, 'a') as logfile:
-        logfile.write(REQUEST_LINE.format(int(datetime.now().timestamp() * 1000000),
-                                          result.router_ip, mac, result.get_ip(),
-                                          result.message.name, result.env.get('vid', 'UNKNOWN'),
-                                          result.env.get('zid', 'UNKNOWN')))
+    timestamp = int(datetime.now().timestamp() * 1000000)
+    if TRANSACTION_LOG != 'binary':
+        writer(REQUEST_LOG_FILE).write(REQUEST_LINE.format(
+            timestamp, result.router_ip, mac, result.get_ip(), result.message.name,
+            result.env.get('vid', 'UNKNOWN'), result.env.get('zid', 'UNKNOWN'),
+            trace_id=trace_id()))
+    if TRANSACTION_LOG != 'text':
+        txlog.log(txlog.REQUEST, timestamp, mac, result)
@@ -1,4 +1,6 @@
 """This module provides tools to work with Round-Robin pools of servers"""
 
 from .autoldap import RoundRobinLdap
-from .exceptions import NotFoundException, NoMoreIPException, ReadOnlyException
+from .deadline import remaining, bound, with_deadline
+from .exceptions import (NotFoundException, NoMoreIPException, ReadOnlyException,
+                         PoolExhaustedException, DeadlineExceededException)
@@ -1,57 +1,190 @@
 """This module defines the tools to communicate with the LDAP"""
 
 import logging
-from ldap3 import Server, Connection, MODIFY_REPLACE
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from socket import SHUT_RDWR
+from threading import Event, Lock
+from time import perf_counter
+from ldap3 import Server, Connection, MODIFY_REPLACE, BASE
 from ldap3.core.exceptions import (LDAPStrongerAuthRequiredResult, LDAPUnavailableResult,
                                    LDAPNoSuchObjectResult, LDAPInvalidAttributeSyntaxResult)
-from .exceptions import NoMoreIPException, ReadOnlyException
+from .deadline import remaining, bound
+from .exceptions import (NoMoreIPException, ReadOnlyException, PoolExhaustedException,
+                         DeadlineExceededException)
+from .health import HealthChecker
 from .ip import RoundRobinIP
+from .pool import ConnectionPool
 #from ldap3.utils.log import set_library_log_detail_level, NETWORK
 #set_library_log_detail_level(NETWORK)
 
 
+PAGED_RESULTS = '1.2.840.113556.1.4.319'
+WRITE_ACTIONS = ['add', 'modify', 'modify_dn', 'delete']
+RECEIVE_TIMEOUT = 20 # Seconds to wait for an answer, unless the request has less time left
+
+
 class RoundRobinLdap:
-    """This class implements a round-robin LDAP client"""
-    def __init__(self, user, password, rw_servers=None, ro_servers=None):
+    """
+    This class implements a thread-safe round-robin LDAP client, keeping a pool of connections to
+    each server.
+    :param user: The user to bind as
+    :param password: The user password
+    :param rw_servers: The R/W servers
+    :param ro_servers: The R/O servers
+    :param pool_size: The maximum number of connections to a server
+    :param pool_timeout: The maximum number of seconds to wait for a connection
+    """
+    def __init__(self, user, password, rw_servers=None, ro_servers=None, pool_size=4,
+                 pool_timeout=30):
         self.user = user
         self.password = password
         self.ip = RoundRobinIP(rw_servers, ro_servers)
-        self.ldap = None
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.pools = {}
+        self.lock = Lock()
+        self.health = None
+        self.hedger = None
 
     def connect(self, address):
         """
         Connect to the LDAP server located at the given address.
         :param address: The LDAP server to connect to
-        :returns: Whether the connection has been made
+        :returns: The connection
         """
         try:
             logging.info('[RRLDAP][connect] Connecting to {}'.format(address))
             ldap = Connection(Server(address, use_ssl=True, connect_timeout=5), user=self.user,
                               password=self.password, auto_bind=True, return_empty_attributes=True,
-                              raise_exceptions=True, receive_timeout=20)
-            self.disconnect()
-            self.ldap = ldap
-            logging.info('[RRLDAP][connect] Successful connection to {}'.format(self.ip.address))
+                              raise_exceptions=True, receive_timeout=RECEIVE_TIMEOUT)
+            logging.info('[RRLDAP][connect] Successful connection to {}'.format(address))
         except Exception as e:
             logging.error('[RRLDAP][connect] Connection to {} failed. Reason:\n                  {}'
                           .format(address, e))
-            return False
-        return True
+            raise
+        return ldap
 
     def disconnect(self):
-        """Disconnect from the currently connected LDAP server, if any"""
+        """Stop checking the health of the LDAP servers and close the idle connections to them"""
+        if self.health is not None:
+            self.health.stop()
+            self.health = None
+        self.hedger = None
+        self.drop_pools()
+
+    def drop_pools(self):
+        """Close the idle connections to every LDAP server, the pools being created again on use"""
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.clear()
+
+    def get_pool(self, address):
+        """
+        Get the connection pool of a server.
+        :param address: The server address
+        :returns: The connection pool
+        """
         try:
-            self.ldap.unbind()
-        except:
-            pass
+            return self.pools[address]
+        except KeyError:
+            with self.lock:
+                return self.pools.setdefault(address, ConnectionPool(
+                    lambda: self.connect(address), self.pool_size, self.pool_timeout))
+
+    def failover(self, server, write=True):
+        """
+        Switch to the next available node, unless another thread already did it.
+        :param server: The node which failed
+        :param write: Whether the node was used for writes or for reads
+        """
+        with self.lock:
+            if self.ip.current(write) is server:
+                if server is not None:
+                    pool = self.pools.pop(server.address, None)
+                    if pool is not None:
+                        pool.clear()
+                self.ip.next(write)
+
+    def rebalance(self):
+        """Switch to the preferred nodes if they are faster than the current ones"""
+        with self.lock:
+            for write in [True, False]:
+                if self.ip.rebalance(write):
+                    logging.info('[RRLDAP][rebalance] Now using {} for {}'.format(
+                        self.ip.current(write).address, 'writes' if write else 'reads'))
+
+    @staticmethod
+    def ping(ldap):
+        """
+        Check that a connection works with a cheap search on the root DSE.
+        :param ldap: The connection
+        """
+        ldap.search('', '(objectClass=*)', BASE, attributes=['1.1'])
+
+    def probe(self, server, max_idle=None):
+        """
+        Check the health of a node and measure its latency. A failing node is marked as crashed,
+        and left if it was in use.
+        :param server: The node
+        :param max_idle: The number of seconds after which idle connections are checked
+        :returns: Whether the node is healthy
+        """
+        pool = self.get_pool(server.address)
+        start = perf_counter()
+        try:
+            ldap = pool.acquire(0) # Without waiting, so that the other nodes are probed in time
+        except PoolExhaustedException:
+            return True # The node is busy, not down
+        except Exception:
+            ldap = None
+        try:
+            if ldap is None:
+                raise ConnectionError(f'Connection to {server.address} failed')
+            self.ping(ldap)
+        except Exception as e:
+            if ldap is not None:
+                pool.discard(ldap)
+            logging.error('[RRLDAP][probe] {} is down. Reason:\n                {}'
+                          .format(server.address, e))
+            server.crashed()
+            try:
+                for write in [True, False]:
+                    self.failover(server, write)
+            except NoMoreIPException:
+                logging.critical('[RRLDAP][probe] All nodes down')
+            return False
+        pool.release(ldap)
+        server.succeeded(perf_counter() - start)
+        if max_idle is not None:
+            pool.refresh(max_idle, self.ping)
+        return True
+
+    def start(self, min_connections=1, interval=10, max_idle=120):
+        """
+        Connect to the nodes eagerly, choose the fastest ones, and keep checking their health in
+        the background.
+        :param min_connections: The number of connections to open to each healthy node
+        :param interval: The number of seconds between two health checks
+        :param max_idle: The number of seconds after which idle connections are checked
+        """
+        for server in self.ip.servers:
+            if self.probe(server):
+                try:
+                    self.get_pool(server.address).fill(min_connections)
+                except Exception:
+                    pass
+        self.rebalance()
+        self.health = HealthChecker(self, interval, max_idle)
+        self.health.start()
 
     @property
     def can_write(self):
         """
-        Returns whether the current server is a R/W node.
-        :returns: A boolean telling if the server is R/W
+        Returns whether a R/W node is available.
+        :returns: A boolean telling if the LDAP is R/W
         """
-        return self.ip.can_write
+        return self.ip.has_writable
 
     def raise_ro_fast(self):
         """Raises a ReadOnlyException if there is no R/W IP in the pool"""
@@ -62,49 +195,240 @@ class RoundRobinLdap:
         """Indicates that the server timed out"""
         self.ip.timed_out()
 
-    def do(self, action, *args, **kwargs):
+    @staticmethod
+    def call(ldap, function):
         """
-        Execute an action on the LDAP server
-        :param action: The action to perform
-        :param args: The args to pass
-        :param kwargs: The kwargs to pass
+        Call a function with a connection, waiting for answers no longer than the current request
+        has time left.
+        :param ldap: The connection
+        :param function: The function, taking the connection as its argument
+        :returns: The function result
+        """
+        if getattr(ldap, 'socket', None) is not None:
+            ldap.socket.settimeout(bound(RECEIVE_TIMEOUT))
+        return function(ldap)
+
+    def run_on(self, server, function):
+        """
+        Run a function with a connection to a given node, without failing over.
+        :param server: The node
+        :param function: The function, taking the connection as its argument
+        :returns: The function result
+        """
+        pool = self.get_pool(server.address)
+        ldap = pool.acquire(bound(self.pool_timeout))
+        try:
+            result = self.call(ldap, function)
+        except:
+            pool.discard(ldap)
+            raise
+        pool.release(ldap)
+        return result
+
+    def run(self, function, write=True):
+        """
+        Run a function with a connection to the LDAP server
+        :param function: The function, taking the connection as its argument
+        :param write: Whether to use the node for writes or the one for reads
+        :returns: The function result
         """
         try:
             while True: # As long as possible,
+                server = self.ip.current(write)
+                if server is None:
+                    self.failover(None, write) # Find the first available node
+                    continue
+                pool = self.get_pool(server.address)
+                timeout = bound(self.pool_timeout)
+                try:
+                    ldap = pool.acquire(timeout)
+                except PoolExhaustedException:
+                    remaining() # The request may just have run out of time
+                    logging.error('[RRLDAP][run] No connection to {} available'
+                                  .format(server.address))
+                    raise
+                except Exception: # If the node cannot be reached,
+                    self.failover(server, write) # Find the next available node
+                    continue
                 try:
-                    return getattr(self.ldap, action)(*args, **kwargs) # Try to contact the LDAP
+                    result = self.call(ldap, function) # Try to contact the LDAP
                 except (LDAPStrongerAuthRequiredResult, LDAPUnavailableResult) as e:
-                    if self.can_write:
-                        self.timed_out()
-                        logging.error('[RRLDAP][do] R/W node {} is R/O'.format(self.ip.address))
+                    pool.release(ldap)
+                    if server.can_write:
+                        server.timed_out()
+                        logging.error('[RRLDAP][run] R/W node {} is R/O'.format(server.address))
                         raise ReadOnlyException() from e
-                    logging.error('[RRLDAP][do] {} is R/O'.format(self.ip.address))
+                    logging.error('[RRLDAP][run] {} is R/O'.format(server.address))
                 except (LDAPNoSuchObjectResult, LDAPInvalidAttributeSyntaxResult) as e:
-                    logging.warning('[RRLDAP][do] Non-critical exception raised for {}. Reason:\n'
-                                    '             {}'.format(self.ip.address, e))
+                    pool.release(ldap)
+                    logging.warning('[RRLDAP][run] Non-critical exception raised for {}. Reason:\n'
+                                    '              {}'.format(server.address, e))
                     raise
-                except AttributeError:
-                    pass
                 except Exception as e: # If the current node is down,
-                    logging.error('[RRLDAP][do] Connection to {} failed. Reason:\n             {}'
-                                  .format(self.ip.address, e))
-                #pylint: disable=E1102
-                while not self.connect(self.ip.next()): # Find the next available node
-                    logging.error('[RRLDAP][do] Connection to {} failed'.format(self.ip.address))
-        except NoMoreIPException: # If no node is up,
-            self.disconnect()
-            self.ldap = None
-            logging.critical('[RRLDAP][do] All nodes down')
+                    pool.discard(ldap)
+                    logging.error('[RRLDAP][run] Connection to {} failed. Reason:\n              {}'
+                                  .format(server.address, e))
+                    remaining() # A node only too slow for the time left is not left
+                else:
+                    pool.release(ldap)
+                    return result
+                self.failover(server, write) # Find the next available node
+        except NoMoreIPException: # If no node is up, the health checks will bring them back
+            self.drop_pools()
+            logging.critical('[RRLDAP][run] All nodes down')
             raise
 
-    def search(self, query, dn, attributes=[]):
+    def master(self):
+        """
+        Get the node every client uses for the writes which must be checked against each other,
+        since a write may not be replicated yet to the other R/W nodes.
+        :returns: The first available R/W node in the configured order
+        """
+        server = self.ip.get_master()
+        if server is None:
+            raise NoMoreIPException()
+        return server
+
+    def do(self, action, *args, write=None, server=None, **kwargs):
+        """
+        Execute an action on the LDAP server
+        :param action: The action to perform
+        :param args: The args to pass
+        :param write: Whether to use the node for writes, by default only for modifications
+        :param server: The node to use without failing over, by default the current one
+        :param kwargs: The kwargs to pass
+        :returns: The action result, or the list of entries found for a search
+        """
+        def perform(ldap):
+            result = getattr(ldap, action)(*args, **kwargs)
+            return list(ldap.entries) if action == 'search' else result
+        if server is not None:
+            return self.run_on(server, perform)
+        return self.run(perform, action in WRITE_ACTIONS if write is None else write)
+
+    def search(self, query, dn, attributes=[], primary=False, server=None):
         """
         Perform an LDAP search.
         :param query: The query to execute
         :dn: The base DN
         :attributes: The query attributes
+        :primary: Whether to search on the node for writes, to read its latest writes
+        :server: The node to search on without failing over, by default the current one
+        :returns: The list of entries found
+        """
+        return self.do('search', dn, query, attributes=attributes, write=primary, server=server)
+
+    def hedged_search(self, query, dn, attributes=[]):
+        """
+        Perform an LDAP search on the node for reads, and on a second node if the first one has not
+        answered within the hedging delay. The first answer wins, the search on the first node
+        being aborted if the second one answers first. If no answer comes, the search falls back
+        to the usual failover.
+        :param query: The query to execute
+        :dn: The base DN
+        :attributes: The query attributes
+        :returns: The list of entries found
         """
-        return self.do('search', dn, query, attributes=attributes)
+        first = self.ip.current(False)
+        second = next((srv for srv in self.ip.get_pool(False) if srv is not first), None)
+        if self.hedger is None or first is None or second is None:
+            return self.search(query, dn, attributes)
+        lock, settled = Lock(), Event()
+        state = {'connection': None, 'hedged': False, 'winner': None}
+        start = perf_counter()
+
+        def perform(ldap):
+            ldap.search(dn, query, attributes=attributes)
+            return list(ldap.entries)
+
+        def primary(ldap):
+            with lock:
+                if state['winner'] is not None:
+                    raise ConnectionAbortedError('Answered by the hedged search')
+                state['connection'] = ldap
+            ldap.search(dn, query, attributes=attributes)
+            with lock:
+                state['connection'] = None
+                if state['winner'] is not None: # The connection may have been shut down
+                    raise ConnectionAbortedError('Answered by the hedged search')
+                state['winner'] = first
+                settled.set()
+            return list(ldap.entries)
+
+        def hedge():
+            if settled.wait(max(0., start + self.hedger.delay - perf_counter())):
+                return None
+            with lock:
+                if settled.is_set():
+                    return None
+                state['hedged'] = True
+            hedge_start = perf_counter()
+            result = self.run_on(second, perform)
+            self.hedger.record(perf_counter() - hedge_start)
+            with lock:
+                if state['winner'] is not None:
+                    return None
+                state['winner'] = second
+                settled.set()
+                ldap = state['connection']
+            if getattr(ldap, 'socket', None) is not None:
+                try: # Abort the search on the first node, its connection being discarded
+                    ldap.socket.shutdown(SHUT_RDWR)
+                except OSError:
+                    pass
+            return result
+
+        future = self.hedger.submit(hedge)
+        try:
+            result = self.run_on(first, primary)
+        except Exception:
+            with lock:
+                hedged = state['hedged']
+                settled.set() # A hedge not sent yet is not sent
+            if not hedged:
+                return self.search(query, dn, attributes)
+            try:
+                result = future.result(bound(None))
+            except FutureTimeoutError as e:
+                raise DeadlineExceededException() from e
+            except Exception:
+                result = None
+            self.hedged(result is not None)
+            return self.search(query, dn, attributes) if result is None else result
+        self.hedger.record(perf_counter() - start)
+        if state['hedged']:
+            self.hedged(False)
+        return result
+
+    def hedged(self, won):
+        """
+        Called when a search was sent to a second node.
+        :param won: Whether the second node answered first
+        """
+
+    def paged_search(self, query, dn, callback, attributes=[], page_size=500, primary=False):
+        """
+        Perform an LDAP search using paged results. All the pages are fetched on a same connection
+        as paging cookies are only valid on the connection which gave them. If the connection
+        fails, the search starts over on the next available node.
+        :param query: The query to execute
+        :dn: The base DN
+        :callback: The function called with the list of entries of each page
+        :attributes: The query attributes
+        :page_size: The number of entries per page
+        :primary: Whether to search on the node for writes, to read its latest writes
+        """
+        def fetch(ldap):
+            cookie = None
+            while True:
+                ldap.search(dn, query, attributes=attributes, paged_size=page_size,
+                            paged_cookie=cookie)
+                controls = ldap.result.get('controls') or {}
+                cookie = controls.get(PAGED_RESULTS, {}).get('value', {}).get('cookie')
+                callback(list(ldap.entries))
+                if not cookie:
+                    return
+        self.run(fetch, write=primary)
 
     def update(self, dn, key, value):
         """
@@ -123,17 +447,3 @@ class RoundRobinLdap:
         """
         self.raise_ro_fast()
         self.do('delete', dn)
-
-    def get_result(self):
-        """
-        Returns the previous query results.
-        :returns: The query results
-        """
-        return self.ldap.entries[0]
-
-    def get_results(self):
-        """
-        Return the previous query list of results.
-        :returns: The query list of results
-        """
-        return self.ldap.entries
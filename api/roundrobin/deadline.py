@@ -0,0 +1,56 @@
+"""This module provides the deadlines bounding the time spent on a request"""
+
+from contextvars import ContextVar
+from functools import wraps
+from time import monotonic
+from .exceptions import DeadlineExceededException
+
+
+# The monotonic time at which the current request must be answered
+DEADLINE = ContextVar('deadline', default=None)
+
+
+def remaining():
+    """
+    Get the time left before the deadline of the current request.
+    :returns: The number of seconds left, or None if there is no deadline
+    """
+    deadline = DEADLINE.get()
+    if deadline is None:
+        return None
+    left = deadline - monotonic()
+    if left <= 0:
+        raise DeadlineExceededException()
+    return left
+
+
+def bound(timeout):
+    """
+    Bound a timeout by the time left before the deadline of the current request.
+    :param timeout: The timeout in seconds, or None for no timeout
+    :returns: The bounded timeout
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
+
+
+def with_deadline(seconds):
+    """
+    Give the calls of a function a deadline, unless they already have an earlier one.
+    :param seconds: The number of seconds the function has to return
+    :returns: The decorator
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            deadline = monotonic() + seconds
+            current = DEADLINE.get()
+            token = DEADLINE.set(deadline if current is None else min(current, deadline))
+            try:
+                return function(*args, **kwargs)
+            finally:
+                DEADLINE.reset(token)
+        return wrapper
+    return decorator
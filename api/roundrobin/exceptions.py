@@ -8,3 +8,9 @@ class NotFoundException(Exception):
 
 class ReadOnlyException(Exception):
     """This class represents the fact that the LDAP is read-only"""
+
+class PoolExhaustedException(Exception):
+    """This class represents the fact that no connection of a pool became available in time"""
+
+class DeadlineExceededException(Exception):
+    """This class represents the fact that a request ran out of time"""
@@ -0,0 +1,35 @@
+"""This module provides the background health checking of the LDAP servers"""
+
+from threading import Thread, Event
+
+
+class HealthChecker(Thread):
+    """
+    This class periodically probes every server of a round-robin LDAP client, keeping their
+    breakers and latencies up to date and their idle connections alive, and moves the client to the
+    fastest available nodes.
+    :param ldap: The round-robin LDAP client
+    :param interval: The number of seconds between two checks
+    :param max_idle: The number of seconds after which idle connections are checked
+    """
+    def __init__(self, ldap, interval, max_idle):
+        super().__init__(name='ldap-health', daemon=True)
+        self.ldap = ldap
+        self.interval = interval
+        self.max_idle = max_idle
+        self.stopped = Event()
+
+    def run(self):
+        """Check the servers until stopped"""
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """Probe every server once"""
+        for server in self.ldap.ip.servers:
+            self.ldap.probe(server, self.max_idle)
+        self.ldap.rebalance()
+
+    def stop(self):
+        """Stop checking the servers"""
+        self.stopped.set()
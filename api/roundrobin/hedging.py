@@ -0,0 +1,61 @@
+"""This module provides the hedging of the searches across replicas"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from threading import Lock
+
+
+class Hedger:
+    """
+    This class runs the hedges of the searches in the background and decides when to send them to
+    a second replica: when the first one has not answered within a percentile of the recent search
+    latencies.
+    :param percentile: The latency percentile after which a search is hedged
+    :param min_delay: The minimum number of seconds before a search is hedged
+    :param workers: The number of threads running the hedges
+    :param window: The number of recent latencies the percentile is computed on
+    """
+    def __init__(self, percentile, min_delay, workers, window=1000):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.latencies = deque(maxlen=window)
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='hedge')
+        self.recorded = 0
+        self._delay = None
+
+    def record(self, latency):
+        """
+        Record the latency of a search.
+        :param latency: The latency in seconds
+        """
+        with self.lock:
+            self.latencies.append(latency)
+            self.recorded += 1
+            if self.recorded % 100 == 0: # Sorting the window for every search would be wasteful
+                self._delay = None
+
+    @property
+    def delay(self):
+        """
+        Get the number of seconds after which a search is sent to a second replica.
+        :returns: The delay
+        """
+        if self._delay is None:
+            with self.lock:
+                latencies = sorted(self.latencies)
+            if not latencies:
+                return self.min_delay
+            index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+            self._delay = max(self.min_delay, latencies[index])
+        return self._delay
+
+    def submit(self, function, *args):
+        """
+        Run a function in the background, in the context of the caller so that its deadline holds.
+        :param function: The function
+        :param args: The function arguments
+        :returns: The future of the function result
+        """
+        return self.executor.submit(copy_context().run, function, *args)
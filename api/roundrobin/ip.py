@@ -1,36 +1,41 @@
 """This modules provides tools to manipulate IP addresses and pools"""
 
-from datetime import datetime, timedelta
 from random import shuffle
+from time import monotonic
 from .exceptions import NoMoreIPException
 
 
 class PoolIP:
     """
-    This class implements an IP member of a pool
+    This class implements an IP member of a pool, with a circuit breaker: once the node crashes,
+    the breaker is open and the node is unavailable for a cooldown period, after which it is
+    half-open and may be tried again. A success closes the breaker, a failure opens it again.
     """
+    CLOSED, OPEN = 'closed', 'open'
+    COOLDOWN = 300 # Seconds during which a crashed node is not used
+    ALPHA = 0.2 # Weight of a new latency measure in the latency average
+
     def __init__(self, address, should_write):
         self.address = address
         self.should_write = should_write
-        self.last_crash = datetime.now()
-        self.last_timeout = datetime.now() - timedelta(minutes=10)
-        self.up = True
+        self.latency = None
+        self.state = self.CLOSED
+        self.last_crash = None
+        self.last_timeout = None
 
     def reset(self):
         """Reset the state of the IP"""
-        self.last_crash = datetime.now()
-        self.last_timeout = datetime.now() - timedelta(minutes=10)
-        self.up = True
+        self.state = self.CLOSED
+        self.last_crash = None
+        self.last_timeout = None
 
     @property
     def is_available(self):
         """
-        Check if the IP is available.
+        Check if the IP is available, that is if its breaker is closed or half-open.
         :returns: Whether the IP is available or not
         """
-        if self.up or (datetime.now() - self.last_crash).seconds > 300:
-            return True
-        return False
+        return self.state == self.CLOSED or monotonic() - self.last_crash > self.COOLDOWN
 
     @property
     def can_write(self):
@@ -38,21 +43,38 @@ class PoolIP:
         Check if the IP corresponds to a writable node.
         :returns: Whether the node is writable or not
         """
-        return self.should_write and (datetime.now() - self.last_timeout).seconds > 300
+        return self.should_write and (self.last_timeout is None or
+                                      monotonic() - self.last_timeout > self.COOLDOWN)
 
     def timed_out(self):
         """Mark the node as timed out"""
-        self.last_timeout = datetime.now()
+        self.last_timeout = monotonic()
+
+    def crashed(self):
+        """Mark the node as crashed, opening its breaker"""
+        self.state = self.OPEN
+        self.last_crash = monotonic()
+
+    def succeeded(self, latency):
+        """
+        Mark a successful request to the node, closing its breaker.
+        :param latency: The request latency in seconds
+        """
+        self.state = self.CLOSED
+        self.latency = (latency if self.latency is None
+                        else self.ALPHA * latency + (1 - self.ALPHA) * self.latency)
 
 
 class RoundRobinIP:
     """
-    This class implements a round-robin IP pool
+    This class implements a round-robin IP pool, with a current node for writes and another one
+    for reads
     """
     def __init__(self, rw_servers, ro_servers):
         self.servers = ([PoolIP(address, True) for address in rw_servers] +
                         [PoolIP(address, False) for address in ro_servers])
         self.ip = None
+        self.read_ip = None
 
     def get_rw_pool(self):
         """
@@ -61,33 +83,90 @@ class RoundRobinIP:
         """
         return [srv for srv in self.servers if srv.can_write and srv.is_available]
 
-    def next(self):
+    def get_master(self):
+        """
+        Get the first available R/W node in the configured order, which all the clients seeing the
+        same available nodes agree on.
+        :returns: The node, or None if no R/W node is available
+        """
+        return next((srv for srv in self.servers if srv.can_write and srv.is_available), None)
+
+    def get_pool(self, write=True):
+        """
+        Get the available nodes, by order of preference. Writes prefer R/W nodes, and reads prefer
+        R/O nodes, then the fastest nodes are preferred.
+        :param write: Whether to order the nodes for writes or for reads
+        :returns: The available nodes
+        """
+        def by_latency(pool):
+            shuffle(pool) # Nodes which have not been measured yet are tried randomly
+            return sorted(pool, key=lambda srv: srv.latency or 0)
+        rw_pool = by_latency(self.get_rw_pool())
+        ro_pool = by_latency([srv for srv in self.servers
+                              if not srv.can_write and srv.is_available])
+        return rw_pool + ro_pool if write else ro_pool + rw_pool
+
+    def current(self, write=True):
+        """
+        Get the current node.
+        :param write: Whether to get the node for writes or the one for reads
+        :returns: The current node
+        """
+        return self.ip if write else self.read_ip
+
+    def next(self, write=True):
         """
         Get the next available IP.
+        :param write: Whether to get the next node for writes or for reads
         :returns: The next IP
         """
-        self.just_crashed()
-        rw_pool = self.get_rw_pool()
-        shuffle(rw_pool)
-        ro_pool = [srv for srv in self.servers if not srv.can_write and srv.is_available]
-        shuffle(ro_pool)
-        pool = rw_pool + ro_pool
+        self.just_crashed(write)
         try:
-            self.ip = pool[0]
-            return self.ip.address
+            server = self.get_pool(write)[0]
         except IndexError as e:
             self.reset()
             raise NoMoreIPException() from e
+        if write:
+            self.ip = server
+        else:
+            self.read_ip = server
+        return server.address
 
-    def just_crashed(self):
-        """Mark the node as just crashed"""
-        if self.ip is not None:
-            self.ip.last_crash = datetime.now()
-            self.ip.up = False
+    def rebalance(self, write=True, margin=0.8):
+        """
+        Switch to the preferred node if it is significantly faster than the current one.
+        :param write: Whether to rebalance the node for writes or the one for reads
+        :param margin: The latency ratio under which the preferred node is used
+        :returns: Whether the node changed
+        """
+        server = self.current(write)
+        pool = self.get_pool(write)
+        if not pool or pool[0] is server:
+            return False
+        best = pool[0]
+        if (server is not None and server.is_available and server.should_write == best.should_write
+                and (best.latency is None or server.latency is None
+                     or best.latency >= margin * server.latency)):
+            return False
+        if write:
+            self.ip = best
+        else:
+            self.read_ip = best
+        return True
+
+    def just_crashed(self, write=True):
+        """
+        Mark the node as just crashed
+        :param write: Whether to mark the node for writes or the one for reads
+        """
+        server = self.current(write)
+        if server is not None:
+            server.crashed()
 
     def reset(self):
         """Reset the internal state"""
         self.ip = None
+        self.read_ip = None
         for ip in self.servers:
             ip.reset()
 
@@ -0,0 +1,121 @@
+"""This module provides pools of connections to a server"""
+
+from threading import Condition
+from time import monotonic
+from .exceptions import PoolExhaustedException
+
+
+class ConnectionPool:
+    """
+    This class implements a thread-safe pool of connections to a server.
+    :param connect: The function opening a new connection
+    :param size: The maximum number of connections
+    :param timeout: The maximum number of seconds to wait for a connection
+    """
+    def __init__(self, connect, size, timeout):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.count = 0
+        self.condition = Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Check a connection out of the pool, opening one if none is idle and the pool is not full.
+        :param timeout: The maximum number of seconds to wait, instead of the pool timeout
+        :returns: The connection
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.idle or self.count < self.size,
+                                           self.timeout if timeout is None else timeout):
+                raise PoolExhaustedException()
+            if self.idle:
+                return self.idle.pop()[0]
+            self.count += 1
+        try:
+            return self.connect()
+        except:
+            self._forget(1)
+            raise
+
+    def release(self, connection):
+        """
+        Check a connection back into the pool.
+        :param connection: The connection
+        """
+        with self.condition:
+            self.idle.append((connection, monotonic()))
+            self.condition.notify()
+
+    def discard(self, connection):
+        """
+        Close a checked out connection instead of checking it back in.
+        :param connection: The connection
+        """
+        self._close(connection)
+        self._forget(1)
+
+    def clear(self):
+        """Close the idle connections"""
+        with self.condition:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            self._close(connection)
+        self._forget(len(idle))
+
+    def fill(self, count):
+        """
+        Open connections until the pool holds at least a given number of them.
+        :param count: The number of connections
+        """
+        while True:
+            with self.condition:
+                if self.count >= min(count, self.size):
+                    return
+                self.count += 1
+            try:
+                connection = self.connect()
+            except:
+                self._forget(1)
+                raise
+            self.release(connection)
+
+    def refresh(self, max_idle, check):
+        """
+        Check the connections which have been idle for too long, so that the server does not close
+        them, and close the ones failing the check.
+        :param max_idle: The number of seconds after which idle connections are checked
+        :param check: The function checking a connection
+        """
+        with self.condition:
+            limit = monotonic() - max_idle
+            stale = [connection for connection, since in self.idle if since < limit]
+            self.idle = [(connection, since) for connection, since in self.idle if since >= limit]
+        for connection in stale:
+            try:
+                check(connection)
+            except:
+                self.discard(connection)
+            else:
+                self.release(connection)
+
+    def _forget(self, count):
+        """
+        Make room for new connections.
+        :param count: The number of connections which have been closed
+        """
+        with self.condition:
+            self.count -= count
+            self.condition.notify(count)
+
+    @staticmethod
+    def _close(connection):
+        """
+        Close a connection, ignoring errors.
+        :param connection: The connection
+        """
+        try:
+            connection.unbind()
+        except:
+            pass
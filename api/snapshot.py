@@ -0,0 +1,275 @@
+"""
+This module provides the snapshots of the state a worker derives while running: the resolved
+environments, the used IPs of the pools, the health of the LDAP servers and the lease mirror. A
+worker periodically saves it to a file, and a restarted worker restores the last snapshot at boot
+instead of rebuilding it, then reconciles it with the LDAP as usual.
+
+The file starts with a header and a table of sections, each section being a JSON document which is
+only decoded when restored, straight from the memory-mapped file.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from datetime import datetime
+from threading import Thread, Event
+from time import monotonic, time
+from .allocator import ALLOCATORS
+from .constants import CONFIG_FILE, ALLOCATOR_TTL
+from .ip import IP
+from .loader import ENV_CACHE, FUNCTIONS
+
+
+HEADER = struct.Struct('<4sIQI') # Magic, version, creation timestamp (µs), section count
+SECTION = struct.Struct('<16sQQ') # Name, offset, length
+MAGIC = b'DSNP'
+VERSION = 1
+
+
+def encode(obj):
+    """
+    Encode the values JSON does not support.
+    :param obj: The value
+    :returns: A tagged JSON object
+    """
+    if isinstance(obj, IP):
+        return {'$ip': int(obj)}
+    if isinstance(obj, datetime):
+        return {'$datetime': obj.isoformat()}
+    if FUNCTIONS.get(getattr(obj, '__name__', None)) is obj:
+        return {'$function': obj.__name__}
+    raise TypeError(f'Invalid value: {repr(obj)}')
+
+
+def decode(obj):
+    """
+    Decode the values encoded by encode.
+    :param obj: A JSON object
+    :returns: The value
+    """
+    if len(obj) == 1:
+        if '$ip' in obj:
+            return IP(obj['$ip'])
+        if '$datetime' in obj:
+            return datetime.fromisoformat(obj['$datetime'])
+        if '$function' in obj:
+            return FUNCTIONS[obj['$function']]
+    return obj
+
+
+def config_digest():
+    """
+    Get the digest of the DHCP configuration, the environments resolved with another configuration
+    being discarded.
+    :returns: The digest
+    """
+    with open(CONFIG_FILE, 'rb') as config:
+        return hashlib.sha256(config.read()).hexdigest()
+
+
+def dump_envs():
+    """
+    Get the resolved environments.
+    :returns: The section
+    """
+    return {'config': config_digest(), 'envs': ENV_CACHE.items()}
+
+
+def restore_envs(section, age): #pylint: disable=W0613
+    """
+    Restore the resolved environments, if the configuration did not change.
+    :param section: The section
+    :param age: The age of the snapshot
+    :returns: Whether the section was restored
+    """
+    if section['config'] != config_digest():
+        return False
+    for key, env in section['envs']:
+        ENV_CACHE.set(key, env)
+    return True
+
+
+def dump_allocators():
+    """
+    Get the used IPs of the pools.
+    :returns: The section
+    """
+    pools = []
+    for allocator in list(ALLOCATORS.pools.values()):
+        with allocator.lock:
+            if allocator.loaded_at is not None:
+                pools.append([allocator.lease_prefix, allocator.first,
+                              allocator.first + allocator.size - 1, hex(allocator.bits),
+                              monotonic() - allocator.loaded_at])
+    return pools
+
+
+def restore_allocators(section, age):
+    """
+    Restore the used IPs of the pools which are not expired.
+    :param section: The section
+    :param age: The age of the snapshot
+    :returns: Whether the section was restored
+    """
+    for lease_prefix, first, last, bits, loaded in section:
+        if age + loaded < ALLOCATOR_TTL:
+            allocator = ALLOCATORS.get(lease_prefix, first, last)
+            with allocator.lock:
+                if allocator.loaded_at is None:
+                    allocator.bits = int(bits, 16)
+                    allocator.loaded_at = monotonic() - age - loaded
+    return True
+
+
+def dump_health(ldap):
+    """
+    Get the health of the LDAP servers, the events being dated with the wall clock.
+    :param ldap: The ldap
+    :returns: The section
+    """
+    def wall(instant):
+        return None if instant is None else time() - (monotonic() - instant)
+    return [[server.address, server.latency, server.state, wall(server.last_crash),
+             wall(server.last_timeout)] for server in ldap.ip.servers]
+
+
+def restore_health(section, age, ldap): #pylint: disable=W0613
+    """
+    Restore the health of the LDAP servers still configured.
+    :param section: The section
+    :param age: The age of the snapshot
+    :param ldap: The ldap
+    :returns: Whether the section was restored
+    """
+    def clock(instant):
+        return None if instant is None else monotonic() - (time() - instant)
+    servers = {server.address: server for server in ldap.ip.servers}
+    for address, latency, state, last_crash, last_timeout in section:
+        server = servers.get(address)
+        if server is not None and server.latency is None:
+            server.latency = latency
+            server.state = state
+            server.last_crash = clock(last_crash)
+            server.last_timeout = clock(last_timeout)
+    return True
+
+
+def dump_mirror(ldap):
+    """
+    Get the lease mirror.
+    :param ldap: The ldap
+    :returns: The section, or None if the mirror is not loaded
+    """
+    state = ldap.mirror.dump() if ldap.mirror is not None else None
+    if state is None:
+        return None
+    leases, high_water, loaded = state
+    # Rows rather than objects, which are much faster to decode
+    return {'leases': [[lease['lease_id'], lease['mac_address'], lease['ip_address'],
+                        lease['lease_expiry'].isoformat()] for lease in leases],
+            'high_water': high_water, 'loaded': loaded}
+
+
+def restore_mirror(section, age, ldap):
+    """
+    Restore the lease mirror.
+    :param section: The section
+    :param age: The age of the snapshot
+    :param ldap: The ldap
+    :returns: Whether the section was restored
+    """
+    if ldap.mirror is None:
+        return False
+    leases = [{'lease_id': lease_id, 'mac_address': mac_address, 'ip_address': ip_address,
+               'lease_expiry': datetime.fromisoformat(lease_expiry)}
+              for lease_id, mac_address, ip_address, lease_expiry in section['leases']]
+    return ldap.mirror.restore(leases, section['high_water'], age + section['loaded'])
+
+
+def save(path, ldap):
+    """
+    Save a snapshot, replacing the previous one at once.
+    :param path: The snapshot path
+    :param ldap: The ldap
+    """
+    sections = {'envs': dump_envs(), 'allocators': dump_allocators(),
+                'health': dump_health(ldap), 'mirror': dump_mirror(ldap)}
+    data = [(name.encode(), json.dumps(section, default=encode, separators=(',', ':')).encode())
+            for name, section in sections.items() if section is not None]
+    offset = HEADER.size + SECTION.size * len(data)
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as snapshot:
+        snapshot.write(HEADER.pack(MAGIC, VERSION, int(time() * 1000000), len(data)))
+        for name, section in data:
+            snapshot.write(SECTION.pack(name, offset, len(section)))
+            offset += len(section)
+        for _, section in data:
+            snapshot.write(section)
+    os.replace(temp, path)
+
+
+def restore(path, ldap, max_age):
+    """
+    Restore the last snapshot, the sections being decoded one by one from the mapped file.
+    :param path: The snapshot path
+    :param ldap: The ldap
+    :param max_age: The number of seconds after which a snapshot is ignored
+    :returns: The names of the restored sections
+    """
+    restorers = {'envs': restore_envs, 'allocators': restore_allocators,
+                 'health': lambda section, age: restore_health(section, age, ldap),
+                 'mirror': lambda section, age: restore_mirror(section, age, ldap)}
+    restored = []
+    try:
+        with open(path, 'rb') as snapshot, \
+             mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, created, count = HEADER.unpack_from(data)
+            age = time() - created / 1000000
+            if magic != MAGIC or version != VERSION or not 0 <= age < max_age:
+                logging.info('[SNAPSHOT][restore] Ignoring snapshot %s', path)
+                return restored
+            for i in range(count):
+                name, offset, length = SECTION.unpack_from(data, HEADER.size + i * SECTION.size)
+                name = name.rstrip(b'\0').decode()
+                section = json.loads(data[offset:offset+length], object_hook=decode)
+                if name in restorers and restorers[name](section, age):
+                    restored.append(name)
+    except FileNotFoundError:
+        return restored
+    except Exception as e: # A worker can always start cold
+        logging.error('[SNAPSHOT][restore] Restoring %s failed. Reason:\n'
+                      '                    %s', path, e)
+    logging.info('[SNAPSHOT][restore] Restored %s from %s', ', '.join(restored) or 'nothing',
+                 path)
+    return restored
+
+
+class Snapshotter(Thread):
+    """
+    This class periodically saves a snapshot from a background thread.
+    :param path: The snapshot path
+    :param ldap: The ldap
+    :param interval: The number of seconds between two snapshots
+    """
+    def __init__(self, path, ldap, interval):
+        super().__init__(name='snapshot', daemon=True)
+        self.path = path
+        self.ldap = ldap
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        """Save snapshots until stopped"""
+        while not self.stopped.wait(self.interval):
+            try:
+                save(self.path, self.ldap)
+            except Exception as e: # The previous snapshot is kept
+                logging.error('[SNAPSHOT][run] Saving %s failed. Reason:\n'
+                              '                %s', self.path, e)
+
+    def stop(self):
+        """Stop saving snapshots"""
+        self.stopped.set()
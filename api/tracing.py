@@ -0,0 +1,91 @@
+"""This module provides lightweight tracing: the spans of a request, identified by a trace ID"""
+
+import logging
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from .constants import TRACE_SLOW
+
+
+class Trace:
+    """
+    This class records the spans of a request.
+    :param name: The name of the root span
+    """
+    def __init__(self, name):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name
+        self.spans = []
+        self.depth = 0
+
+    def __str__(self):
+        """
+        Describe the spans of the trace, only once the trace is actually logged.
+        :returns: The spans with their durations in milliseconds, indented by depth
+        """
+        return ', '.join(f'{"." * depth}{name} {duration * 1000:.2f}ms'
+                         for _, depth, name, duration in sorted(self.spans))
+
+
+TRACE = ContextVar('trace', default=None)
+
+
+@contextmanager
+def span(name):
+    """
+    Record the duration of a block, or of the calls of a function when used as a decorator, as a
+    span of the current trace. Nothing is recorded outside of a trace.
+    :param name: The span name
+    """
+    trace = TRACE.get()
+    if trace is None:
+        yield
+        return
+    start = perf_counter()
+    depth = trace.depth
+    trace.depth += 1
+    try:
+        yield
+    finally:
+        trace.depth = depth
+        trace.spans.append((start, depth, name, perf_counter() - start))
+
+
+@contextmanager
+def traced(name):
+    """
+    Start a trace, unless one is already running, and log its spans once it ends. The traces
+    slower than TRACE_SLOW seconds are logged as warnings.
+    :param name: The name of the root span
+    """
+    if TRACE.get() is not None:
+        with span(name):
+            yield
+        return
+    trace = Trace(name)
+    token = TRACE.set(trace)
+    try:
+        with span(name):
+            yield
+    finally:
+        duration = trace.spans[-1][3]
+        logging.log(logging.WARNING if duration > TRACE_SLOW else logging.DEBUG,
+                    '[TRACE][%s] %s %.2fms: %s', name, trace.trace_id, duration * 1000, trace)
+        TRACE.reset(token)
+
+
+def trace_id():
+    """
+    Get the ID of the current trace.
+    :returns: The trace ID, or '-' outside of a trace
+    """
+    trace = TRACE.get()
+    return '-' if trace is None else trace.trace_id
+
+
+class TraceFilter(logging.Filter):
+    """This class adds the ID of the current trace to the log records, as trace_id"""
+    def filter(self, record):
+        record.trace_id = trace_id()
+        return True
@@ -0,0 +1,324 @@
+"""
+This module provides the binary transaction log: fixed-width records appended to segments, which
+are indexed by time, IP address and MAC address once full. It can also be run to query the log:
+
+    python -m api.txlog [--ip IP] [--mac MAC] [--since DATE] [--until DATE] [--index] [DIRECTORY]
+"""
+
+import argparse
+import atexit
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime
+from glob import glob
+from threading import Lock
+from time import time
+from .constants import (TXLOG_DIR, TXLOG_SEGMENT_BYTES, LOG_FLUSH_SIZE, LOG_FLUSH_INTERVAL,
+                        LOG_QUEUE_SIZE)
+from .ip import IP
+from .logs import LogWriter
+from .messages import Message
+
+
+# Timestamp (µs), relay IP, IP, MAC, kind, message, vid, zid
+RECORD = struct.Struct('<QIIQBB7s7s')
+HEADER = struct.Struct('<4sIQQ') # Magic, record count, first and last timestamps
+TIME_ENTRY = struct.Struct('<QI') # Timestamp, record number
+IP_ENTRY = struct.Struct('<II') # IP, record number
+MAC_ENTRY = struct.Struct('<QI') # MAC, record number
+MAGIC = b'DTXI'
+DISCOVER, REQUEST = 0, 1
+KINDS = ['discover', 'request']
+
+Record = namedtuple('Record', ['timestamp', 'relay_ip', 'ip', 'mac', 'kind', 'message', 'vid',
+                               'zid'])
+
+
+def to_int(ip):
+    """
+    Convert an IP address to an integer, unknown addresses being 0.
+    :param ip: The IP address, or 'UNKNOWN'
+    :returns: The integer
+    """
+    try:
+        return int(IP(ip))
+    except (ValueError, TypeError):
+        return 0
+
+
+def mac_to_int(mac):
+    """
+    Convert a MAC address to an integer, addresses which cannot be encoded being 0.
+    :param mac: The MAC address, with or without separators
+    :returns: The integer
+    """
+    try:
+        value = int(mac.replace(':', '').replace('-', ''), 16)
+    except (AttributeError, ValueError):
+        return 0
+    return value if value < 2**64 else 0
+
+
+def encode(kind, timestamp, mac, result):
+    """
+    Encode a transaction as a record.
+    :param kind: DISCOVER or REQUEST
+    :param timestamp: The transaction timestamp in µs
+    :param mac: The client MAC address
+    :param result: The transaction result
+    :returns: The record bytes
+    """
+    return RECORD.pack(timestamp, to_int(result.router_ip), to_int(result.get_ip()),
+                       mac_to_int(mac), kind, result.message.value,
+                       str(result.env.get('vid', '')).encode()[:7],
+                       str(result.env.get('zid', '')).encode()[:7])
+
+
+def decode(data, offset=0):
+    """
+    Decode a record.
+    :param data: The buffer holding the record
+    :param offset: The record offset in the buffer
+    :returns: The record
+    """
+    timestamp, relay_ip, ip, mac, kind, message, vid, zid = RECORD.unpack_from(data, offset)
+    return Record(timestamp, relay_ip, ip, mac, kind, message, vid.rstrip(b'\0').decode(),
+                  zid.rstrip(b'\0').decode())
+
+
+def segment_path(directory):
+    """
+    Get the path of a new segment. Every process writes its own segments.
+    :param directory: The segments directory
+    :returns: The segment path
+    """
+    return os.path.join(directory, f'{int(time() * 1000000)}-{os.getpid()}.seg')
+
+
+class SegmentWriter(LogWriter):
+    """
+    This class appends records to segments from a background thread, and indexes every segment
+    once it is full.
+    :param directory: The segments directory
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(segment_path(directory), LOG_FLUSH_SIZE, LOG_FLUSH_INTERVAL,
+                         TXLOG_SEGMENT_BYTES, 0, LOG_QUEUE_SIZE)
+        self.name = os.path.basename(directory) # Rather than the name of the current segment
+
+    def rotate(self):
+        """Index the full segment and start a new one"""
+        self.file.close()
+        self.file = None
+        build_index(self.path)
+        self.path = segment_path(self.directory)
+
+
+WRITER = None
+WRITER_LOCK = Lock()
+
+
+def log(kind, timestamp, mac, result):
+    """
+    Save a transaction in the binary log.
+    :param kind: DISCOVER or REQUEST
+    :param timestamp: The transaction timestamp in µs
+    :param mac: The client MAC address
+    :param result: The transaction result
+    """
+    global WRITER #pylint: disable=W0603
+    if WRITER is None or WRITER.pid != os.getpid():
+        with WRITER_LOCK:
+            if WRITER is None or WRITER.pid != os.getpid():
+                WRITER = SegmentWriter(TXLOG_DIR)
+    WRITER.write(encode(kind, timestamp, mac, result))
+
+
+def close():
+    """Write the pending records of the process, which is exiting"""
+    if WRITER is not None:
+        WRITER.close()
+
+
+atexit.register(close)
+
+
+def build_index(path):
+    """
+    Write the index of a segment: its records numbers sorted by time, by IP and by MAC address.
+    :param path: The segment path
+    """
+    with open(path, 'rb') as segment:
+        data = segment.read()
+    records = [RECORD.unpack_from(data, offset)
+               for offset in range(0, len(data) - RECORD.size + 1, RECORD.size)]
+    times = sorted((record[0], i) for i, record in enumerate(records))
+    ips = sorted((record[2], i) for i, record in enumerate(records))
+    macs = sorted((record[3], i) for i, record in enumerate(records))
+    with open(f'{path}.idx.tmp', 'wb') as index:
+        index.write(HEADER.pack(MAGIC, len(records), times[0][0] if times else 0,
+                                times[-1][0] if times else 0))
+        for entries, entry in [(times, TIME_ENTRY), (ips, IP_ENTRY), (macs, MAC_ENTRY)]:
+            index.write(b''.join(entry.pack(*x) for x in entries))
+    os.replace(f'{path}.idx.tmp', f'{path}.idx')
+
+
+class Keys:
+    """
+    This class exposes the keys of a sorted index section as a sequence, for binary searches.
+    :param data: The index buffer
+    :param offset: The offset of the section
+    :param entry: The structure of the section entries
+    :param count: The number of entries
+    """
+    def __init__(self, data, offset, entry, count):
+        self.data = data
+        self.offset = offset
+        self.entry = entry
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.entry.unpack_from(self.data, self.offset + i * self.entry.size)[0]
+
+    def numbers(self, low, high):
+        """
+        Get the record numbers of the entries whose keys are in a range.
+        :param low: The lowest key
+        :param high: The highest key
+        :returns: The record numbers
+        """
+        i = bisect_left(self, low)
+        while i < self.count:
+            key, number = self.entry.unpack_from(self.data, self.offset + i * self.entry.size)
+            if key > high:
+                return
+            yield number
+            i += 1
+
+
+class Segment:
+    """
+    This class gives access to the records of a memory-mapped segment, through its index if any.
+    :param path: The segment path
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = self._map(path)
+        self.count = len(self.data) // RECORD.size
+        self.index = None
+        if os.path.exists(f'{path}.idx'):
+            index = self._map(f'{path}.idx')
+            magic, count, self.first, self.last = HEADER.unpack_from(index)
+            if magic == MAGIC and count == self.count:
+                offset = HEADER.size
+                self.index = {}
+                for name, entry in [('time', TIME_ENTRY), ('ip', IP_ENTRY), ('mac', MAC_ENTRY)]:
+                    self.index[name] = Keys(index, offset, entry, count)
+                    offset += count * entry.size
+
+    @staticmethod
+    def _map(path):
+        """
+        Map a file in memory.
+        :param path: The file path
+        :returns: The mapped file, or empty bytes for an empty file
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def query(self, ip=None, mac=None, since=0, until=2**64-1):
+        """
+        Find the records matching the given criteria.
+        :param ip: The IP address as an integer
+        :param mac: The MAC address as an integer
+        :param since: The lowest timestamp
+        :param until: The highest timestamp
+        :returns: The matching records
+        """
+        if self.index is None:
+            numbers = range(self.count)
+        elif self.first > until or self.last < since:
+            return
+        elif ip is not None:
+            numbers = sorted(self.index['ip'].numbers(ip, ip))
+        elif mac is not None:
+            numbers = sorted(self.index['mac'].numbers(mac, mac))
+        else:
+            numbers = sorted(self.index['time'].numbers(since, until))
+        for number in numbers:
+            record = decode(self.data, number * RECORD.size)
+            if ((ip is None or record.ip == ip) and (mac is None or record.mac == mac)
+                    and since <= record.timestamp <= until):
+                yield record
+
+
+def query(directory, ip=None, mac=None, since=0, until=2**64-1):
+    """
+    Find the records of all the segments matching the given criteria, by time.
+    :param directory: The segments directory
+    :param ip: The IP address as an integer
+    :param mac: The MAC address as an integer
+    :param since: The lowest timestamp
+    :param until: The highest timestamp
+    :returns: The matching records
+    """
+    records = []
+    for path in glob(os.path.join(directory, '*.seg')):
+        records.extend(Segment(path).query(ip, mac, since, until))
+    return sorted(records)
+
+
+def index_missing(directory, idle=60):
+    """
+    Index the segments which have no index and have not been written to for a while, such as the
+    last segments of stopped processes.
+    :param directory: The segments directory
+    :param idle: The number of seconds since the last write
+    """
+    for path in glob(os.path.join(directory, '*.seg')):
+        if not os.path.exists(f'{path}.idx') and time() - os.path.getmtime(path) > idle:
+            build_index(path)
+
+
+def main(argv):
+    """
+    Query the binary transaction log.
+    :param argv: The command line arguments
+    """
+    parser = argparse.ArgumentParser(prog='python -m api.txlog', description=main.__doc__)
+    parser.add_argument('directory', nargs='?', default=TXLOG_DIR)
+    parser.add_argument('--ip', help='IP address given to the client')
+    parser.add_argument('--mac', help='client MAC address')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='ISO date or time')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='ISO date or time')
+    parser.add_argument('--index', action='store_true', help='index the idle unindexed segments')
+    args = parser.parse_args(argv)
+    if args.index:
+        index_missing(args.directory)
+    records = query(args.directory,
+                    to_int(args.ip) if args.ip else None,
+                    mac_to_int(args.mac) if args.mac else None,
+                    int(args.since.timestamp() * 1000000) if args.since else 0,
+                    int(args.until.timestamp() * 1000000) if args.until else 2**64-1)
+    for record in records:
+        mac = f'{record.mac:012x}'
+        mac = ':'.join(mac[i:i+2] for i in range(0, 12, 2))
+        print(datetime.fromtimestamp(record.timestamp / 1000000).isoformat(),
+              KINDS[record.kind], IP(record.relay_ip), mac,
+              IP(record.ip) if record.ip else 'UNKNOWN', Message(record.message).name,
+              record.vid or 'UNKNOWN', record.zid or 'UNKNOWN')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
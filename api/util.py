@@ -1,17 +1,168 @@
 """This module provides utility functions"""
 
-def first_available(l, start=0):
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
+from .metrics import inc
+
+
+class LRUCache:
+    """
+    This class implements a thread-safe bounded mapping which evicts the least recently used keys.
+    :param size: The maximum number of entries
+    :param ttl: The optional number of seconds after which entries expire
+    :param name: The optional name the hits and misses of the cache are counted under
+    """
+    def __init__(self, size, ttl=None, name=None):
+        self.size = size
+        self.ttl = ttl
+        self.name = name
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        """
+        Get a value from the cache.
+        :param key: The key to look for
+        :param default: The value to return if the key is not cached
+        :returns: The cached value or the default one
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and (entry[0] is None or entry[0] >= monotonic())
+            if hit:
+                self.entries.move_to_end(key)
+            elif entry is not None:
+                del self.entries[key]
+        if self.name is not None:
+            inc('dhcapi_cache_lookups_total', cache=self.name, result='hit' if hit else 'miss')
+        return entry[1] if hit else default
+
+    def set(self, key, value):
+        """
+        Cache a value, evicting the least recently used one if the cache is full.
+        :param key: The key
+        :param value: The value
+        """
+        expiry = None if self.ttl is None else monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (expiry, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Remove a value from the cache.
+        :param key: The key
+        :param default: The value to return if the key is not cached
+        :returns: The removed value or the default one
+        """
+        with self.lock:
+            return self.entries.pop(key, (None, default))[1]
+
+    def items(self):
+        """
+        Get the cached entries which have not expired, from the least recently used one.
+        :returns: A list of (key, value) pairs
+        """
+        now = monotonic()
+        with self.lock:
+            return [(key, value) for key, (expiry, value) in self.entries.items()
+                    if expiry is None or expiry >= now]
+
+    def clear(self):
+        """Remove every value from the cache"""
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        """
+        Return the number of cached values
+        :returns: The number of cached values
+        """
+        return len(self.entries)
+
+
+class NegativeCache:
+    """
+    This class caches failed lookups for a short time. Entries are grouped by a tag, such as a MAC
+    address, invalidating all the entries of a tag at once.
+    :param size: The maximum number of entries
+    :param ttl: The number of seconds after which entries expire
+    :param name: The optional name the hits and misses of the cache are counted under
+    """
+    def __init__(self, size, ttl, name=None):
+        self.entries = LRUCache(size, ttl, name)
+        self.invalidated = LRUCache(size, ttl) # When each tag was last invalidated
+
+    def get(self, key, tag, default=None):
+        """
+        Get a value from the cache.
+        :param key: The key to look for
+        :param tag: The tag of the key
+        :param default: The value to return if the key is not cached or has been invalidated
+        :returns: The cached value or the default one
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        cached_at, value = entry
+        invalidated_at = self.invalidated.get(tag)
+        if invalidated_at is not None and invalidated_at >= cached_at:
+            self.entries.pop(key)
+            return default
+        return value
+
+    def set(self, key, value):
+        """
+        Cache a value.
+        :param key: The key
+        :param value: The value
+        """
+        self.entries.set(key, (monotonic(), value))
+
+    def invalidate(self, tag):
+        """
+        Invalidate the values cached so far with a tag.
+        :param tag: The tag
+        """
+        self.invalidated.set(tag, monotonic())
+
+
+class SingleFlight:
     """
-    Find the first available value in a sorted list.
-    :param l: The list
-    :param start: The starting value
+    This class runs one call at a time per key: the calls made with a key while another one is
+    running wait for it and share its result or exception.
     """
-    l = [i for i in l if i >= start]
-    if len(l) == 0 or l[0] != start:
-        return start
-    mid_i = (len(l) + 1) // 2
-    start = l[0]
-    mid = l[mid_i-1]
-    if mid - start > mid_i - 1:
-        return first_available(l[:mid_i], start)
-    return first_available(l[mid_i:], mid + 1)
+    def __init__(self):
+        self.calls = {}
+        self.lock = Lock()
+
+    def do(self, key, function, *args, timeout=None):
+        """
+        Call a function, or wait for the call running with the same key.
+        :param key: The key
+        :param function: The function
+        :param args: The args to pass
+        :param timeout: The number of seconds to wait for the running call, None to wait forever
+        :returns: The result, and whether it was shared by another call
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result(timeout), True
+        try:
+            result = function(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+        call.set_result(result)
+        return result, False
@@ -0,0 +1,105 @@
+"""This module provides the deferred writing of LDAP modifications"""
+
+import atexit
+import logging
+import os
+from collections import OrderedDict
+from threading import Condition, Thread
+from .metrics import inc
+
+
+class WriteBehind:
+    """
+    This class queues LDAP modifications and applies them in batches from a background thread.
+    Pending modifications of a same attribute are coalesced, only the last value being written.
+    Failed modifications are queued again a limited number of times.
+    :param ldap: The ldap used to apply the modifications
+    :param interval: The maximum number of seconds a modification waits before being applied
+    :param batch: The number of pending modifications triggering a batch before the interval
+    :param retries: The number of times a failed modification is queued again
+    """
+    def __init__(self, ldap, interval, batch, retries):
+        self.ldap = ldap
+        self.interval = interval
+        self.batch = batch
+        self.retries = retries
+        self.pending = OrderedDict()
+        self.attempts = {}
+        self.condition = Condition()
+        self.thread = None
+        self.pid = os.getpid()
+        WRITERS.append(self)
+
+    def put(self, dn, key, value):
+        """
+        Queue a modification.
+        :param dn: The base DN
+        :param key: The key to alter
+        :param value: The value to set
+        """
+        with self.condition:
+            if (dn, key) in self.pending:
+                inc('dhcapi_deferred_writes_total', result='coalesced')
+            self.pending[(dn, key)] = value
+            self.attempts.pop((dn, key), None) # A new value gets all its attempts
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name='write-behind', daemon=True)
+                self.thread.start()
+            if len(self.pending) >= self.batch:
+                self.condition.notify()
+
+    def run(self):
+        """Apply the pending modifications forever"""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) >= self.batch, self.interval)
+            self.apply()
+
+    def apply(self):
+        """
+        Apply the pending modifications, queuing the failed ones again unless they were retried
+        enough or a newer value is pending.
+        :returns: The number of modifications queued again
+        """
+        with self.condition:
+            batch, self.pending = self.pending, OrderedDict()
+            attempts = {key: self.attempts.pop(key, 0) for key in batch}
+        failed = {}
+        for (dn, key), value in batch.items():
+            try:
+                self.ldap.update(dn, key, value)
+                inc('dhcapi_deferred_writes_total', result='written')
+            except Exception as e:
+                if attempts[(dn, key)] < self.retries:
+                    failed[(dn, key)] = value
+                    inc('dhcapi_deferred_writes_total', result='retried')
+                else:
+                    inc('dhcapi_deferred_writes_total', result='failed')
+                logging.warning('[WRITEBEHIND][apply] Update of %s on %s failed. Reason:\n'
+                                '                     %s', key, dn, e)
+        with self.condition:
+            for (dn, key), value in failed.items():
+                if (dn, key) not in self.pending:
+                    self.pending[(dn, key)] = value
+                    self.attempts[(dn, key)] = attempts[(dn, key)] + 1
+        return len(failed)
+
+    def flush(self):
+        """Apply the pending modifications at once, retrying the failed ones"""
+        if self.pid != os.getpid():
+            return
+        for _ in range(self.retries + 1):
+            if not self.apply():
+                return
+
+
+WRITERS = []
+
+
+def flush_writers():
+    """Apply the pending modifications of the process, which is exiting"""
+    for writer in list(WRITERS):
+        writer.flush()
+
+
+atexit.register(flush_writers)
@@ -0,0 +1 @@
+from api.asgi import app
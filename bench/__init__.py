@@ -0,0 +1,2 @@
+"""This module provides the benchmarks of the API. Run them from the repository root with
+`python -m bench.<name>`."""
@@ -0,0 +1,109 @@
+"""
+This benchmark measures the IP operations done for every packet, and optionally compares them with
+the api/ip.py of another git revision:
+
+    python -m bench.ip_ops [--against REVISION] [--number N]
+"""
+
+import argparse
+import subprocess
+import types
+from timeit import timeit
+from api import ip as current
+
+
+def load(revision):
+    """
+    Load the api/ip.py of a git revision as a module.
+    :param revision: The git revision
+    :returns: The module
+    """
+    source = subprocess.run(['git', 'show', f'{revision}:api/ip.py'], capture_output=True,
+                            text=True, check=True).stdout
+    module = types.ModuleType(f'ip_{revision}')
+    exec(compile(source, f'{revision}:api/ip.py', 'exec'), module.__dict__) #pylint: disable=W0122
+    return module
+
+
+def operations(module, number):
+    """
+    Build the operations to measure with the IP and Network types of a module.
+    :param module: The module
+    :param number: The number of calls of every operation
+    :returns: The operations by name
+    """
+    IP, Network = module.IP, module.Network #pylint: disable=C0103
+    relay, mask, other = IP('10.6.0.5'), IP('0.31.128.0'), IP('10.6.3.4')
+    sections = [Network(network) for network in ['10.0.128.0/255.31.128.0',
+                                                  '10.6.128.0/255.255.128.0',
+                                                  '10.6.0.0/255.255.128.0']]
+
+    def packet():
+        # The IP work of a transaction: match the relay, compute the pool, format the answer
+        relay_ip = IP('10.6.0.5')
+        if not relay_ip:
+            return None
+        network = next(network for network in sections if relay_ip in network)
+        base = network.base_ip(relay_ip)
+        first, last = base + 2, base + IP('0.0.127.250')
+        lease = first + 40
+        return (first <= lease <= last, relay_ip.extract(mask), str(lease), str(relay_ip),
+                str(network.contiguous_mask))
+
+    unseen = iter([f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(number + 1)])
+
+    def hashing():
+        return {relay: 0}[relay]
+
+    return {
+        'parse': lambda: IP('10.6.0.5'),
+        'parse unseen': lambda: IP(next(unseen)),
+        'format': lambda: str(IP(168165381)),
+        'format again': lambda: str(relay),
+        'compare': lambda: relay < other,
+        'equal': lambda: relay == other,
+        'add': lambda: relay + 2,
+        'contains': lambda: relay in sections[2],
+        'extract': lambda: relay.extract(mask),
+        'dict lookup': hashing,
+        'packet': packet,
+    }
+
+
+def measure(operation, number):
+    """
+    Measure an operation.
+    :param operation: The operation
+    :param number: The number of calls
+    :returns: The duration of a call in ns, or None if the operation is not supported
+    """
+    try:
+        operation()
+    except TypeError: # Such as hashing unhashable IPs
+        return None
+    return timeit(operation, number=number) / number * 1e9
+
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(prog='python -m bench.ip_ops', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--against', help='git revision to compare with')
+    parser.add_argument('--number', type=int, default=200000, help='calls per operation')
+    args = parser.parse_args()
+    mine = operations(current, args.number)
+    theirs = operations(load(args.against), args.number) if args.against else None
+    print(f'{"operation":<14} {"now (ns)":>10}' + (f' {args.against[:10] + " (ns)":>15} '
+                                                   f'{"speedup":>8}' if theirs else ''))
+    for name, operation in mine.items():
+        now = measure(operation, args.number)
+        line = f'{name:<14} {now:>10.0f}'
+        if theirs:
+            before = measure(theirs[name], args.number)
+            line += (f' {before:>15.0f} {before / now:>7.1f}x' if before is not None
+                     else f' {"unsupported":>15}')
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
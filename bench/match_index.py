@@ -0,0 +1,56 @@
+"""This benchmark compares the linear scan of the pool sections against the network index"""
+
+import random
+import sys
+from timeit import timeit
+from api.ip import Network, NetworkIndex, IP
+
+
+LOOKUPS = 10000
+
+
+def make_networks(count):
+    """
+    Generate pool sections looking like ours: mostly VLAN subnets, and a few non-contiguous masks.
+    :param count: The number of networks
+    :returns: The list of networks
+    """
+    networks = ['10.0.128.0/255.31.128.0', '10.6.0.0/255.255.128.0', '10.6.128.0/255.255.128.0']
+    networks += [f'10.{64 + i // 256 % 128}.{i % 256}.0/{random.choice([23, 24])}'
+                 for i in range(count - len(networks))]
+    return [Network(network) for network in networks[:count]]
+
+
+def linear(networks, ip):
+    """
+    Find the first network containing an IP by checking them in order.
+    :param networks: The networks
+    :param ip: The IP
+    :returns: The index of the network or None
+    """
+    for i, network in enumerate(networks):
+        if ip in network:
+            return i
+    return None
+
+
+def main(sizes):
+    """
+    Run the benchmark.
+    :param sizes: The numbers of sections to benchmark
+    """
+    random.seed(0)
+    print(f'{"sections":>10} {"linear (us)":>12} {"index (us)":>12} {"speedup":>8}')
+    for size in sizes:
+        networks = make_networks(size)
+        index = NetworkIndex(networks)
+        ips = [IP(random.getrandbits(32) & 0x003fffff | 0x0a000000) for _ in range(LOOKUPS)]
+        assert all(linear(networks, ip) == index.find(ip) for ip in ips[:1000])
+        t_linear = timeit(lambda: [linear(networks, ip) for ip in ips], number=1) / LOOKUPS
+        t_index = timeit(lambda: [index.find(ip) for ip in ips], number=1) / LOOKUPS
+        print(f'{size:>10} {t_linear * 1e6:>12.2f} {t_index * 1e6:>12.2f} '
+              f'{t_linear / t_index:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [3, 10, 100, 500, 1000])
@@ -0,0 +1,281 @@
+"""
+This tool replays logged transactions against the HTTP routes and the LDAP stand-in, at their
+logged pace or faster, and reports the latency distributions and the outcomes which differ from the
+logged ones. It reads the text logs, whose lines follow DISCOVERY_LINE and REQUEST_LINE, or the
+binary transaction log.
+
+    python -m bench.replay [--discover PATH] [--request PATH] [--txlog DIRECTORY] [--speed X]
+                           [--since DATE] [--until DATE] [--limit N] [--workers N] [--latency MS]
+                           [--jitter MS] [--failures RATE] [--no-seed]
+
+The transactions are logged once answered, so their timestamps are the answer times rather than
+the arrival times, and the relay IP is the router IP of the pool, which only differs from the relay
+IP for pools configuring their own router IP.
+"""
+
+import argparse
+import logging
+import re
+import threading
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from string import Formatter
+from time import perf_counter, sleep
+from api import discovery, requesting, txlog
+from api.constants import DISCOVERY_LINE, REQUEST_LINE
+from api.exceptions import NoRuleMatchedException, FieldUndefinedException
+from api.ip import IP
+from api.loader import get_env
+from api.messages import Message
+from api.txlog import DISCOVER, REQUEST, KINDS
+from .standin import StandIn, Faults
+
+
+# The positional fields of DISCOVERY_LINE and REQUEST_LINE, in order
+FIELDS = ['timestamp', 'relay_ip', 'mac', 'ip', 'status', 'vid', 'zid']
+
+Transaction = namedtuple('Transaction', ['timestamp', 'kind', 'relay_ip', 'mac', 'ip', 'status'])
+
+OUTCOME = threading.local()
+
+
+def pattern(template):
+    """
+    Build the regular expression matching the lines of a log template.
+    :param template: The template, such as DISCOVERY_LINE
+    :returns: The compiled expression, with a group for every field
+    """
+    regex, position, seen = '', 0, set()
+    for literal, field, _, _ in Formatter().parse(template.rstrip('\n')):
+        regex += re.escape(literal)
+        if field is None:
+            continue
+        if field == '':
+            field, position = FIELDS[position], position + 1
+        elif field.isdigit():
+            field = FIELDS[int(field)]
+        regex += f'(?P={field})' if field in seen else f'(?P<{field}>.*?)'
+        seen.add(field)
+    missing = {'timestamp', 'relay_ip', 'mac', 'status'} - seen
+    if missing:
+        raise ValueError(f'The template lacks {", ".join(sorted(missing))}')
+    return re.compile(regex)
+
+
+def read_text(path, kind, since, until):
+    """
+    Read the transactions of a text log.
+    :param path: The log path
+    :param kind: DISCOVER or REQUEST
+    :param since: The lowest timestamp in µs
+    :param until: The highest timestamp in µs
+    :returns: The transactions, and the number of lines which could not be parsed
+    """
+    regex = pattern(DISCOVERY_LINE if kind == DISCOVER else REQUEST_LINE)
+    transactions, skipped = [], 0
+    with open(path, errors='replace') as f:
+        for line in f:
+            match = regex.fullmatch(line.rstrip('\n'))
+            if match is None or not match['timestamp'].isdigit():
+                skipped += 1
+                continue
+            timestamp = int(match['timestamp'])
+            if since <= timestamp <= until:
+                transactions.append(Transaction(timestamp, kind, match['relay_ip'], match['mac'],
+                                                match.groupdict().get('ip', 'UNKNOWN'),
+                                                match['status']))
+    return transactions, skipped
+
+
+def read_binary(directory, since, until):
+    """
+    Read the transactions of the binary transaction log.
+    :param directory: The segments directory
+    :param since: The lowest timestamp in µs
+    :param until: The highest timestamp in µs
+    :returns: The transactions
+    """
+    return [Transaction(record.timestamp, record.kind, str(IP(record.relay_ip)),
+                        f'{record.mac:012x}', str(IP(record.ip)) if record.ip else 'UNKNOWN',
+                        Message(record.message).name)
+            for record in txlog.query(directory, since=since, until=until)]
+
+
+def seed(ldap, transactions):
+    """
+    Give the clients whose first replayed transaction is a successful request the lease they held
+    before the replayed window, so that their renewals do not fail for lack of history.
+    :param ldap: The stand-in
+    :param transactions: The transactions, by time
+    :returns: The number of leases added
+    """
+    seen, count = set(), 0
+    for transaction in transactions:
+        if transaction.mac in seen:
+            continue
+        seen.add(transaction.mac)
+        if (transaction.kind != REQUEST or transaction.status != Message.OK.name
+                or transaction.ip == 'UNKNOWN'):
+            continue
+        try:
+            env = get_env(IP(transaction.relay_ip), transaction.mac)
+        except (NoRuleMatchedException, FieldUndefinedException, ValueError):
+            continue
+        ldap.put_lease(f'{env["lease_prefix"]}{transaction.mac}-0', transaction.mac,
+                       transaction.ip,
+                       datetime.now().astimezone() + timedelta(seconds=env['lease_duration']))
+        count += 1
+    return count
+
+
+def capture(_, result):
+    """
+    Record the outcome of a transaction for the replay, instead of logging it.
+    :param result: The transaction result
+    """
+    OUTCOME.message = result.message.name
+    OUTCOME.ip = result.get_ip()
+
+
+def replay(client, transactions, speed, workers):
+    """
+    Send the transactions to the routes, keeping their relative timing. Like the clients, which
+    wait for an answer before going on, the transactions of a client are sent one after the other,
+    and a request asks for the IP offered by the replayed discovery before it.
+    :param client: The test client of the Flask app
+    :param transactions: The transactions, by time
+    :param speed: The acceleration factor, 0 sending the transactions as fast as possible
+    :param workers: The number of concurrent transactions
+    :returns: The replay duration, and for every transaction, its latency since it was due and its
+              outcome
+    """
+    offers = {}
+
+    def send(transaction, due, previous):
+        if previous is not None:
+            previous.result()
+            due = max(due, perf_counter())
+        OUTCOME.message = None
+        form = {'relay_ip': transaction.relay_ip, 'mac': transaction.mac}
+        if transaction.kind == REQUEST:
+            ip = offers.pop(transaction.mac, transaction.ip)
+            form['requested_ip'] = '0.0.0.0' if ip == 'UNKNOWN' else ip
+            form['hostname'] = 'replay'
+        try:
+            response = client.post(f'/{KINDS[transaction.kind]}', data=form)
+            outcome = (OUTCOME.message or 'NO_ANSWER' if response.status_code == 200
+                       else f'HTTP_{response.status_code}')
+            if transaction.kind == DISCOVER and OUTCOME.message == Message.OK.name:
+                offers[transaction.mac] = OUTCOME.ip
+        except Exception as e: #pylint: disable=W0703
+            outcome = type(e).__name__
+        return transaction, perf_counter() - due, outcome
+
+    start = perf_counter()
+    first = transactions[0].timestamp
+    with ThreadPoolExecutor(workers) as executor:
+        futures, last = [], {}
+        for transaction in transactions:
+            # Latencies are measured from the due time, so that the queueing behind a burst counts
+            due = start + (transaction.timestamp - first) / 1000000 / speed if speed else None
+            delay = due - perf_counter() if due else 0
+            if delay > 0:
+                sleep(delay)
+            # The previous transaction of the client was submitted first, so it is already running
+            future = executor.submit(send, transaction, due or perf_counter(),
+                                     last.get(transaction.mac))
+            futures.append(future)
+            last[transaction.mac] = future
+        results = [future.result() for future in futures]
+    return perf_counter() - start, results
+
+
+def percentile(latencies, p):
+    """
+    Get a percentile of latencies.
+    :param latencies: The sorted latencies in seconds
+    :param p: The percentile, between 0 and 1
+    :returns: The percentile in milliseconds
+    """
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+
+def report(transactions, duration, results):
+    """
+    Print the results of a replay.
+    :param transactions: The transactions, by time
+    :param duration: The replay duration
+    :param results: The transactions with their latencies and outcomes
+    """
+    window = (transactions[-1].timestamp - transactions[0].timestamp) / 1000000
+    peak = max(Counter(t.timestamp // 1000000 for t in transactions).values())
+    print(f'{len(transactions)} transactions logged over {window:.1f}s (peak {peak}/s), '
+          f'replayed in {duration:.1f}s ({len(transactions) / duration:.0f}/s)')
+    print(f'\n{"kind":<10} {"count":>8} {"p50 (ms)":>9} {"p90 (ms)":>9} {"p99 (ms)":>9} '
+          f'{"p99.9 (ms)":>10} {"max (ms)":>9}')
+    for kind, name in enumerate(KINDS):
+        latencies = sorted(latency for t, latency, _ in results if t.kind == kind)
+        if not latencies:
+            continue
+        print(f'{name:<10} {len(latencies):>8}', *(f'{percentile(latencies, p):>{width}.2f}'
+                                                   for p, width in [(.5, 9), (.9, 9), (.99, 9),
+                                                                    (.999, 10), (1, 9)]))
+    mismatches = Counter((KINDS[t.kind], t.status, outcome)
+                         for t, _, outcome in results if outcome != t.status)
+    print(f'\n{sum(mismatches.values())} outcomes differ from the logged ones')
+    if mismatches:
+        print(f'{"kind":<10} {"logged":<14} {"replayed":<26} {"count":>8}')
+        for (kind, logged, outcome), count in mismatches.most_common():
+            print(f'{kind:<10} {logged:<14} {outcome:<26} {count:>8}')
+
+
+def main():
+    """Replay the logs"""
+    parser = argparse.ArgumentParser(prog='python -m bench.replay', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--discover', help='text log of the discoveries')
+    parser.add_argument('--request', help='text log of the requests')
+    parser.add_argument('--txlog', help='directory of the binary transaction log')
+    parser.add_argument('--speed', type=float, default=1.,
+                        help='acceleration factor, 0 for as fast as possible')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='ISO date or time')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='ISO date or time')
+    parser.add_argument('--limit', type=int, help='maximum number of transactions')
+    parser.add_argument('--workers', type=int, default=64, help='concurrent transactions')
+    parser.add_argument('--latency', type=float, default=0., help='LDAP latency in ms')
+    parser.add_argument('--jitter', type=float, default=0., help='LDAP latency jitter in ms')
+    parser.add_argument('--failures', type=float, default=0., help='LDAP failure rate')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='start from an empty directory, without the leases held before')
+    args = parser.parse_args()
+    if not (args.discover or args.request or args.txlog):
+        parser.error('no log to replay')
+    since = int(args.since.timestamp() * 1000000) if args.since else 0
+    until = int(args.until.timestamp() * 1000000) if args.until else 2**64-1
+
+    transactions = []
+    for path, kind in [(args.discover, DISCOVER), (args.request, REQUEST)]:
+        if path:
+            read, skipped = read_text(path, kind, since, until)
+            transactions += read
+            if skipped:
+                print(f'{skipped} lines of {path} could not be parsed')
+    if args.txlog:
+        transactions += read_binary(args.txlog, since, until)
+    transactions = sorted(transactions)[:args.limit]
+    if not transactions:
+        parser.error('no transaction to replay')
+
+    from api import api #pylint: disable=C0415
+    logging.disable(logging.CRITICAL) # Injected failures are expected
+    api.ldap = StandIn(faults=Faults(args.latency / 1000, args.jitter / 1000, args.failures),
+                       pool_size=args.workers)
+    if not args.no_seed:
+        print(f'{seed(api.ldap, transactions)} leases held before the replayed window')
+    discovery.log = requesting.log = capture
+    report(transactions, *replay(api.app.test_client(), transactions, args.speed, args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""
+This benchmark runs the discovery and requesting logic, and the HTTP routes, against the LDAP
+stand-in, and reports the throughput and the latency percentiles of each scenario.
+
+    python -m bench.scenarios [--count N] [--threads N] [--latency MS] [--jitter MS]
+                              [--failures RATE] [SCENARIO ...]
+"""
+
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Barrier
+from time import perf_counter
+from api import discovery, requesting
+from api.allocator import ALLOCATORS
+from api.ip import IP
+from api.loader import get_env
+from api.messages import Message
+from api.mirror import LeaseMirror
+from api.models import Lease
+from .standin import StandIn, Faults
+
+
+RELAY_IP = IP('10.6.0.5') # A relay of the Registration pool
+BATCH = 100 # Clients per call of the batch scenarios
+RACERS = 4 # Workers adding a lease for the same IP at once in the race scenario
+
+
+def measure(function, items, threads):
+    """
+    Call a function on items from several threads.
+    :param function: The function, returning whether the call succeeded, a call raising an
+                     exception having failed
+    :param items: The items
+    :param threads: The number of threads
+    :returns: The total duration, the durations of the calls, and the number of failed calls
+    """
+    def timed(item):
+        start = perf_counter()
+        try:
+            ok = function(item)
+        except Exception: #pylint: disable=W0703
+            ok = False
+        return perf_counter() - start, ok
+
+    start = perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(timed, items))
+    durations = sorted(duration for duration, _ in results)
+    return perf_counter() - start, durations, sum(1 for _, ok in results if not ok)
+
+
+def report(name, total, durations, failed):
+    """
+    Print the results of a scenario.
+    :param name: The scenario name
+    :param total: The total duration
+    :param durations: The sorted durations of the calls
+    :param failed: The number of failed calls
+    """
+    def percentile(p):
+        if not durations:
+            return 0
+        return durations[min(len(durations) - 1, int(len(durations) * p))] * 1000
+    print(f'{name:<18} {len(durations):>8} {len(durations) / total:>10.0f} '
+          f'{percentile(.5):>9.2f} {percentile(.99):>9.2f} {failed:>7}')
+
+
+def pool_of(relay_ip):
+    """
+    Get the lease prefix and the first IP of the pool of a relay.
+    :param relay_ip: The relay IP
+    :returns: The lease prefix and the first IP
+    """
+    env = get_env(relay_ip, '000000000000')
+    return env['lease_prefix'], env['first']
+
+
+def new_clients(args, faults):
+    """Clients discovering the same pool for the first time"""
+    ldap = StandIn(faults=faults, pool_size=args.threads)
+    return measure(lambda i: discovery.process(ldap, RELAY_IP, f'{i:012x}').message == Message.OK,
+                   range(args.count), args.threads)
+
+
+def new_clients_batch(args, faults):
+    """Clients discovering the same pool for the first time, in batches of BATCH clients"""
+    ldap = StandIn(faults=faults, pool_size=args.threads)
+    batches = [[(RELAY_IP, f'{i:012x}') for i in range(j, min(j + BATCH, args.count))]
+               for j in range(0, args.count, BATCH)]
+    return measure(lambda clients: all(result.message == Message.OK for result in
+                                       discovery.process_batch(ldap, clients)),
+                   batches, args.threads)
+
+
+def renewals(args, faults):
+    """Clients renewing their leases"""
+    ldap = StandIn(faults=faults, pool_size=args.threads)
+    prefix, first = pool_of(RELAY_IP)
+    macs = ldap.populate(args.count, prefix, first,
+                         datetime.now().astimezone() + timedelta(hours=2))
+    return measure(lambda i: requesting.process(ldap, RELAY_IP, first + i, macs[i], 'bench')
+                   .message == Message.OK, range(args.count), args.threads)
+
+
+def renewals_mirrored(args, faults):
+    """Clients renewing their leases, looked up in the lease mirror"""
+    ldap = StandIn(faults=faults, pool_size=args.threads)
+    prefix, first = pool_of(RELAY_IP)
+    macs = ldap.populate(args.count, prefix, first,
+                         datetime.now().astimezone() + timedelta(hours=2))
+    ldap.mirror = LeaseMirror(ldap, 1, 3600, 10, 1000)
+    ldap.mirror.load()
+    return measure(lambda i: requesting.process(ldap, RELAY_IP, first + i, macs[i], 'bench')
+                   .message == Message.OK, range(args.count), args.threads)
+
+
+def optimistic_race(args, faults):
+    """
+    Workers with identical bitmaps adding leases for the same IP at once in the optimistic mode,
+    each race being a call, which fails unless exactly one of the leases keeps the IP
+    """
+    ldap = StandIn(faults=faults, pool_size=args.threads * RACERS)
+    prefix, first = pool_of(RELAY_IP)
+
+    def race(i):
+        barrier = Barrier(RACERS)
+
+        def racer(j):
+            server = ldap.master()
+            lease = Lease.add(ldap, f'{prefix}{i:06x}{j:06x}', f'{i:06x}{j:06x}', first + i,
+                              server)
+            barrier.wait() # Every lease sees the others
+            return Lease.claim(ldap, prefix, first + i, lease.lease_id, server)
+
+        with ThreadPoolExecutor(RACERS) as executor:
+            return sum(executor.map(racer, range(RACERS))) == 1
+
+    return measure(race, range(args.count), args.threads)
+
+
+def replica_down(args, faults):
+    """Clients discovering their existing leases while one of the two replicas is down"""
+    ldap = StandIn(['rw1'], ['ro1', 'ro2'], faults, pool_size=args.threads)
+    prefix, first = pool_of(RELAY_IP)
+    macs = ldap.populate(args.count, prefix, first)
+    faults.down.add('ro1')
+    try:
+        return measure(lambda mac: discovery.process(ldap, RELAY_IP, mac).message == Message.OK,
+                       macs, args.threads)
+    finally:
+        faults.down.discard('ro1')
+
+
+def cleanup(args, faults):
+    """Removal of expired leases, each removal being a call"""
+    ldap = StandIn(faults=faults, pool_size=args.threads)
+    prefix, first = pool_of(RELAY_IP)
+    ldap.populate(args.count, prefix, first, datetime.now().astimezone() - timedelta(hours=1))
+    start = perf_counter()
+    counts = ldap.remove_expired_leases()
+    total = perf_counter() - start
+    # Removals are not timed one by one, so every one of them gets the mean duration
+    return total, [total / max(1, counts['found'])] * counts['found'], counts['failed']
+
+
+def routes(args, faults):
+    """Clients discovering the same pool for the first time, through the Flask routes"""
+    from api import api #pylint: disable=C0415
+    api.ldap = StandIn(faults=faults, pool_size=args.threads)
+    client = api.app.test_client()
+    return measure(lambda i: client.post('/discover', data={
+        'relay_ip': str(RELAY_IP), 'mac': ':'.join(f'{i:012x}'[j:j+2] for j in range(0, 12, 2))
+    }).status_code == 200, range(args.count), args.threads)
+
+
+SCENARIOS = {'new_clients': new_clients, 'new_clients_batch': new_clients_batch,
+             'renewals': renewals, 'renewals_mirrored': renewals_mirrored,
+             'optimistic_race': optimistic_race, 'replica_down': replica_down,
+             'cleanup': cleanup, 'routes': routes}
+
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(prog='python -m bench.scenarios', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*',
+                        help=f'among {", ".join(SCENARIOS)}, all by default')
+    parser.add_argument('--count', type=int, default=2000, help='calls per scenario')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent calls')
+    parser.add_argument('--latency', type=float, default=0., help='LDAP latency in ms')
+    parser.add_argument('--jitter', type=float, default=0., help='LDAP latency jitter in ms')
+    parser.add_argument('--failures', type=float, default=0., help='LDAP failure rate')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario {name}')
+    logging.disable(logging.CRITICAL) # Injected failures are expected
+    print(f'{"scenario":<18} {"calls":>8} {"calls/s":>10} {"p50 (ms)":>9} {"p99 (ms)":>9} '
+          f'{"failed":>7}')
+    for name in args.scenarios or SCENARIOS:
+        ALLOCATORS.pools.clear() # Every scenario starts with an empty directory
+        faults = Faults(args.latency / 1000, args.jitter / 1000, args.failures)
+        report(name, *SCENARIOS[name](args, faults))
+
+
+if __name__ == '__main__':
+    main()
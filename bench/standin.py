@@ -0,0 +1,359 @@
+"""
+This module provides an in-process stand-in for the LDAP cluster: an in-memory directory indexed by
+lease ID, served to the API through connections with injected latency and failures. It supports
+the operations and the search filters the API uses, and is fast enough for the benchmarks to
+measure the API rather than the stand-in.
+"""
+
+import random
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from functools import lru_cache
+from threading import RLock
+from time import sleep
+from ldap3 import BASE
+from ldap3.core.exceptions import (LDAPSocketOpenError, LDAPSocketReceiveError,
+                                   LDAPNoSuchObjectResult, LDAPEntryAlreadyExistsResult)
+from api.constants import LEASES_DN, DEVICES_DN
+from api.ldap import Ldap
+from api.roundrobin.autoldap import PAGED_RESULTS
+
+
+@lru_cache(maxsize=1024)
+def parse_filter(text):
+    """
+    Parse a search filter.
+    :param text: The filter
+    :returns: The filter tree, made of ('&', children), ('|', children), ('!', child),
+              ('=', attribute, value), ('*', attribute, prefix), ('<=', attribute, value),
+              ('>=', attribute, value) and ('present', attribute) nodes
+    """
+    def node(i):
+        if text[i] != '(':
+            raise ValueError(f'Invalid filter {text}')
+        operator = text[i + 1]
+        if operator in '&|':
+            children, i = [], i + 2
+            while text[i] == '(':
+                child, i = node(i)
+                children.append(child)
+            return (operator, children), i + 1
+        if operator == '!':
+            child, i = node(i + 2)
+            return ('!', child), i + 1
+        end = text.index(')', i)
+        item = text[i + 1:end]
+        for operator in ['<=', '>=', '=']:
+            if operator in item:
+                attribute, value = item.split(operator, 1)
+                attribute = attribute.lower()
+                if operator != '=':
+                    return (operator, attribute, value), end + 1
+                if value == '*':
+                    return ('present', attribute), end + 1
+                if value.endswith('*') and '*' not in value[:-1]:
+                    return ('*', attribute, value[:-1].lower()), end + 1
+                return ('=', attribute, value.lower()), end + 1
+        raise ValueError(f'Invalid filter {text}')
+    return node(0)[0]
+
+
+def comparable(value, other):
+    """
+    Convert an assertion value to the type of an attribute value, so that they can be compared.
+    :param value: The attribute value
+    :param other: The assertion value
+    :returns: The converted assertion value
+    """
+    if isinstance(value, datetime):
+        return datetime.strptime(other, '%Y%m%d%H%M%S%z')
+    return other
+
+
+def matches(tree, attributes):
+    """
+    Evaluate a filter on an entry.
+    :param tree: The filter tree
+    :param attributes: The entry attributes, by lower case name
+    :returns: Whether the entry matches
+    """
+    operator = tree[0]
+    if operator == '&':
+        return all(matches(child, attributes) for child in tree[1])
+    if operator == '|':
+        return any(matches(child, attributes) for child in tree[1])
+    if operator == '!':
+        return not matches(tree[1], attributes)
+    if operator == 'present':
+        return tree[1] in attributes
+    value = attributes.get(tree[1])
+    if value is None:
+        return False
+    if operator == '<=':
+        return value <= comparable(value, tree[2])
+    if operator == '>=':
+        return value >= comparable(value, tree[2])
+    if isinstance(value, list):
+        return tree[2] in [str(x).lower() for x in value]
+    if operator == '*':
+        return str(value).lower().startswith(tree[2])
+    return str(value).lower() == tree[2]
+
+
+class Value:
+    """
+    This class represents an attribute of a search result.
+    :param value: The attribute value
+    """
+    def __init__(self, value):
+        self.value = value
+
+
+class Entry:
+    """
+    This class represents a search result, whose attributes are given as objects with a value.
+    :param dn: The entry DN
+    :param attributes: The entry attributes
+    """
+    def __init__(self, dn, attributes):
+        self.entry_dn = dn
+        for name, value in attributes.items():
+            setattr(self, name, Value(value))
+
+
+class Directory:
+    """This class holds the entries of the stand-in, and indexes the leases by lease ID"""
+    def __init__(self):
+        self.entries = {}
+        self.lease_ids = []
+        self.lock = RLock()
+
+    def add(self, dn, attributes):
+        """
+        Add an entry, with its RDN attribute as a server would.
+        :param dn: The entry DN
+        :param attributes: The entry attributes
+        """
+        name, value = dn.split(',', 1)[0].split('=', 1)
+        attributes = {name: value, **attributes}
+        with self.lock:
+            if dn in self.entries:
+                raise LDAPEntryAlreadyExistsResult(f'{dn} already exists')
+            self.entries[dn] = {**attributes, 'modifyTimestamp': datetime.now().astimezone()}
+            if 'leaseID' in attributes:
+                insort(self.lease_ids, (attributes['leaseID'].lower(), dn))
+
+    def modify(self, dn, changes):
+        """
+        Replace attributes of an entry.
+        :param dn: The entry DN
+        :param changes: The changes, by attribute name
+        """
+        with self.lock:
+            entry = self.entries.get(dn)
+            if entry is None:
+                raise LDAPNoSuchObjectResult(f'{dn} does not exist')
+            for name, [(_, values)] in changes.items():
+                entry[name] = values[0] if len(values) == 1 else values
+            entry['modifyTimestamp'] = datetime.now().astimezone()
+
+    def delete(self, dn):
+        """
+        Remove an entry.
+        :param dn: The entry DN
+        """
+        with self.lock:
+            entry = self.entries.pop(dn, None)
+            if entry is None:
+                raise LDAPNoSuchObjectResult(f'{dn} does not exist')
+            if 'leaseID' in entry:
+                key = (entry['leaseID'].lower(), dn)
+                del self.lease_ids[bisect_left(self.lease_ids, key)]
+
+    def candidates(self, tree):
+        """
+        Narrow down the entries which may match a filter with the lease ID index.
+        :param tree: The filter tree
+        :returns: The DNs of the candidates, or None if the filter cannot use the index
+        """
+        operator = tree[0]
+        if operator in ['=', '*'] and tree[1] == 'leaseid':
+            i = bisect_left(self.lease_ids, (tree[2],))
+            dns = []
+            while i < len(self.lease_ids) and self.lease_ids[i][0].startswith(tree[2]):
+                if operator == '*' or self.lease_ids[i][0] == tree[2]:
+                    dns.append(self.lease_ids[i][1])
+                i += 1
+            return dns
+        if operator == '&':
+            for child in tree[1]:
+                dns = self.candidates(child)
+                if dns is not None:
+                    return dns
+        if operator == '|':
+            dns = [self.candidates(child) for child in tree[1]]
+            if all(x is not None for x in dns):
+                return list(dict.fromkeys(dn for x in dns for dn in x))
+        return None
+
+    def search(self, base, query, scope):
+        """
+        Find the entries matching a filter.
+        :param base: The base DN
+        :param query: The filter
+        :param scope: The search scope
+        :returns: The matching entries
+        """
+        tree = parse_filter(query)
+        with self.lock:
+            if scope == BASE:
+                dns = [base] if base in self.entries or not base else []
+            else:
+                dns = self.candidates(tree)
+                if dns is None:
+                    dns = list(self.entries)
+            results = []
+            for dn in dns:
+                attributes = self.entries.get(dn, {})
+                if dn != base and dn.endswith(base) and matches(tree, {
+                        k.lower(): v for k, v in attributes.items()}):
+                    results.append(Entry(dn, attributes))
+                elif scope == BASE:
+                    results.append(Entry(dn, attributes))
+            return results
+
+
+class Faults:
+    """
+    This class describes the latency and the failures injected into the LDAP operations.
+    :param latency: The mean latency of an operation in seconds
+    :param jitter: The maximum deviation from the mean latency in seconds
+    :param failure_rate: The fraction of operations failing as if the connection broke
+    """
+    def __init__(self, latency=0., jitter=0., failure_rate=0.):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.down = set()
+
+    def inject(self, address):
+        """
+        Delay an operation, and make it fail if the server is down or by chance.
+        :param address: The server address
+        """
+        if self.latency or self.jitter:
+            sleep(max(0., self.latency + random.uniform(-self.jitter, self.jitter)))
+        if address in self.down or random.random() < self.failure_rate:
+            raise LDAPSocketReceiveError(f'Injected failure on {address}')
+
+
+class Connection:
+    """
+    This class implements the part of the ldap3 connections the API uses, on the directory.
+    :param directory: The directory
+    :param address: The server name
+    :param faults: The injected faults
+    """
+    socket = None
+
+    def __init__(self, directory, address, faults):
+        self.directory = directory
+        self.address = address
+        self.faults = faults
+        self.entries = []
+        self.result = {}
+        self.pages = []
+
+    def search(self, search_base, search_filter, search_scope=None, attributes=None,
+               paged_size=None, paged_cookie=None, **_):
+        """Search the directory, page by page if a page size is given"""
+        self.faults.inject(self.address)
+        if paged_size is None:
+            self.entries = self.directory.search(search_base, search_filter, search_scope)
+            self.result = {}
+            return bool(self.entries)
+        if not paged_cookie:
+            self.pages = self.directory.search(search_base, search_filter, search_scope)
+        self.entries, self.pages = self.pages[:paged_size], self.pages[paged_size:]
+        cookie = b'more' if self.pages else b''
+        self.result = {'controls': {PAGED_RESULTS: {'value': {'cookie': cookie}}}}
+        return bool(self.entries)
+
+    def add(self, dn, object_class=None, attributes=None):
+        """Add an entry to the directory"""
+        self.faults.inject(self.address)
+        self.directory.add(dn, {'objectClass': object_class, **(attributes or {})})
+        return True
+
+    def modify(self, dn, changes):
+        """Replace attributes of an entry of the directory"""
+        self.faults.inject(self.address)
+        self.directory.modify(dn, changes)
+        return True
+
+    def delete(self, dn):
+        """Remove an entry from the directory"""
+        self.faults.inject(self.address)
+        self.directory.delete(dn)
+        return True
+
+    def unbind(self):
+        """Close the connection"""
+
+
+class StandIn(Ldap):
+    """
+    This class is the API's LDAP client, connected to an in-memory directory shared by all its
+    servers instead of a real cluster.
+    :param rw_servers: The R/W server names
+    :param ro_servers: The R/O server names
+    :param faults: The injected faults
+    :param pool_size: The maximum number of connections to a server
+    """
+    def __init__(self, rw_servers=('rw1',), ro_servers=(), faults=None, pool_size=8):
+        super().__init__('cn=admin', '', list(rw_servers), list(ro_servers), pool_size)
+        self.faults = faults or Faults()
+        self.directory = Directory()
+
+    def connect(self, address):
+        """
+        Connect to a server of the stand-in.
+        :param address: The server name
+        :returns: The connection
+        """
+        if address in self.faults.down:
+            raise LDAPSocketOpenError(f'{address} is down')
+        return Connection(self.directory, address, self.faults)
+
+    def put_lease(self, lease_id, mac, ip, expiry):
+        """
+        Add a lease and its device directly to the directory.
+        :param lease_id: The lease ID
+        :param mac: The MAC address
+        :param ip: The IP address
+        :param expiry: The lease expiry
+        """
+        self.directory.add(f'leaseID={lease_id},{LEASES_DN}', {
+            'objectClass': 'reselLease', 'macAddress': mac, 'ipHostNumber': str(ip),
+            'leaseExpiry': expiry})
+        if f'macAddress={mac},{DEVICES_DN}' not in self.directory.entries:
+            self.directory.add(f'macAddress={mac},{DEVICES_DN}',
+                               {'objectClass': 'reselDevice', 'host': ''})
+
+    def populate(self, count, lease_prefix, first, expiry=None, mac_offset=0):
+        """
+        Add leases and devices directly to the directory.
+        :param count: The number of leases
+        :param lease_prefix: The lease prefix of the pool
+        :param first: The IP of the first lease, the next ones following
+        :param expiry: The lease expiry, by default in one hour
+        :param mac_offset: The number of the first MAC address
+        :returns: The MAC addresses of the leases
+        """
+        expiry = expiry or datetime.now().astimezone() + timedelta(hours=1)
+        macs = []
+        for i in range(count):
+            mac = f'{mac_offset + i:012x}'
+            self.put_lease(f'{lease_prefix}{mac}-{i}', mac, first + i, expiry)
+            macs.append(mac)
+        return macs
@@ -0,0 +1,25 @@
+"""This module provides the gunicorn hooks of the API, the settings being on the command line"""
+
+
+def on_starting(server): #pylint: disable=W0613
+    """
+    Remove the metrics of the workers of a previous run, in the master process.
+    :param server: The arbiter
+    """
+    from api.metrics import METRICS #pylint: disable=C0415
+    METRICS.clear()
+
+
+def worker_exit(server, worker): #pylint: disable=W0613
+    """
+    Apply the pending LDAP modifications of an exiting worker, write its pending logs and
+    transactions, and remove its metrics.
+    :param server: The arbiter
+    :param worker: The worker
+    """
+    from api import logs, txlog, writebehind #pylint: disable=C0415
+    from api.metrics import METRICS #pylint: disable=C0415
+    writebehind.flush_writers()
+    logs.close_writers()
+    txlog.close()
+    METRICS.close()